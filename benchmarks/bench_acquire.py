@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+'''
+Compares the old busy-wait acquisition loop from Worker.run with the
+Reader thread from pulseox_acquire, reading the simulated pulse oximeter in
+real time.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Reports the CPU time used per second of acquisition and the read interval
+percentiles and late reads, once with processing that keeps up and once
+with a processData() that takes longer than a read period every refresh.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pulseox_acquire import Reader
+from pulseox_device import SimulatedDevice
+from pulseox_engine import READ_PERIOD
+from pulseox_profile import Profiler
+from pulseox_protocol import decode_packets
+
+SECONDS = 3.0
+READS_PER_REFRESH = 3 # SAMPLES_PER_REFRESH/UC_NUM_DATASETS for the short view
+
+# CPU time of this process, time.process_time() doesn't exist in Python 2
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock
+
+
+def busy_wait(device, profiler, process_time):
+    # the loop Worker.run used before
+    read_t0 = 0
+    reads = 0
+    t_end = time.time() + SECONDS
+    while time.time() < t_end:
+        read_t1 = time.time()
+        if (read_t1 - read_t0 > READ_PERIOD):
+            if read_t0 > 0:
+                profiler.add('read interval', read_t1 - read_t0)
+                if read_t1 - read_t0 > READ_PERIOD + 0.006:
+                    profiler.count('late reads')
+            read_t0 = read_t1
+            decode_packets(device.read())
+            reads += 1
+            if reads % READS_PER_REFRESH == 0:
+                time.sleep(process_time)
+
+
+def reader_thread(device, profiler, process_time):
+    reader = Reader(device, READ_PERIOD, profiler)
+    reader.start()
+    reads = 0
+    t_end = time.time() + SECONDS
+    while time.time() < t_end:
+        for read_t0, data in reader.get(0.5):
+            decode_packets(data)
+            reads += 1
+            if reads % READS_PER_REFRESH == 0:
+                time.sleep(process_time)
+    reader.stop()
+
+
+if __name__ == '__main__':
+    print('%-14s %-10s %10s %9s %9s %9s %6s' %
+          ('loop', 'process', 'CPU [%]', 'p50 [ms]', 'p99 [ms]', 'max [ms]', 'late'))
+    for process_time in [0.001, 0.05]:
+        for name, loop in [('busy wait', busy_wait), ('Reader', reader_thread)]:
+            device = SimulatedDevice(seed=0)
+            device.open()
+            profiler = Profiler()
+            c0 = cpu_time()
+            t0 = time.time()
+            loop(device, profiler, process_time)
+            cpu = (cpu_time() - c0)/(time.time() - t0)
+            n, mean, mx, (p50, p90, p99) = profiler.summary('read interval')
+            print('%-14s %-10s %10.1f %9.1f %9.1f %9.1f %6d' %
+                  (name, '%g ms' % (1e3*process_time), 100*cpu, 1e3*p50, 1e3*p99, 1e3*mx,
+                   profiler.counters.get('late reads', 0)))
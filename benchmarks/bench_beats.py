@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+'''
+Accuracy and cost of the beat stream and the heart rate variability.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Runs a simulated device whose heart rate follows breathing (respiratory
+sinus arrhythmia) plus a random walk, and compares the beats the engine
+reports and its SDNN, RMSSD and pNN50 over the trend window with those of
+the beats the simulation actually produced. Also checks that the batch
+and incremental paths report the same beats, and times the beat tracker,
+its quality scoring and the HRV update per refresh.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from math import pi, sin
+from numpy import abs as np_abs, arange, array, cumsum, diff, errstate, floor, mean, random, \
+                  sqrt, std
+from pulseox_device import SimulatedDevice
+from pulseox_engine import PulseOxEngine, UC_SAMPLE_PERIOD
+from pulseox_protocol import UC_NUM_DATASETS, decode_packets
+
+SECONDS = 600
+BREATHING = 0.25 # Hz
+SWING = 6 # bpm either side
+PEAK_PHASE = 0.15 # where SimulatedDevice puts the peak in each beat
+
+
+def heart_rates(seed=0):
+    # heart rate of every read
+    rs = random.RandomState(seed)
+    reads = int(SECONDS/(UC_NUM_DATASETS*UC_SAMPLE_PERIOD))
+    t = arange(reads)*UC_NUM_DATASETS*UC_SAMPLE_PERIOD
+    walk = cumsum(rs.randn(reads))*0.05
+    return array([70 + SWING*sin(2*pi*BREATHING*x) for x in t]) + walk
+
+
+def true_beats(rates):
+    # sample numbers of the peaks the device produced
+    phase = cumsum(rates.repeat(UC_NUM_DATASETS)/60.0*UC_SAMPLE_PERIOD)
+    beat = floor(phase - PEAK_PHASE)
+    return (arange(len(phase))[1:][diff(beat) > 0] + 1).astype(float)
+
+
+def hrv(peaks):
+    rr = diff(peaks)*UC_SAMPLE_PERIOD
+    d = diff(rr)
+    return std(rr, ddof=1), sqrt(mean(d*d)), 100*mean(np_abs(d) > 0.05)
+
+
+def run(rates, incremental):
+    engine = PulseOxEngine('short', incremental=incremental)
+    device = SimulatedDevice(heart_rate=rates[0], realtime=False, seed=1)
+    device.open()
+    beats = []
+    seconds = 0.0
+    with errstate(divide='ignore', invalid='ignore'):
+        for r in range(len(rates)):
+            device.heart_rate = rates[r]
+            if engine.push(decode_packets(device.read())):
+                engine.process(t=r*UC_NUM_DATASETS*UC_SAMPLE_PERIOD)
+                beats += engine.new_beats
+    return engine, beats
+
+
+if __name__ == '__main__':
+    rates = heart_rates()
+    engine, beats = run(rates, True)
+    batch, batch_beats = run(rates, False)
+    print('%d beats, %d accepted, batch path the same: %s' %
+          (len(beats), sum([b.accepted for b in beats]), beats == batch_beats))
+
+    truth = true_beats(rates)
+    found = array([b.n for b in beats], dtype=float)
+    # The truth is the phase the peak is drawn at, a sample or two from the
+    # largest sample of a noisy peak. Any other beats reported are the
+    # detector's, mostly dicrotic waves, which the HRV leaves out as
+    # artifacts.
+    error = abs(truth[:, None] - found[None, :])
+    matched = error.min(axis=0) <= 3
+    print('%d of %d true beats reported, %d other beats' %
+          (len(set(error.argmin(axis=0)[matched])), len(truth), (~matched).sum()))
+
+    span = engine.trend_span
+    sdnn, rmssd, pnn50 = hrv(truth[truth > found[-1] - span])
+    print('%-8s %10s %10s' % ('', 'true', 'measured'))
+    print('%-8s %10.1f %10.1f' % ('SDNN', 1e3*sdnn, 1e3*engine.hrv.sdnn('trend')))
+    print('%-8s %10.1f %10.1f' % ('RMSSD', 1e3*rmssd, 1e3*engine.hrv.rmssd('trend')))
+    print('%-8s %10.1f %10.1f' % ('pNN50', pnn50, engine.hrv.pnn50('trend')))
+    print('artifacts %d' % engine.hrv.artifacts)
+
+    # cost of the beat stream per refresh
+    window, Ired, Iir = engine.stream.window()
+    result = engine.process(t=0.0)
+    refreshes = 2000
+    t0 = time.time()
+    for r in range(refreshes):
+        engine.beat_tracker.reset()
+        engine.beat_tracker.last = beats[-2].n
+        for beat in engine.beat_tracker.update(window, Ired, Iir, result[3], result[4], 0.0):
+            engine.hrv.add(beat)
+    t1 = time.time()
+    print('beat tracker, quality and HRV %.1f us per refresh' % (1e6*(t1-t0)/refreshes))
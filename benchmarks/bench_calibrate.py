@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+'''
+Accuracy and time of calibrating a fleet of pulse oximeters.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Records sessions from simulated devices that each read off by a different
+calibration constant, one of them with a different curve as well, at
+several SpO2 levels, with a reference file for the desaturation. Then runs
+pulseox_calibrate.py over them twice, once extracting the beats and once
+from the cache, and checks the SpO2 the engine reads with each device's
+profile against the SpO2 it was simulated at.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange, column_stack, concatenate, errstate, nanmedian, random, savetxt
+from pulseox_calibrate import load_profile, main, profile_path
+from pulseox_device import SimulatedDevice
+from pulseox_engine import K, READ_PERIOD
+from pulseox_protocol import decode_packets
+from pulseox_replay import read_recording, replay
+from pulseox_signal import SPO2_CURVE
+
+DEVICES = 6
+SECONDS = 120 # per level
+LEVELS = [98, 93, 88] # percent SpO2
+CHECK_LEVEL = 95
+
+
+def record(path, SpO2s, K, curve, seed):
+    # writes a rawdata.txt of SECONDS at each SpO2 in turn
+    device = SimulatedDevice(SpO2=SpO2s[0], realtime=False, seed=seed, K=K, curve=curve)
+    device.open()
+    reads = int(SECONDS/READ_PERIOD)
+    rows = []
+    for k, SpO2 in enumerate(SpO2s):
+        device.SpO2 = SpO2
+        for r in range(reads):
+            datasets = decode_packets(device.read())
+            t = (k*reads + r)*READ_PERIOD
+            rows.append(column_stack([t + 0*datasets[:, 0], datasets[:, 2],
+                                      datasets[:, 0], datasets[:, 1]]))
+    savetxt(path, concatenate(rows), fmt=['%.3f', '%d', '%d', '%d'])
+
+
+def read_SpO2(directory, name, K, curve):
+    # median SpO2 the engine reads at CHECK_LEVEL
+    path = os.path.join(directory, name+'_check.txt')
+    series = replay(*read_recording(path), K=K, curve=curve)
+    with errstate(invalid='ignore'):
+        return nanmedian(series[len(series)//2:, 3])
+
+
+if __name__ == '__main__':
+    rs = random.RandomState(0)
+    directory = tempfile.mkdtemp()
+    try:
+        truth = {}
+        lines = []
+        for d in range(DEVICES):
+            name = 'unit%d' % d
+            Kd = K + rs.uniform(-0.05, 0.05)
+            curve = SPO2_CURVE if d > 0 else (0.84, 0.2, 0.63, 0.09)
+            truth[name] = (Kd, curve)
+            # steady readings at each level, and a desaturation with a
+            # reference reading every 5 s
+            for SpO2 in LEVELS:
+                record(os.path.join(directory, '%s_%d.txt' % (name, SpO2)), [SpO2], Kd, curve, d)
+                lines.append('%s %s_%d.txt %d' % (name, name, SpO2, SpO2))
+            record(os.path.join(directory, name+'_desat.txt'), [97, 91, 97], Kd, curve, d)
+            t = arange(0, 3*SECONDS, 5.0)
+            savetxt(os.path.join(directory, name+'_reference.txt'),
+                    column_stack([t, 97 - 6*((t >= SECONDS) & (t < 2*SECONDS))]), fmt='%.1f')
+            lines.append('%s %s_desat.txt %s_reference.txt' % (name, name, name))
+            record(os.path.join(directory, name+'_check.txt'), [CHECK_LEVEL], Kd, curve, d+100)
+        sessions = os.path.join(directory, 'sessions.txt')
+        with open(sessions, 'w') as fo:
+            fo.write('\n'.join(lines)+'\n')
+        outdir = os.path.join(directory, 'calibration')
+        curve_dir = os.path.join(directory, 'curve')
+
+        t0 = time.time()
+        main([sessions, '-o', curve_dir, '--curve'])
+        t1 = time.time()
+        main([sessions, '-o', curve_dir, '--curve'])
+        t2 = time.time()
+        main([sessions, '-o', outdir])
+        t3 = time.time()
+        print('')
+        print('extracting and fitting %.2f s, from the cache %.2f s, K only %.2f s' %
+              (t1-t0, t2-t1, t3-t2))
+
+        print('%-8s %10s %10s %14s %14s %14s' % ('device', 'true K', 'fitted K', 'SpO2 default',
+                                                 'SpO2 K only', 'SpO2 curve'))
+        for d in range(DEVICES):
+            name = 'unit%d' % d
+            k_only = load_profile(profile_path(outdir, name))
+            with_curve = load_profile(profile_path(curve_dir, name))
+            print('%-8s %10.4f %10.4f %14.1f %14.1f %14.1f' %
+                  (name, truth[name][0], k_only['K'],
+                   read_SpO2(directory, name, K, SPO2_CURVE),
+                   read_SpO2(directory, name, k_only['K'], k_only['curve']),
+                   read_SpO2(directory, name, with_curve['K'], with_curve['curve'])))
+        print('simulated at %d%%' % CHECK_LEVEL)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+'''
+Micro-benchmark of recording the raw data with DEBUG_DATA enabled.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Compares the old text dump, four str() calls and two writes per dataset,
+against appending each read to a capture file, then reads a time range back
+and checks it against what was written.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange, column_stack, uint32
+from pulseox_capture import CaptureReader, CaptureWriter
+from pulseox_protocol import RED, IR, SAMPLE_NUM, UC_NUM_DATASETS
+
+NUM_READS = 20000
+READ_PERIOD = 0.03
+
+
+def make_reads(num):
+    n = arange(num*UC_NUM_DATASETS)
+    datasets = column_stack([250000+(n % 125), 180000+(n % 125), n]).astype(uint32)
+    return [datasets[k:k+UC_NUM_DATASETS] for k in range(0, len(datasets), UC_NUM_DATASETS)]
+
+
+def write_text(path, reads):
+    fo = open(path, 'w')
+    for k, datasets in enumerate(reads):
+        read_t0 = 1000+k*READ_PERIOD
+        for n, red, ir in zip(datasets[:, SAMPLE_NUM], datasets[:, RED], datasets[:, IR]):
+            fo.write(' '+str(read_t0)+' '+str(n)+' '+str(red)+' '+str(ir))
+            fo.write('\n')
+    fo.close()
+
+
+def write_capture(path, reads):
+    writer = CaptureWriter(path)
+    for k, datasets in enumerate(reads):
+        writer.append(1000+k*READ_PERIOD, datasets)
+    writer.close()
+
+
+if __name__ == '__main__':
+    reads = make_reads(NUM_READS)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, func, path in [('text (old)', write_text, 'rawdata.txt'),
+                                 ('capture', write_capture, 'rawdata.cap')]:
+            path = os.path.join(tmpdir, path)
+            t0 = time.time()
+            func(path, reads)
+            t1 = time.time()
+            print('%-12s %10.0f reads/s' % (name, NUM_READS/(t1-t0)))
+
+        reader = CaptureReader(os.path.join(tmpdir, 'rawdata.cap'))
+        # the capture file is preallocated so compare the bytes in use
+        print('text %d bytes, capture %d bytes' %
+              (os.path.getsize(os.path.join(tmpdir, 'rawdata.txt')),
+               len(reader)*reader.records.itemsize))
+        t0 = time.time()
+        records = reader.time_range(1000+100*READ_PERIOD, 1000+200*READ_PERIOD)
+        t1 = time.time()
+        print('time_range   %10.1f us for %d records' % (1e6*(t1-t0), len(records)))
+        assert (records['n'] == arange(100*UC_NUM_DATASETS, 200*UC_NUM_DATASETS)).all()
+        del reader, records
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+'''
+Micro-benchmark of the USB packet decoder.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Compares the old hand-written decoder from Worker.readData, which built each
+uint32 a byte at a time and stored it one element at a time, against
+decode_packets() writing slices into the circular buffers. Packets are tuples
+of ints since that's what pyusb's interruptRead() returns.
+'''
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange, int64, zeros
+from pulseox_protocol import DATASET_FIELDS, RED, IR, SAMPLE_NUM, decode_packets, ring_write
+
+BUFFERSIZE = 1500
+NUM_PACKETS = 20000
+QUEUE_DEPTH = 20 # packets decoded per call in the batched case
+
+
+def make_packets(num):
+    packets = []
+    for p in range(num):
+        values = []
+        for d in range(5):
+            sample_num = 5*p+d
+            values += [250000+(sample_num % 125), 180000+(sample_num % 125), sample_num]
+        packets.append(tuple(bytearray(struct.pack('<15I', *values))))
+    return packets
+
+
+def decode_old(packets, cb_red, cb_ir, cb_n):
+    i = 0
+    for data in packets:
+        for k in range(5):
+            b = 12*k
+            cb_red[i+k] = (data[b+3]<<24)+(data[b+2]<<16)+(data[b+1]<<8)+data[b]
+            cb_ir[i+k] = (data[b+7]<<24)+(data[b+6]<<16)+(data[b+5]<<8)+data[b+4]
+            cb_n[i+k] = (data[b+11]<<24)+(data[b+10]<<16)+(data[b+9]<<8)+data[b+8]
+        i = (i + 5) % BUFFERSIZE
+
+
+def decode_new(packets, cb):
+    i = 0
+    for data in packets:
+        i = ring_write(cb, i, decode_packets(data))
+
+
+def decode_batched(packets, cb):
+    i = 0
+    for k in range(0, len(packets), QUEUE_DEPTH):
+        i = ring_write(cb, i, decode_packets(packets[k:k+QUEUE_DEPTH]))
+
+
+def check_ring_write(L=10):
+    # writes of every length up to and past the buffer, against a plain
+    # list of everything written so far
+    cb = zeros(L, dtype=int64)
+    i = 0
+    written = []
+    for num in [3, 13, 7, 20, 1, 10, 25, 9]:
+        values = arange(len(written), len(written)+num)
+        i = ring_write(cb, i, values)
+        written.extend(values)
+        assert i == len(written) % L, 'ring_write returned the wrong index'
+        for k in range(1, min(L, len(written))+1):
+            assert cb[(i-k) % L] == written[-k], 'ring_write misplaced a value'
+
+
+def bench(name, func, packets):
+    # Worker keeps cb_red, cb_ir and cb_n as column views of one (N, 3)
+    # buffer so a decoded packet is stored with a single slice assignment.
+    cb = zeros((BUFFERSIZE, DATASET_FIELDS), dtype=int64)
+    buffers = [cb[:, RED], cb[:, IR], cb[:, SAMPLE_NUM]]
+    t0 = time.time()
+    if func is decode_old:
+        func(packets, *buffers)
+    else:
+        func(packets, cb)
+    t1 = time.time()
+    print('%-28s %10.0f packets/s' % (name, len(packets)/(t1-t0)))
+    return buffers
+
+
+if __name__ == '__main__':
+    packets = make_packets(NUM_PACKETS)
+
+    old = bench('per-element (old)', decode_old, packets)
+    new = bench('decode_packets', decode_new, packets)
+    batched = bench('decode_packets, %d queued' % QUEUE_DEPTH, decode_batched, packets)
+
+    for a, b, c in zip(old, new, batched):
+        assert (a == b).all() and (a == c).all(), 'decoders disagree'
+    check_ring_write()
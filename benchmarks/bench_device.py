@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+'''
+End to end throughput of reading, decoding and processing packets from the
+simulated pulse oximeter, run as fast as the CPU allows.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Checks that the heart rate and SpO2 reported for the simulated signal are
+close to the ones it was set to.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import errstate
+from pulseox_device import SimulatedDevice
+from pulseox_engine import PulseOxEngine, READ_PERIOD
+from pulseox_protocol import decode_packets
+
+NUM_READS = 6000 # 3 minutes of reads
+
+
+def run(view, heart_rate, SpO2, **options):
+    device = SimulatedDevice(heart_rate=heart_rate, SpO2=SpO2, realtime=False, seed=0, **options)
+    device.open()
+    engine = PulseOxEngine(view)
+    refreshes = 0
+    t0 = time.time()
+    # the window starts out flat so the first refreshes divide 0 by 0
+    with errstate(divide='ignore', invalid='ignore'):
+        for r in range(NUM_READS):
+            if engine.push(decode_packets(device.read())):
+                engine.process()
+                refreshes += 1
+    t1 = time.time()
+    device.close()
+
+    print('%-5s %3d bpm %3d%% %-24s %8.0f reads/s %6.0fx real time  hr %5.1f SpO2 %5.1f' %
+          (view, heart_rate, SpO2, ' '.join('%s=%s' % kv for kv in sorted(options.items())),
+           NUM_READS/(t1-t0), NUM_READS*READ_PERIOD/(t1-t0), engine.heartrate, engine.SpO2))
+    assert abs(engine.heartrate - heart_rate) < 2, 'heart rate off'
+    assert abs(engine.SpO2 - SpO2) < 2, 'SpO2 off'
+
+
+if __name__ == '__main__':
+    for view in ['short', 'long']:
+        run(view, 75, 97)
+        run(view, 110, 92)
+        run(view, 60, 97, drop=0.05)
+        run(view, 75, 97, sample_num=2**32-NUM_READS)
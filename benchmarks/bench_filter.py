@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+'''
+Throughput of the streaming PPG filter, and the heart rate found with and
+without it on simulated signals with noise and motion artifacts.
+Author: Jonathan Thomson
+Released Under the MIT License
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import errstate, log
+from numpy.random import RandomState
+from pulseox_device import SimulatedDevice
+from pulseox_engine import PulseOxEngine, UC_SAMPLE_PERIOD
+from pulseox_filter import ppg_filter
+from pulseox_protocol import UC_NUM_DATASETS, decode_packets
+
+NUM_SAMPLES = 200000
+NUM_READS = 6000 # 3 minutes
+
+
+def throughput(block, **options):
+    chain = ppg_filter(UC_SAMPLE_PERIOD, **options)
+    x = -log(1e5 + 1e3*RandomState(0).rand(NUM_SAMPLES))
+    chain.reset(x[0])
+    t0 = time.time()
+    for k in range(0, NUM_SAMPLES, block):
+        chain.process(x[k:k+block])
+    t1 = time.time()
+    print('%2d stages, blocks of %5d: %8.0f samples/s, %5.2f us/sample' %
+          (len(chain.stages), block, NUM_SAMPLES/(t1-t0), 1e6*(t1-t0)/NUM_SAMPLES))
+
+
+def accuracy(filter, heart_rate, **options):
+    device = SimulatedDevice(heart_rate=heart_rate, realtime=False, seed=1, **options)
+    device.open()
+    engine = PulseOxEngine('short', filter=filter)
+    rates = []
+    t0 = time.time()
+    with errstate(divide='ignore', invalid='ignore'):
+        for r in range(NUM_READS):
+            if engine.push(decode_packets(device.read())):
+                engine.process()
+                if engine.heartrate is not None and r*UC_SAMPLE_PERIOD*UC_NUM_DATASETS > 20:
+                    rates.append(engine.heartrate)
+    t1 = time.time()
+    errors = sorted([abs(hr - heart_rate) for hr in rates])
+    print('%-8s %3d bpm %-24s %6.0f reads/s  median error %6.1f bpm, p90 %6.1f bpm' %
+          (['raw', 'filtered'][bool(filter)], heart_rate,
+           ' '.join('%s=%s' % kv for kv in sorted(options.items())), NUM_READS/(t1-t0),
+           errors[len(errors)//2], errors[9*len(errors)//10]))
+
+
+if __name__ == '__main__':
+    for block in [UC_NUM_DATASETS, 1500]:
+        throughput(block)
+        throughput(block, dc=True, derivative=True)
+    for options in [dict(), dict(noise=0.002), dict(motion=1.0), dict(motion=1.0, noise=0.002)]:
+        for filter in [False, True]:
+            accuracy(filter, 70, **options)
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+'''
+Push and draw times of the history's decimation pyramid.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Fills a History with HISTORY_SECONDS of synthetic reads, timing the pushes
+of a read at a time, then times envelope() for spans from a second to the
+whole history against reducing every sample of the span to its pixel
+columns with minmax_indices(), the way the window used to be drawn. First
+checks that reads through consistent() while another thread pushes never
+mix samples from different pushes.
+'''
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange
+from bench_stream import synthetic_datasets
+from pulseox_engine import UC_SAMPLE_PERIOD
+from pulseox_history import HISTORY_SECONDS, History
+from pulseox_protocol import UC_NUM_DATASETS
+from pulseox_render import minmax_indices
+
+WIDTH = 1210
+TIMED_READS = 20000
+SPANS = [1, 10, 60, 600, 3600, HISTORY_SECONDS] # seconds
+REPEAT = 20
+
+
+def check_consistent(capacity=5000, reads=2000):
+    # The writer pushes a ramp, each sample its own position, into a small
+    # history so the ring wraps many times. A consistent read of everything held
+    # has to run from start to total - 1 of the same push.
+    history = History(capacity, ingest=False)
+    done = []
+
+    def write():
+        while not done:
+            p = history.total + arange(UC_NUM_DATASETS)
+            history.push(p[:, None].repeat(3, axis=1))
+
+    def read(width):
+        start, total = history.start, history.total
+        x, lo, hi = history.envelope(start, total, width)
+        return start, total, lo, hi, history.samples([start])
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for r in range(reads):
+            start, total, lo, hi, oldest = history.consistent(read, 50 + r % 500)
+            if len(lo) == 0:
+                continue
+            assert lo[0, 0] == start and hi[-1, 1] == total - 1, 'torn envelope'
+            assert oldest[0, 0] == start, 'torn samples'
+    finally:
+        done.append(True)
+        writer.join()
+
+
+if __name__ == '__main__':
+    check_consistent()
+
+    history = History(int(HISTORY_SECONDS/UC_SAMPLE_PERIOD), ingest=False)
+    one = synthetic_datasets(100000)
+    total = history.capacity
+    print('%d samples in %d levels, %.0f MB' %
+          (history.capacity, history.levels,
+           (history.n.nbytes + sum([lo.nbytes for lo in history.lo]) +
+            sum([hi.nbytes for hi in history.hi[1:]]))/1e6))
+
+    t0 = time.time()
+    for k in range(TIMED_READS):
+        i = (k*UC_NUM_DATASETS) % (len(one) - UC_NUM_DATASETS)
+        datasets = one[i:i+UC_NUM_DATASETS].copy()
+        datasets[:, 2] = history.total + arange(UC_NUM_DATASETS)
+        history.push(datasets)
+    t1 = time.time()
+    print('push of a read %.1f us' % (1e6*(t1-t0)/TIMED_READS))
+
+    while history.total < total:
+        datasets = one.copy()
+        datasets[:, 2] = history.total + arange(len(one))
+        history.push(datasets)
+    red = history.lo[0][:, 0]
+
+    print('%10s %6s %14s %14s' % ('span [s]', 'level', 'envelope [ms]', 'every sample'))
+    for seconds in SPANS:
+        span = min(int(seconds/UC_SAMPLE_PERIOD), history.total - history.start)
+        p1 = history.total
+        p0 = p1 - span
+        t0 = time.time()
+        for r in range(REPEAT):
+            history.envelope(p0, p1, WIDTH)
+        t1 = time.time()
+        # what drawing the span from the samples themselves costs
+        i = arange(p0, p1) % history.capacity
+        x = (arange(span)*float(WIDTH))/span
+        for r in range(REPEAT):
+            minmax_indices(x, red[i], WIDTH)
+        t2 = time.time()
+        print('%10d %6d %14.3f %14.3f' % (seconds, history.level(span, WIDTH),
+                                          1e3*(t1-t0)/REPEAT, 1e3*(t2-t1)/REPEAT))
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+'''
+Load test of DeviceManager serving many simulated pulse oximeters in real
+time.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+For each number of devices reports the CPU used by the whole process, the
+worst 99th percentile read interval and processData time of any device, and
+the late and dropped reads. The number of devices a host can serve is the
+largest one where the read interval stays near READ_PERIOD.
+
+With processes the processing runs in a worker process per device. The CPU
+is then only that of the manager's process, the reads and the handoff, and
+proc p99 is the time to collect a frame. Worker processes only help with
+more than one core.
+
+First checks that a device that won't open or sends malformed packets only
+stops its own channel.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pulseox_device import SimulatedDevice
+from pulseox_manager import DeviceManager, simulated_devices
+
+SECONDS = 12.0 # long enough for the first full window of the short view
+DEVICES = [1, 8, 32, 64]
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock
+
+
+class Unopenable(SimulatedDevice):
+    opens = 0
+
+    def open(self):
+        Unopenable.opens += 1
+        raise IOError('no such device')
+
+
+class Malformed(SimulatedDevice):
+    def read(self):
+        return SimulatedDevice.read(self)[:7]
+
+
+def check_faults():
+    # with a single worker, which has to survive the malformed packets for
+    # the good device to be processed
+    def find():
+        return dict(bad=Malformed(realtime=False), good=SimulatedDevice(realtime=False),
+                    gone=Unopenable())
+    manager = DeviceManager(find, workers=1, period=0.02)
+    manager.start(scan_period=None)
+    try:
+        time.sleep(1)
+        channels = manager.channels
+        assert channels['bad'].state == 'error', 'malformed packets not reported'
+        assert channels['good'].state == 'running' and channels['good'].refreshes > 0, \
+               'worker lost to another channel'
+        assert channels['gone'].engine is None, 'engine started for a device not opened'
+        # 4 s of scans, opened again 2 s after the first time and not until
+        # 4 s after that
+        for k in range(20):
+            manager.scan()
+            time.sleep(0.2)
+        assert Unopenable.opens == 2, 'opened %d times, not backing off' % Unopenable.opens
+        manager.report()
+    finally:
+        manager.stop()
+
+
+def run(processes):
+    print('%9s %8s %8s %12s %12s %6s %6s %10s' %
+          ('', 'devices', 'CPU [%]', 'read p99', 'proc p99', 'late', 'drop', 'with HR'))
+    for num in DEVICES:
+        manager = DeviceManager(simulated_devices(num), max_devices=num, processes=processes)
+        c0 = cpu_time()
+        t0 = time.time()
+        manager.start(scan_period=None)
+        time.sleep(SECONDS)
+        rows = manager.status()
+        cpu = (cpu_time() - c0)/(time.time() - t0)
+        manager.stop()
+
+        print('%9s %8d %8.1f %9.1f ms %9.2f ms %6d %6d %10d' %
+              (['threads', 'processes'][processes], num, 100*cpu, 1e3*max([r['read_p99'] or 0 for r in rows]),
+               1e3*max([r['process_p99'] or 0 for r in rows]),
+               sum([r['late_reads'] for r in rows]), sum([r['dropped'] for r in rows]),
+               len([r for r in rows if r['heartrate'] is not None])))
+
+
+if __name__ == '__main__':
+    check_faults()
+    run(False)
+    run(True)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+'''
+Paint time of the photoplethysmograms for the short and long views.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Compares the old paintEvent loop, one drawLine() per STEP samples with a new
+QFont and QColors every repaint, against one drawPolyline() per trace of
+the min/max decimated points built from the numpy arrays. Both paint into
+an offscreen QImage the size of the graph.
+
+Decimation is timed and checked against every pixel column even without
+PyQt4. The painting needs PyQt4 and a display.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import errstate, minimum, unique
+from bench_stream import synthetic_datasets
+from pulseox_engine import PulseOxEngine
+from pulseox_render import minmax_indices, trace_points
+
+REPEAT = 200
+
+
+def window(view):
+    engine = PulseOxEngine(view)
+    datasets = synthetic_datasets(2*engine.buffersize)
+    # the window starts out flat so the first refreshes divide 0 by 0
+    with errstate(divide='ignore', invalid='ignore'):
+        results = engine.feed(datasets[:, 2], datasets[:, 0], datasets[:, 1])
+    tn, nPPG_red, nPPG_ir = results[-1][:3]
+    return engine.constants, tn, nPPG_red, nPPG_ir
+
+
+def check_decimation(tn, y, width):
+    # every pixel column must keep its extremes, which plotting every
+    # STEP-th sample doesn't
+    idx = minmax_indices(tn, y, width)
+    columns = minimum(tn.astype(int), width-1)
+    for c in unique(columns):
+        kept = idx[columns[idx] == c]
+        every = columns == c
+        assert y[kept].max() == y[every].max() and y[kept].min() == y[every].min()
+    return len(idx)
+
+
+def paint_old(QtGui, paint, c, tn, plot_red, plot_ir, floor_red, floor_ir):
+    font = QtGui.QFont('Serif', 7, QtGui.QFont.Light)
+    paint.setFont(font)
+    paint.setPen(QtGui.QColor(255, 255, 255))
+    paint.setBrush(QtGui.QColor(255, 255, 255))
+    paint.drawRect(0, 0, c['GRAPH_WIDTH'], c['GRAPH_HEIGHT'])
+
+    B, STEP = c['BUFFERSIZE'], c['STEP']
+    paint.setPen(QtGui.QColor(255, 0, 0))
+    paint.setBrush(QtGui.QColor(255, 255, 255))
+    for i in range(0, B-STEP, STEP):
+        paint.drawLine(tn[i], floor_red-plot_red[i], tn[i+STEP], floor_red-plot_red[i+STEP])
+    paint.setPen(QtGui.QColor(0, 0, 0))
+    paint.setBrush(QtGui.QColor(255, 255, 255))
+    for i in range(0, B-STEP, STEP):
+        paint.drawLine(tn[i], floor_ir-plot_ir[i], tn[i+STEP], floor_ir-plot_ir[i+STEP])
+
+
+def paint_new(polygon, cache, paint, c, tn, nPPG_red, nPPG_ir, floor_red, floor_ir, sf):
+    paint.setFont(cache['font'])
+    paint.setPen(cache['white'])
+    paint.setBrush(cache['white'])
+    paint.drawRect(0, 0, c['GRAPH_WIDTH'], c['GRAPH_HEIGHT'])
+
+    paint.setPen(cache['pen_red'])
+    paint.drawPolyline(polygon(trace_points(tn, nPPG_red, c['GRAPH_WIDTH'], floor_red, sf)))
+    paint.setPen(cache['pen_ir'])
+    paint.drawPolyline(polygon(trace_points(tn, nPPG_ir, c['GRAPH_WIDTH'], floor_ir, sf)))
+
+
+def bench_paint(view, c, tn, nPPG_red, nPPG_ir):
+    from PyQt4 import QtGui
+    from pulseox_graph import polygon
+
+    hh = 22 # height of heart_peak.png
+    floor_red = (c['GRAPH_HEIGHT']/2)-hh
+    floor_ir = c['GRAPH_HEIGHT']-hh
+    sf = floor_red-hh
+    image = QtGui.QImage(c['GRAPH_WIDTH'], c['GRAPH_HEIGHT'], QtGui.QImage.Format_RGB32)
+    cache = dict(font=QtGui.QFont('Serif', 7, QtGui.QFont.Light),
+                 white=QtGui.QColor(255, 255, 255),
+                 pen_red=QtGui.QPen(QtGui.QColor(255, 0, 0)),
+                 pen_ir=QtGui.QPen(QtGui.QColor(0, 0, 0)))
+
+    times = []
+    for name in ['old', 'new']:
+        t0 = time.time()
+        for r in range(REPEAT):
+            paint = QtGui.QPainter()
+            paint.begin(image)
+            if name == 'old':
+                paint_old(QtGui, paint, c, tn, sf*nPPG_red, sf*nPPG_ir, floor_red, floor_ir)
+            else:
+                paint_new(polygon, cache, paint, c, tn, nPPG_red, nPPG_ir, floor_red, floor_ir, sf)
+            paint.end()
+        times.append((time.time()-t0)/REPEAT)
+    print('%-6s paint: drawLine loop %.2f ms, polyline %.2f ms (%.1fx)' %
+          (view, 1e3*times[0], 1e3*times[1], times[0]/times[1]))
+
+
+if __name__ == '__main__':
+    try:
+        from PyQt4 import QtGui
+        app = QtGui.QApplication(sys.argv)
+    except ImportError:
+        QtGui = None
+        print('PyQt4 is not installed, only decimation is timed')
+
+    for view in ['short', 'long']:
+        c, tn, nPPG_red, nPPG_ir = window(view)
+        points = check_decimation(tn, nPPG_red, c['GRAPH_WIDTH'])
+        t0 = time.time()
+        for r in range(REPEAT):
+            trace_points(tn, nPPG_red, c['GRAPH_WIDTH'], 300, 250)
+        t1 = time.time()
+        print('%-6s %5d samples -> %4d points per trace (STEP kept %d), %.3f ms' %
+              (view, c['BUFFERSIZE'], points, c['BUFFERSIZE']//c['STEP'], 1e3*(t1-t0)/REPEAT))
+        if QtGui is not None:
+            bench_paint(view, c, tn, nPPG_red, nPPG_ir)
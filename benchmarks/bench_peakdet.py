@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+'''
+Checks pulseox_signal.peakdet() against the original implementation from
+Worker.peakdet and times both.
+Author: Jonathan Thomson
+Released Under the MIT License
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange, exp, inf, nan, pi, random, sin
+from pulseox_signal import peakdet
+
+BUFFERSIZES = [1500, 12000, 100000]
+DELTA = 0.15
+
+
+def peakdet_reference(v, delta):
+    # Worker.peakdet as it was before it was replaced by pulseox_signal.peakdet
+    maxtab = []
+    mintab = []
+
+    mn, mx = inf, -inf
+    mnpos, mxpos = nan, nan
+
+    lookformax = True
+    L = len(v)
+    for i in arange(1,L+1):
+        this = v[-i]
+        if this > mx:
+            mx = this
+            mxpos = L-i
+        if this < mn:
+            mn = this
+            mnpos = L-i
+
+        if lookformax:
+            if this < mx-delta:
+                maxtab.insert(0, mxpos)
+                mn = this
+                mnpos = L-i
+                lookformax = False
+        else:
+            if this > mn+delta:
+                mintab.insert(0, mnpos)
+                mx = this
+                mxpos = L-i
+                lookformax = True
+
+    return maxtab, mintab
+
+
+def synthetic_ppg(L, seed=0):
+    # The sum of the normalized red and IR PPGs that processData() hands to
+    # peakdet: roughly 80 [bpm] at 166.7 Hz with a dicrotic notch, baseline
+    # wander, and noise.
+    rs = random.RandomState(seed)
+    t = arange(L)*0.006
+    phase = (t*80/60.0) % 1
+    beat = exp(-((phase-0.15)/0.06)**2) + 0.35*exp(-((phase-0.45)/0.08)**2)
+    wander = 0.3*sin(2*pi*0.25*t)
+    return 1.5*beat + wander + 0.02*rs.randn(L)
+
+
+def bench(func, v, repeat):
+    t0 = time.time()
+    for k in range(repeat):
+        result = func(v, DELTA)
+    return (time.time()-t0)/repeat, result
+
+
+if __name__ == '__main__':
+    for seed in range(20):
+        for L in [50, 1500, 12000]:
+            v = synthetic_ppg(L, seed)
+            assert peakdet(v, DELTA) == peakdet_reference(v, DELTA), \
+                   'mismatch for L=%d seed=%d' % (L, seed)
+
+    print('%10s %8s %14s %14s %8s' % ('BUFFERSIZE', 'beats', 'reference [ms]', 'peakdet [ms]', 'speedup'))
+    for L in BUFFERSIZES:
+        v = synthetic_ppg(L)
+        repeat = max(1, 200000//L)
+        t_ref, ref = bench(peakdet_reference, v, repeat)
+        t_new, new = bench(peakdet, v, repeat)
+        assert new == ref, 'mismatch for L=%d' % L
+        print('%10d %8d %14.3f %14.3f %7.1fx' % (L, len(new[0]), 1000*t_ref, 1000*t_new, t_ref/t_new))
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+'''
+Protocol v1 against v2: what gets through when the host stalls or the
+device samples faster.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Checks that a simulated device sends the same datasets in both protocols,
+times decoding them, then reads a realtime simulated device on the
+Reader's schedule, sleeping for a stall every second, at the default
+sample period and faster ones. Prints the datasets lost and the overflow
+count from the v2 headers. A stall costs v2 nothing as long as it and the
+read period after it fit in the firmware's queue of 74 datasets, with some
+room for the scheduler.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import array_equal, concatenate, uint32, unique
+from pulseox_acquire import Deadlines
+from pulseox_device import SimulatedDevice
+from pulseox_engine import READ_PERIOD, UC_SAMPLE_PERIOD
+from pulseox_protocol import PROTOCOL_V1, PROTOCOL_V2, SAMPLE_NUM, V2_NUM_DATASETS, \
+                             decode_packets, v2_headers
+
+NUM_READS = 20000
+SECONDS = 5 # per realtime case
+STALL_EVERY = 1.0 # seconds
+# (sample period [s], stall [s])
+CASES = [(UC_SAMPLE_PERIOD, 0), (UC_SAMPLE_PERIOD, 0.15), (UC_SAMPLE_PERIOD, 0.4),
+         (0.002, 0), (0.002, 0.08), (0.001, 0), (0.001, 0.03)]
+
+
+def reads(protocol, num):
+    device = SimulatedDevice(realtime=False, seed=0, sample_num=2**32-1000, protocol=protocol)
+    device.open()
+    return [device.read() for r in range(num)]
+
+
+def stalled(protocol, sample_period, stall):
+    # reads on the Reader's schedule for SECONDS with a stall every
+    # STALL_EVERY, returns what was decoded and the v2 overflow count
+    device = SimulatedDevice(seed=0, sample_period=sample_period,
+                             protocol=protocol)
+    device.open()
+    deadlines = Deadlines(READ_PERIOD)
+    received = []
+    overflow = 0
+    t0 = time.time()
+    next_stall = t0 + STALL_EVERY
+    while time.time() - t0 < SECONDS:
+        deadlines.wait()
+        if stall > 0 and time.time() >= next_stall:
+            time.sleep(stall)
+            next_stall += STALL_EVERY
+        data = device.read()
+        received.append(decode_packets(data, protocol))
+        if protocol == PROTOCOL_V2:
+            overflow = int(v2_headers(data)['overflow'][-1])
+    return concatenate(received), overflow
+
+
+def check_empty():
+    # a zero-length read decodes to no datasets in either protocol
+    for protocol in [PROTOCOL_V1, PROTOCOL_V2]:
+        assert decode_packets(b'', protocol).shape == (0, 3), 'empty read'
+    assert len(v2_headers(b'')) == 0, 'empty read headers'
+
+
+if __name__ == '__main__':
+    check_empty()
+    v1 = reads(PROTOCOL_V1, NUM_READS)
+    v2 = reads(PROTOCOL_V2, NUM_READS)
+    print('same datasets in both protocols: %s' %
+          array_equal(decode_packets(v1, PROTOCOL_V1), decode_packets(v2, PROTOCOL_V2)))
+    for name, packets, protocol in [('v1', v1, PROTOCOL_V1), ('v2', v2, PROTOCOL_V2)]:
+        t0 = time.time()
+        for data in packets:
+            decode_packets(data, protocol)
+        t1 = time.time()
+        print('%s decode %8.0f packets/s, %d bytes for 5 datasets' %
+              (name, len(packets)/(t1-t0), len(packets[0])))
+    print('v2 holds up to %d datasets in a 64 byte packet, v1 5 in 60' % V2_NUM_DATASETS)
+    print('')
+
+    print('%-10s %-8s %-4s %10s %10s %8s %10s' %
+          ('period', 'stall', '', 'produced', 'received', 'lost', 'overflow'))
+    for sample_period, stall in CASES:
+        for name, protocol in [('v1', PROTOCOL_V1), ('v2', PROTOCOL_V2)]:
+            datasets, overflow = stalled(protocol, sample_period, stall)
+            n = unique(datasets[:, SAMPLE_NUM].astype(uint32))
+            produced = int(n[-1] - n[0] + 1)
+            print('%-10s %-8s %-4s %10d %10d %7.1f%% %10s' %
+                  ('%.0f ms' % (1e3*sample_period), '%.0f ms' % (1e3*stall), name, produced,
+                   len(n), 100.0*(produced - len(n))/produced,
+                   overflow if protocol == PROTOCOL_V2 else ''))
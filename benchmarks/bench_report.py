@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+'''
+Time to draw the morning review sheets of a night's sessions.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Writes overnight capture files of a simulated pulse, whose heart rate
+wanders slowly, then draws a sheet of each with pulseox_report.py across a
+process pool: the whole night with the vitals, the traces alone, and a
+minute of it with every beat marked as PNG and as SVG. Prints the time per
+sheet and what dozens of sessions would take on the cores there are.
+'''
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from math import pi
+from numpy import arange, cumsum, exp, int64, random, sin, zeros
+from pulseox_capture import CaptureWriter
+from pulseox_engine import UC_SAMPLE_PERIOD
+from pulseox_protocol import DATASET_FIELDS, IR, RED, SAMPLE_NUM, UC_NUM_DATASETS
+from pulseox_report import main
+
+HOURS = 8
+RECORDINGS = 4
+SESSIONS = 36 # a ward's worth, for the estimate
+BLOCK = 1000000 # datasets generated at a time
+READS_PER_APPEND = 6 # reads appended to the capture file together
+
+
+def overnight(path, hours, seed):
+    # writes a capture file of hours of a pulse around 60 [bpm] wandering
+    # by a few bpm, with some baseline wander and noise
+    rs = random.RandomState(seed)
+    num = int(hours*3600/UC_SAMPLE_PERIOD)
+    writer = CaptureWriter(path, capacity=num)
+    block = READS_PER_APPEND*UC_NUM_DATASETS
+    phase = 0.0
+    rate = 60.0
+    for start in range(0, num, BLOCK):
+        count = min(BLOCK, num - start)
+        t = (start + arange(count))*UC_SAMPLE_PERIOD
+        rates = rate + cumsum(rs.randn(count))*0.002
+        rate = rates[-1] + 0.05*(60 - rates[-1])
+        phases = phase + cumsum(rates/60.0*UC_SAMPLE_PERIOD)
+        phase = phases[-1]
+        p = phases % 1
+        beat = exp(-((p-0.15)/0.06)**2) + 0.1*exp(-((p-0.45)/0.08)**2)
+        wander = 0.01*sin(2*pi*0.2*t)
+        datasets = zeros((count, DATASET_FIELDS), dtype=int64)
+        datasets[:, RED] = 40000*exp(-0.02*beat - wander) + 20*rs.randn(count)
+        datasets[:, IR] = 60000*exp(-0.03*beat - wander) + 20*rs.randn(count)
+        datasets[:, SAMPLE_NUM] = start + arange(count)
+        for k in range(0, count, block):
+            writer.append(1.7e9 + t[k], datasets[k:k+block])
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time drawing review sheets.')
+    parser.add_argument('--hours', type=float, default=HOURS)
+    parser.add_argument('--recordings', type=int, default=RECORDINGS)
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        paths = []
+        t0 = time.time()
+        for r in range(args.recordings):
+            paths.append(os.path.join(directory, 'night%d.cap' % r))
+            overnight(paths[-1], args.hours, r)
+        print('wrote %d recordings of %.1f hours in %.1f s' %
+              (args.recordings, args.hours, time.time()-t0))
+
+        outdir = os.path.join(directory, 'sheets')
+        common = ['-o', outdir, '-j', str(args.jobs)] + paths
+        runs = [('whole night, vitals', []),
+                ('whole night, traces only', ['--no-vitals']),
+                ('a minute marked, PNG', ['--start', '3600', '--end', '3660', '--rows', '2']),
+                ('a minute marked, SVG', ['--start', '3600', '--end', '3660', '--rows', '2',
+                                          '--format', 'svg'])]
+        results = []
+        for name, options in runs:
+            t0 = time.time()
+            main(options + common)
+            results.append((name, time.time()-t0))
+        print('')
+        cores = max(args.jobs, 1)
+        for name, elapsed in results:
+            per_sheet = elapsed*min(cores, args.recordings)/args.recordings
+            print('%-26s %6.2f s per sheet, %d sessions on %d cores in %.1f min' %
+                  (name, per_sheet, SESSIONS, cores, SESSIONS*per_sheet/cores/60))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+'''
+Fan-out of StreamServer to many subscribers on the loopback interface.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Serves simulated devices in real time and subscribes more and more load
+test clients, reporting the frames and bytes delivered per second and the
+latency from the read to the subscriber. Then publishes large frames as
+fast as possible with a client that never reads, to check that it loses
+frames instead of holding up the publisher.
+'''
+
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange, zeros
+from pulseox_manager import DeviceManager, simulated_devices
+from pulseox_server import StreamServer, encode_frame, load_test, serve
+
+DEVICES = 8
+CLIENTS = [1, 10, 50, 200]
+SECONDS = 10.0
+STALL_FRAMES = 2000
+STALL_SAMPLES = 8000 # 64 kB frames
+
+
+if __name__ == '__main__':
+    manager = DeviceManager(simulated_devices(DEVICES), max_devices=DEVICES)
+    server = StreamServer('127.0.0.1', 0)
+    serve(manager, server)
+    server.start()
+    manager.start(scan_period=None)
+
+    print('%d devices' % DEVICES)
+    for clients in CLIENTS:
+        print(load_test('127.0.0.1', server.port, clients, SECONDS))
+
+    manager.stop()
+    server.stop()
+
+    server = StreamServer('127.0.0.1', 0)
+    server.start()
+    stalled = socket.create_connection(('127.0.0.1', server.port))
+    time.sleep(0.5)
+    n = arange(STALL_SAMPLES)
+    samples = zeros(STALL_SAMPLES)
+    t0 = time.time()
+    for seq in range(STALL_FRAMES):
+        server.publish(encode_frame('stall', seq, time.time(), n, samples, samples,
+                                    n[:0], n[:0], None, None))
+    t1 = time.time()
+    status = server.status()
+    print('%d frames of %d kB published in %.1f ms to a client that never reads, '
+          '%d sent, %d dropped' % (STALL_FRAMES, 8*STALL_SAMPLES//1000, 1e3*(t1-t0),
+                                   status['sent'], status['dropped']))
+    stalled.close()
+    server.stop()
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+'''
+Cost of updating the windowed statistics against the length of the window.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+The values are a heart rate added every refresh, 90 ms apart in the short
+view. Each window is checked against numpy over the same values first.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import array, mean, median, percentile, var
+from numpy.random import RandomState
+from pulseox_engine import UC_SAMPLE_PERIOD
+from pulseox_stats import Window
+
+SAMPLES_PER_REFRESH = 45
+NUM_UPDATES = 50000
+
+
+def values(num):
+    r = RandomState(0)
+    hr = 75 + 5*r.randn(num)
+    hr[r.rand(num) < 0.01] = 400 # outliers beyond hi
+    return hr
+
+
+def check(span):
+    window = Window(span, 0, 300)
+    hr = values(5000)
+    for k, v in enumerate(hr):
+        n = k*SAMPLES_PER_REFRESH
+        window.add(n, v)
+        if k % 97 == 0:
+            expected = hr[max(0, k - (span - 1)//SAMPLES_PER_REFRESH):k+1]
+            assert len(window) == len(expected), 'window length'
+            assert window.median() == median(expected), 'median'
+            for p in [5, 50, 95]:
+                assert abs(window.percentile(p) - percentile(expected, p)) < 1e-9, 'percentile'
+            assert abs(window.mean() - mean(expected)) < 1e-9, 'mean'
+            assert abs(window.variance() - var(expected)) < 1e-6, 'variance'
+
+
+def run(seconds):
+    span = int(round(seconds/UC_SAMPLE_PERIOD))
+    check(span)
+    window = Window(span, 0, 300)
+    hr = values(NUM_UPDATES).tolist()
+    t0 = time.time()
+    for k, v in enumerate(hr):
+        window.add(k*SAMPLES_PER_REFRESH, v)
+        window.median()
+    t1 = time.time()
+    print('%6d s window %7d values %6.2f us/update' % (seconds, len(window), 1e6*(t1-t0)/NUM_UPDATES))
+
+
+if __name__ == '__main__':
+    for seconds in [3, 20, 300, 3600]:
+        run(seconds)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+'''
+Checks that StreamAnalyzer gives the same results as analyze_window() on
+every refresh and compares the time each takes per refresh.
+Author: Jonathan Thomson
+Released Under the MIT License
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import append, arange, array, array_equal, exp, int64, pi, random, sin, zeros
+from pulseox_protocol import DATASET_FIELDS, RED, IR, SAMPLE_NUM, refresh_due, ring_write
+from pulseox_signal import StreamAnalyzer, analyze_window
+
+UC_SAMPLE_PERIOD = 0.006
+K = -0.024542
+
+# BUFFERSIZE, GRAPH_WIDTH, SAMPLES_PER_REFRESH of the short and long views
+VIEWS = [('short', 1500, 780, 45), ('long', 12000, 1210, 120)]
+
+
+def synthetic_datasets(num, seed=0):
+    # red, IR and sample number rows like the ones decoded from the
+    # microcontroller's packets: ~75 [bpm] with some baseline wander, a
+    # slowly rising IR level and noise.
+    rs = random.RandomState(seed)
+    t = arange(num)*UC_SAMPLE_PERIOD
+    phase = (t*75/60.0) % 1
+    beat = exp(-((phase-0.15)/0.06)**2) + 0.1*exp(-((phase-0.45)/0.08)**2)
+    wander = 0.01*sin(2*pi*0.2*t)
+    datasets = zeros((num, DATASET_FIELDS), dtype=int64)
+    datasets[:, RED] = 40000*exp(-0.02*beat - wander) + 20*rs.randn(num)
+    datasets[:, IR] = (60000+50*t)*exp(-0.03*beat - wander) + 20*rs.randn(num)
+    datasets[:, SAMPLE_NUM] = arange(num) + 1000
+    return datasets
+
+
+def same(a, b):
+    if isinstance(a, str) or isinstance(b, str) or a is None or b is None:
+        return a == b
+    return array_equal(array(a), array(b))
+
+
+def run(view, B, graph_width, samples_per_refresh, seconds):
+    edge_threshold = B-round((1/UC_SAMPLE_PERIOD)/2)
+    datasets = synthetic_datasets(int(seconds/UC_SAMPLE_PERIOD))
+
+    # the Worker's circular buffers
+    cb = zeros((B, DATASET_FIELDS), dtype=int64)
+    i = 0
+    stream = StreamAnalyzer(B, graph_width, edge_threshold, UC_SAMPLE_PERIOD, K)
+
+    t_batch = 0
+    t_stream = 0
+    refreshes = 0
+    for k in range(0, len(datasets), 5):
+        packet = datasets[k:k+5]
+        if k == 0:
+            cb[:, RED] = packet[0, RED]
+            cb[:, IR] = packet[0, IR]
+            cb[:, SAMPLE_NUM] = range(int(packet[0, SAMPLE_NUM])-B, int(packet[0, SAMPLE_NUM]))
+        ring_write(cb, i, packet)
+        stream.push(packet)
+        due = refresh_due(i, len(packet), B, samples_per_refresh)
+        i = (i + len(packet)) % B
+        if not due:
+            continue
+
+        t0 = time.time()
+        n = append(cb[i:, SAMPLE_NUM], cb[:i, SAMPLE_NUM])
+        Ired = append(cb[i:, RED], cb[:i, RED])
+        Iir = append(cb[i:, IR], cb[:i, IR])
+        batch = analyze_window(n, Ired, Iir, graph_width, edge_threshold, UC_SAMPLE_PERIOD, K)
+        t1 = time.time()
+        result = stream.update()
+        t2 = time.time()
+
+        t_batch += t1-t0
+        t_stream += t2-t1
+        refreshes += 1
+        for a, b in zip(batch, result):
+            assert same(a, b), 'results differ at refresh %d' % refreshes
+
+    print('%-6s %6d %9d %12.3f %12.3f %9.1f%% %12.0f' %
+          (view, B, refreshes, 1000*t_batch/refreshes, 1000*t_stream/refreshes,
+           100.0*stream.rebuilds/stream.refreshes, float(stream.scanned)/stream.refreshes))
+
+
+if __name__ == '__main__':
+    import warnings
+    warnings.simplefilter('ignore') # the initial window is flat
+
+    print('%-6s %6s %9s %12s %12s %10s %12s' % ('view', 'B', 'refreshes', 'batch [ms]',
+          'stream [ms]', 'rebuilds', 'scanned/ref'))
+    for view, B, graph_width, samples_per_refresh in VIEWS:
+        run(view, B, graph_width, samples_per_refresh, 300)
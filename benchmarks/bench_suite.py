@@ -0,0 +1,356 @@
+#!/usr/bin/python
+
+'''
+Benchmark and regression suite for the host pipeline, run headless.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Every session of the corpus is pushed through what the GUI does with each
+read, a read at a time, for each view and buffer size in CONFIGS:
+
+    readData     decode_packets(), History.push() and PulseOxEngine.push(),
+                 what Worker.storeDatasets() does with a read
+    processData  PulseOxEngine.process(), also split into its PPG, peakdet
+                 and SpO2 stages
+    paint        what Graph.paintEvent() works out with numpy before it
+                 draws anything: the history's envelope of the span shown,
+                 the polylines of both traces and where the markers go
+
+and the samples/s and the percentiles of each stage, per read or per
+refresh, are reported. Nothing needs PyQt4 or a display.
+
+The corpus is SESSIONS, SECONDS each of simulated device packets made from
+fixed seeds, plus any recordings given with --recording (see
+pulseox_replay.py). The heart rate and SpO2 of every refresh and the peak
+and trough of every beat are compared against the golden outputs in
+benchmarks/golden, and a difference beyond HR_TOLERANCE or SPO2_TOLERANCE,
+or in the beats, is flagged. --update-golden writes them again after a
+change that's meant to alter the results.
+
+Timings depend on the machine, so they're compared against a baseline
+saved on the same one with --save-baseline. A stage whose p50 or p99, or a
+session whose samples/s, is more than PERF_THRESHOLD worse, and by more
+than MIN_DIFFERENCE, is flagged. The exit status is 1 if anything was.
+Each run is timed REPEAT times and the best timings kept, and a fixed
+reference workload, analyze_window() on a synthetic window, is timed
+alongside. The baseline's timings are scaled by how much slower or faster
+the reference ran, so a machine that's busier than it was (a shared
+virtual machine can easily be half as fast from one minute to the next)
+doesn't flag everything.
+
+    python benchmarks/bench_suite.py --save-baseline before.json
+    (make the change)
+    python benchmarks/bench_suite.py --baseline before.json
+
+The golden outputs were made with numpy 2. The simulated sessions go
+through exp() and sin(), which may round differently elsewhere, so a few
+differences on another platform needn't be a regression.
+'''
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import column_stack, errstate
+from pulseox_device import SimulatedDevice
+from pulseox_engine import READ_PERIOD, PulseOxEngine
+from pulseox_history import History
+from pulseox_profile import Profiler, timer
+from pulseox_protocol import DATASET_DTYPE, UC_NUM_DATASETS, decode_packets
+from pulseox_render import envelope_points, envelope_ppgs, normalize_samples
+from pulseox_replay import read_recording
+from pulseox_signal import analyze_window
+from bench_stream import synthetic_datasets
+
+SECONDS = 300 # per simulated session, long enough to fill the largest buffer
+SESSIONS = [('steady', dict(heart_rate=75, SpO2=97, seed=1)),
+            ('noisy', dict(heart_rate=60, SpO2=93, noise=0.002, seed=2)),
+            ('motion', dict(heart_rate=95, SpO2=97, motion=4, seed=3)),
+            # lost packets, and sample numbers that wrap around part way
+            ('drops', dict(heart_rate=70, SpO2=96, drop=0.02, sample_num=2**32-20000, seed=4))]
+CONFIGS = [('short', 1500), ('long', 12000), ('long', 48000)] # view, BUFFERSIZE
+STAGES = ['readData', 'processData', 'PPG', 'peakdet', 'SpO2', 'paint']
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+HR_TOLERANCE = 0.01 # bpm
+SPO2_TOLERANCE = 0.01 # percent
+PERF_THRESHOLD = 0.25 # fraction worse
+MIN_DIFFERENCE = 20e-6 # seconds
+REPEAT = 3 # runs of each session, the best timings of which are kept
+BUCKETS_PER_DECADE = 100 # of the histograms, about 2% wide
+REFERENCE_RUNS = 20
+
+
+def simulated_session(options):
+    # host times, packets and sample period of a simulated session
+    device = SimulatedDevice(realtime=False, **options)
+    device.open()
+    reads = int(SECONDS/READ_PERIOD)
+    return ([r*READ_PERIOD for r in range(reads)], [device.read() for r in range(reads)],
+            device.sample_period)
+
+
+def recorded_session(path):
+    # host times, packets and sample period of a recording, a read's worth
+    # of datasets to each packet
+    t, n, red, ir, sample_period = read_recording(path)
+    datasets = column_stack([red, ir, n % 2**32]).astype(DATASET_DTYPE)
+    times = []
+    packets = []
+    for k in range(0, len(n), UC_NUM_DATASETS):
+        times.append(t[min(k+UC_NUM_DATASETS, len(n))-1])
+        packets.append(datasets[k:k+UC_NUM_DATASETS].tobytes())
+    return times, packets, sample_period
+
+
+class Layout():
+    # the parts of Graph's layout paintEvent() uses, less the heart images
+    def __init__(self, constants):
+        self.width = constants['GRAPH_WIDTH']
+        height = constants['GRAPH_HEIGHT']
+        self.floor_red = height/2.0
+        self.floor_ir = float(height)
+        self.sf = height/2.0
+        self.span = constants['BUFFERSIZE']
+
+
+def paint(history, beats, layout):
+    # the numpy half of Graph.paintEvent() for the live span
+    p1 = history.total
+    p0 = p1 - layout.span
+    q0 = max(p0, history.start)
+    x0 = layout.width*float(q0 - p0)/layout.span
+    width = max(layout.width - int(x0), 1)
+    x, lo, hi = history.envelope(q0, p1, width)
+    if len(x) == 0:
+        return
+    bottom, top, norm = envelope_ppgs(lo, hi)
+    x = x*float(layout.width - x0)/width + x0
+    envelope_points(x, bottom[:, 0], top[:, 0], layout.floor_red, layout.sf)
+    envelope_points(x, bottom[:, 1], top[:, 1], layout.floor_ir, layout.sf)
+    if beats is not None:
+        for marks in beats:
+            p = history.positions(marks)
+            p = p[(p >= q0) & (p < p1)]
+            normalize_samples(history.samples(p), norm)
+
+
+def run(times, packets, sample_period, view, buffersize):
+    """
+    Pushes the packets through the pipeline a read at a time and returns
+    the outputs, a dict of the refreshes and beats, and the Profiler with
+    the stages timed, with 'total' for the whole run.
+    """
+
+    profiler = Profiler(buckets_per_decade=BUCKETS_PER_DECADE)
+    engine = PulseOxEngine(view, BUFFERSIZE=buffersize, sample_period=sample_period,
+                           profiler=profiler)
+    history = History(len(packets)*UC_NUM_DATASETS)
+    layout = Layout(engine.constants)
+    refreshes = []
+    beats = []
+    # the window starts out flat so the first refreshes divide 0 by 0
+    with errstate(divide='ignore', invalid='ignore'):
+        start = timer()
+        for r in range(len(packets)):
+            t0 = timer()
+            datasets = decode_packets(packets[r])
+            history.push(datasets)
+            due = engine.push(datasets)
+            t1 = timer()
+            profiler.add('readData', t1-t0)
+            if not due:
+                continue
+
+            engine.process(t=times[r])
+            t2 = timer()
+            profiler.add('processData', t2-t1)
+            paint(history, engine.beats, layout)
+            profiler.add('paint', timer()-t2)
+
+            refreshes.append([int(engine.window()[0][-1]), _round(engine.heartrate),
+                              _round(engine.SpO2)])
+            beats += [[b.n, b.trough, int(b.accepted)] for b in engine.new_beats]
+        profiler.add('total', timer()-start)
+    return dict(refreshes=refreshes, beats=beats), profiler
+
+
+def _round(value):
+    # JSON friendly, None while unknown
+    return None if value is None else round(float(value), 4)
+
+
+def compare_golden(golden, outputs):
+    """
+    Returns a list of the differences between outputs and golden.
+    """
+
+    problems = []
+    a, b = golden['refreshes'], outputs['refreshes']
+    if len(a) != len(b):
+        problems.append('%d refreshes instead of %d' % (len(b), len(a)))
+    for k, (name, tolerance) in enumerate([('HR', HR_TOLERANCE), ('SpO2', SPO2_TOLERANCE)]):
+        unknown = 0
+        worst = 0.0
+        for ra, rb in zip(a, b):
+            va, vb = ra[k+1], rb[k+1]
+            if (va is None) != (vb is None):
+                unknown += 1
+            elif va is not None:
+                worst = max(worst, abs(va - vb))
+        if unknown:
+            problems.append('%s known in %d refreshes it was unknown in or vice versa' %
+                            (name, unknown))
+        if worst > tolerance:
+            problems.append('%s off by up to %.4f' % (name, worst))
+    before = set([tuple(beat) for beat in golden['beats']])
+    after = set([tuple(beat) for beat in outputs['beats']])
+    if before != after:
+        problems.append('%d beats missing, %d beats not in the golden output' %
+                        (len(before - after), len(after - before)))
+    return problems
+
+
+def reference_time(runs=REFERENCE_RUNS):
+    # the best time of analyze_window() on a fixed short view window
+    c = PulseOxEngine('short').constants
+    datasets = synthetic_datasets(c['BUFFERSIZE'])
+    n, Ired, Iir = datasets[:, 2], datasets[:, 0], datasets[:, 1]
+    best = None
+    for r in range(runs):
+        t0 = timer()
+        analyze_window(n, Ired, Iir, c['GRAPH_WIDTH'], c['EDGE_THRESHOLD'], 0.006, -0.024542)
+        t = timer()-t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def timings(profilers, samples, reference):
+    # what's kept in a baseline: samples/s and the p50 and p99 of each
+    # stage, the best of the runs timed by profilers
+    stages = {}
+    for stage in STAGES:
+        for profiler in profilers:
+            if stage in profiler.stages and profiler.stages[stage].n > 0:
+                n, mean, mx, (p50, p99) = profiler.summary(stage, (50, 99))
+                best = stages.get(stage, [p50, p99])
+                stages[stage] = [min(p50, best[0]), min(p99, best[1])]
+    total = min([profiler.stages['total'].total for profiler in profilers])
+    return dict(samples_per_s=samples/total if total > 0 else None, stages=stages,
+                reference=reference)
+
+
+def compare_timings(base, now):
+    """
+    Returns a list of the timings in now that are worse than in base.
+    """
+
+    problems = []
+    # how much slower the machine is than it was
+    speed = now['reference']/base['reference']
+    if base['samples_per_s'] and \
+       now['samples_per_s'] < (1 - PERF_THRESHOLD)*base['samples_per_s']/speed:
+        problems.append('%.0f samples/s instead of %.0f' %
+                        (now['samples_per_s'], base['samples_per_s']/speed))
+    for stage in STAGES:
+        if stage not in base['stages'] or stage not in now['stages']:
+            continue
+        for name, old, new in zip(['p50', 'p99'], base['stages'][stage], now['stages'][stage]):
+            old *= speed
+            if new > (1 + PERF_THRESHOLD)*old and new - old > MIN_DIFFERENCE:
+                problems.append('%s %s %.3f ms instead of %.3f ms' % (stage, name, 1e3*new, 1e3*old))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the host pipeline on the corpus.')
+    parser.add_argument('--recording', action='append', default=[],
+                        help='add a recording to the corpus, may be given more than once')
+    parser.add_argument('--golden', default=GOLDEN, help='directory of the golden outputs')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='write the golden outputs instead of comparing against them')
+    parser.add_argument('--baseline', help='timings saved by --save-baseline to compare against')
+    parser.add_argument('--save-baseline', metavar='PATH', help='save the timings')
+    parser.add_argument('--session', action='append',
+                        help='only run this session, may be given more than once')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='runs of each session to keep the best timings of')
+    args = parser.parse_args(argv)
+
+    corpus = [(name, lambda options=options: simulated_session(options))
+              for name, options in SESSIONS]
+    corpus += [('rec_'+os.path.splitext(os.path.basename(path))[0],
+                lambda path=path: recorded_session(path)) for path in args.recording]
+    if args.session:
+        corpus = [(name, load) for name, load in corpus if name in args.session]
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as fi:
+            baseline = json.load(fi)
+    if args.update_golden and not os.path.isdir(args.golden):
+        os.makedirs(args.golden)
+
+    results = {}
+    flagged = []
+    print('%-8s %-6s %6s %9s ' % ('session', 'view', 'buffer', 'samples/s') +
+          ' '.join(['%15s' % stage for stage in STAGES]))
+    print('%-33s' % '' + ' '.join(['%15s' % 'p50/p99 [ms]' for stage in STAGES]))
+    for name, load in corpus:
+        times, packets, sample_period = load()
+        samples = len(packets)*UC_NUM_DATASETS
+        for view, buffersize in CONFIGS:
+            key = '%s_%s_%d' % (name, view, buffersize)
+            profilers = []
+            problems = []
+            reference = None
+            for k in range(max(args.repeat, 1)):
+                again, profiler = run(times, packets, sample_period, view, buffersize)
+                profilers.append(profiler)
+                if k == 0:
+                    outputs = again
+                elif again != outputs:
+                    problems.append('outputs differ between runs')
+                t = reference_time()
+                reference = t if reference is None else min(reference, t)
+            now = timings(profilers, samples, reference)
+            results[key] = now
+            fields = []
+            for stage in STAGES:
+                if stage in now['stages']:
+                    fields.append('%15s' % ('%.3f/%.3f' % tuple([1e3*v for v in now['stages'][stage]])))
+                else:
+                    fields.append('%15s' % '--')
+            print('%-8s %-6s %6d %9.0f ' % (name, view, buffersize, now['samples_per_s']) +
+                  ' '.join(fields))
+
+            path = os.path.join(args.golden, key+'.json')
+            if args.update_golden:
+                with open(path, 'w') as fo:
+                    json.dump(outputs, fo, separators=(',', ':'))
+            elif os.path.exists(path):
+                with open(path) as fi:
+                    problems += ['golden: '+p for p in compare_golden(json.load(fi), outputs)]
+            else:
+                problems.append('golden: no %s' % path)
+            if key in baseline:
+                problems += ['timing: '+p for p in compare_timings(baseline[key], now)]
+            for p in problems:
+                print('    %s' % p)
+            flagged += [(key, p) for p in problems]
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as fo:
+            json.dump(results, fo, indent=1, sort_keys=True)
+
+    print('')
+    if flagged:
+        print('%d regressions flagged in %d runs' % (len(flagged), len(results)))
+        return 1
+    print('%d runs, nothing flagged' % len(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+'''
+Writes a day of trends to a TrendWriter and times range queries of the raw
+tables and the rollups, against parsing the same refreshes from a text log.
+Author: Jonathan Thomson
+Released Under the MIT License
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from numpy import arange, cumsum, loadtxt, median, savetxt, column_stack
+from numpy.random import RandomState
+from pulseox_beats import Beat
+from pulseox_trend import TrendWriter, choose_table, query
+
+HOURS = 24
+REFRESH_PERIOD = 0.27 # seconds, short view
+T0 = 1400000000.0 - 1400000000.0 % 86400 + 3600 # 01:00 UTC
+
+
+def synthetic_day(writer):
+    r = RandomState(0)
+    num = int(HOURS*3600/REFRESH_PERIOD)
+    t = T0 + REFRESH_PERIOD*arange(num)
+    hr = 65 + cumsum(0.05*r.randn(num)).clip(-20, 40)
+    SpO2 = 97 + 0.5*r.randn(num)
+    n = (t - T0)/0.006
+    n = n.astype('int64')
+    for k in range(num):
+        writer.add_refresh(t[k], n[k], hr[k], SpO2[k])
+        if k % 3 == 0:
+            # two beats new in the window, every tenth time the first
+            # rejected by its quality score
+            rr = 60/hr[k]
+            accepted = k % 30 != 0
+            writer.add_beats([Beat(n[k] - int(REFRESH_PERIOD/0.006), 0, t[k] - REFRESH_PERIOD, rr,
+                                   None, None, None, SpO2[k] - 1 if accepted else None, None,
+                                   accepted),
+                              Beat(n[k], 0, t[k], rr, None, None, None, SpO2[k], None, True)])
+    return t, hr, SpO2
+
+
+def timed(f, repeat=20):
+    t0 = time.time()
+    for k in range(repeat):
+        result = f()
+    return result, 1e3*(time.time() - t0)/repeat
+
+
+if __name__ == '__main__':
+    root = tempfile.mkdtemp()
+    try:
+        writer = TrendWriter(os.path.join(root, 'store'))
+        t0 = time.time()
+        t, hr, SpO2 = synthetic_day(writer)
+        writer.close()
+        print('%d refreshes written in %.1f s' % (len(t), time.time() - t0))
+
+        store = os.path.join(root, 'store')
+        t1 = T0 + 3600*HOURS
+        for table, start in [('refresh', T0), ('refresh', t1 - 3600), ('beat', T0),
+                             ('1s', T0), ('1m', T0), ('1h', T0),
+                             (choose_table(T0, t1), T0)]:
+            rows, ms = timed(lambda: query(store, table, start, t1))
+            print('%-8s %5.1f h %8d rows %8.2f ms' % (table, (t1 - start)/3600, len(rows['t']), ms))
+
+        rows = query(store, '1m', T0, t1)
+        k = 90
+        expected = median(hr[(t >= rows['t'][k]) & (t < rows['t'][k] + 60)])
+        assert abs(rows['heartrate_median'][k] - expected) < 1e-3, 'rollup median'
+
+        # each beat row has its own beat's heart rate and SpO2
+        rows = query(store, 'beat', T0, t1)
+        k = arange(0, len(t), 3)
+        assert len(rows['t']) == 2*len(k) - len(k[k % 30 == 0]), 'beats appended'
+        assert abs(rows['SpO2'][-1] - SpO2[k[-1]]) < 1e-3, 'beat SpO2'
+        assert abs(rows['heartrate'][-1] - hr[k[-1]]) < 1e-3, 'beat heart rate'
+
+        text = os.path.join(root, 'SpO2data.txt')
+        savetxt(text, column_stack([t, hr, SpO2]))
+        rows, ms = timed(lambda: loadtxt(text), 1)
+        print('text log %5.1f h %8d rows %8.2f ms' % (HOURS, len(rows), ms))
+    finally:
+        shutil.rmtree(root)
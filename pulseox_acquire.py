@@ -0,0 +1,203 @@
+'''
+Reads packets from a device on a fixed schedule in a thread of its own.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+The reader sleeps until each read is due instead of polling the clock, so an
+idle oximeter costs next to no CPU. Deadlines are multiples of the period
+from the first read, so they don't drift however late an individual read
+is. Packets are handed to the processing side through a queue so a slow
+processData() never delays the next read.
+
+    period, late = read_timing(device)
+    reader = Reader(device, period, late=late)
+    reader.start()
+    while running:
+        for read_t0, data in reader.get(timeout=0.5):
+            engine.push(decode_packets(data))
+    reader.stop()
+'''
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pulseox_device import V2_BANKS
+from pulseox_engine import READ_PERIOD, UC_SAMPLE_PERIOD
+from pulseox_profile import timer
+from pulseox_protocol import PROTOCOL_V2, UC_NUM_DATASETS, V2_MIN_DATASETS, V2_RING_SIZE
+
+QUEUE_SIZE = 100 # reads, 3 seconds at the default period
+
+
+def read_timing(device):
+    """
+    Returns how often to read device once it's open, and the interval
+    between reads beyond which datasets are lost, for its protocol and
+    sample period.
+    """
+
+    if device.protocol == PROTOCOL_V2:
+        # the firmware queues the datasets and only sends a packet once
+        # V2_MIN_DATASETS are waiting
+        queued = V2_RING_SIZE + V2_BANKS*V2_MIN_DATASETS
+        return max(READ_PERIOD, V2_MIN_DATASETS*device.sample_period), queued*device.sample_period
+    # a packet holds the newest UC_NUM_DATASETS
+    period = UC_NUM_DATASETS*device.sample_period
+    return period, period + device.sample_period
+
+
+class Deadlines():
+    """
+    A drift-free schedule of deadlines period seconds apart.
+    """
+
+    def __init__(self, period, start=None):
+        self.period = period
+        self.next = time.time() if start is None else start
+        self.missed = 0
+
+    def wait(self):
+        """
+        Sleeps until the next deadline and schedules the one after it.
+        Deadlines that already passed are skipped rather than run back to
+        back. Returns how many were skipped.
+        """
+
+        now = time.time()
+        if now < self.next:
+            time.sleep(self.next - now)
+            missed = 0
+        else:
+            missed = int((now - self.next)/self.period)
+        self.next += (missed + 1)*self.period
+        self.missed += missed
+        return missed
+
+
+class Reader(threading.Thread):
+    """
+    Reads device every period seconds and queues (host time, packet) pairs.
+
+    If period is None the reads follow each other immediately and are paced
+    by device.read() blocking until the next packet arrives, like
+    interruptRead() does on the IN endpoint. If the queue is full because
+    the processing side has fallen behind the oldest read is discarded.
+
+    Any exception raised by device.read() stops the reader. It's kept in
+    error and get() raises it.
+
+    If notify is given it's called from the reader thread every time a read
+    is queued, and once more when the reader stops, for consumers that wait
+    on many readers at once.
+
+    A read more than late seconds after the one before is counted as late
+    in profiler, by default one UC_SAMPLE_PERIOD more than the period. See
+    read_timing().
+    """
+
+    def __init__(self, device, period=READ_PERIOD, profiler=None, maxsize=QUEUE_SIZE,
+                 notify=None, late=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.device = device
+        self.period = period
+        self.profiler = profiler
+        self.queue = queue.Queue(maxsize)
+        self.running = True # cleared by stop()
+        self.error = None
+        self.notify = notify
+        self.late = late
+
+        self.reads = 0
+        self.dropped = 0 # reads discarded because the queue was full
+
+    def run(self):
+        deadlines = None if self.period is None else Deadlines(self.period)
+        profiler = self.profiler
+        budget = READ_PERIOD if self.period is None else self.period
+        late = budget + UC_SAMPLE_PERIOD if self.late is None else self.late
+        last_t0 = None
+        try:
+            while self.running:
+                if deadlines is not None:
+                    missed = deadlines.wait()
+                    if missed and profiler is not None:
+                        profiler.count('missed deadlines', missed)
+                    if not self.running:
+                        break
+
+                read_t0 = time.time()
+                if profiler is not None:
+                    if last_t0 is not None:
+                        interval = read_t0 - last_t0
+                        profiler.add('read interval', interval)
+                        # the oldest dataset of the last read has been overwritten
+                        if (interval > late):
+                            profiler.count('late reads')
+                    t0 = timer()
+                last_t0 = read_t0
+
+                data = self.device.read()
+
+                if profiler is not None:
+                    profiler.add('read', timer()-t0)
+                self.reads += 1
+                self._put((read_t0, data))
+        except Exception as e:
+            self.error = e
+        self.running = False
+        self._put(None) # wakes get()
+
+    def _put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    if self.profiler is not None:
+                        self.profiler.count('dropped reads')
+                except queue.Empty:
+                    pass
+        if self.notify is not None:
+            self.notify()
+
+    def get(self, timeout=None):
+        """
+        Blocks until at least one read is queued, or timeout seconds have
+        passed, and returns every queued read oldest first. Returns an
+        empty list on timeout or once the reader has stopped.
+        """
+
+        try:
+            items = [self.queue.get(True, timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if None in items:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            items = [item for item in items if item is not None]
+        return items
+
+    def stop(self):
+        """
+        Stops reading and waits for the read in progress to finish.
+        """
+
+        self.running = False
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,204 @@
+'''
+A stream of the heart beats found in the photoplethysmograms, each reported
+once, and heart rate variability over time windows.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Every refresh finds the peaks and troughs of the whole window again, so the
+same beat turns up in refresh after refresh until it leaves the window. A
+BeatTracker remembers the newest beat it has reported and turns each
+refresh's beats into Beats for only the ones after it. A beat is reported
+once its trough has been found, so a peak is never reported before it's
+confirmed. If the tracker has a pulseox_quality.BeatQuality each beat is
+scored then, and the R and SpO2 of the beats it rejects aren't worked out.
+
+HRV keeps the intervals between beats in pulseox_stats Windows and gives
+the usual time domain measures over each of them:
+
+    SDNN    standard deviation of the intervals
+    RMSSD   root mean square of the differences between successive intervals
+    pNN50   percentage of successive intervals more than 50 ms apart
+
+Only normal-to-normal (NN) intervals are counted. An interval ending in a
+rejected beat, outside RR_RANGE, or more than MAX_RR_CHANGE off the one
+before it is most likely a missed, extra or corrupted beat, and it and the
+differences either side of it are left out. Adding a beat costs the same
+whatever the length of the windows.
+
+    tracker = BeatTracker(UC_SAMPLE_PERIOD, K)
+    hrv = HRV(dict(display=10000, trend=50000))
+    for beat in tracker.update(n, Ired, Iir, systole, diastole, time.time()):
+        hrv.add(beat)
+    hrv.rmssd('trend')
+'''
+
+from collections import namedtuple
+from math import sqrt
+
+from numpy import asarray, int64, searchsorted
+
+from pulseox_signal import SPO2_CURVE, beat_ratios, ratio_SpO2
+from pulseox_stats import WindowedStats
+
+RR_RANGE = (0.2, 2.0) # seconds, 300 to 30 bpm
+MAX_RR_CHANGE = 0.2 # fraction of the interval before
+NN50 = 0.05 # seconds
+
+# n          sample number of the peak of the PPG (systole)
+# trough     sample number of the trough that follows it (diastole)
+# t          host time of the peak [s]
+# rr         time since the peak of the beat before [s], None for the first
+# amplitude_red, amplitude_ir
+#            -log of the intensity at the peak over that at the trough
+# R          amplitude_red/amplitude_ir
+# SpO2       from R, even if it isn't plausible [%]
+# quality    signal quality score from 0 to 1, None if it wasn't scored
+# accepted   False if the score rejected it, and then the amplitudes, R
+#            and SpO2 are None
+Beat = namedtuple('Beat', 'n trough t rr amplitude_red amplitude_ir R SpO2 quality accepted')
+
+
+class BeatTracker():
+    """
+    Turns the peaks and troughs of each refresh's window into Beats for the
+    beats that haven't been reported before, scored by quality if it's a
+    BeatQuality. K and curve are the SpO2 calibration, see
+    pulseox_signal.ratio_SpO2().
+    """
+
+    def __init__(self, sample_period, K, quality=None, curve=SPO2_CURVE):
+        self.sample_period = sample_period
+        self.K = K
+        self.curve = curve
+        self.quality = quality
+        self.reset()
+
+    def reset(self):
+        self.last = None # sample number of the newest beat reported
+        if self.quality is not None:
+            self.quality.reset()
+
+    def update(self, n, Ired, Iir, systole, diastole, t):
+        """
+        Returns a list of the new Beats in a window with sample numbers n
+        and intensities Ired and Iir, whose peaks and troughs analyze_beats()
+        found at the indices systole and diastole. t is the host time of the
+        newest sample of the window.
+        """
+
+        if systole == 'NA' or diastole == 'NA':
+            return []
+        # only the peaks with a trough after them
+        peaks = asarray(systole[:len(diastole)], dtype=int64)
+        numbers = n[peaks]
+        first = 0 if self.last is None else int(searchsorted(numbers, self.last, 'right'))
+
+        beats = []
+        newest = int(n[-1])
+        for k in range(first, len(peaks)):
+            peak = int(peaks[k])
+            if peak < 2:
+                # the samples around it are cut off by the window
+                continue
+            trough = diastole[k]
+            if self.quality is None:
+                score = None
+                accepted = True
+            else:
+                score = self.quality.assess(Ired[peak:trough+1], Iir[peak:trough+1])
+                accepted = score >= self.quality.threshold
+            if accepted:
+                Rred, Rir = beat_ratios(peak, trough, Ired, Iir)
+                R = Rred/Rir
+                SpO2 = ratio_SpO2(R, self.K, self.curve)
+            else:
+                Rred = Rir = R = SpO2 = None
+            number = int(numbers[k])
+            if self.last is None:
+                rr = None
+            else:
+                rr = (number - self.last)*self.sample_period
+            beats.append(Beat(number, int(n[trough]), t - (newest - number)*self.sample_period,
+                              rr, Rred, Rir, R, SpO2, score, accepted))
+            self.last = number
+        return beats
+
+
+class HRV():
+    """
+    SDNN, RMSSD and pNN50 of the beats added over windows of different
+    spans. spans is a dict of the span of each window in sample numbers
+    keyed by its name, like WindowedStats'. Each measure is None until
+    there are enough intervals in the window.
+    """
+
+    def __init__(self, spans):
+        self.rr = WindowedStats(spans, RR_RANGE[0], RR_RANGE[1])
+        # absolute differences between successive NN intervals, and whether
+        # each is over NN50
+        self.diff = WindowedStats(spans, 0, RR_RANGE[1] - RR_RANGE[0])
+        self.nn50 = WindowedStats(spans, 0, 1, bins=2)
+        self.clear()
+
+    def clear(self):
+        self.rr.clear()
+        self.diff.clear()
+        self.nn50.clear()
+        self.last_rr = None # the interval before
+        self.last_nn = None # the same if it was NN
+        self.beats = 0
+        self.artifacts = 0 # intervals that weren't NN
+
+    def add(self, beat):
+        self.expire(beat.n)
+        self.beats += 1
+        rr = beat.rr
+        if rr is None:
+            # the first beat, or the first after a reset
+            self.last_rr = self.last_nn = None
+            return
+        nn = beat.accepted and RR_RANGE[0] <= rr <= RR_RANGE[1] and \
+             (self.last_rr is None or abs(rr - self.last_rr) <= MAX_RR_CHANGE*self.last_rr)
+        if nn:
+            self.rr.add(beat.n, rr)
+            if self.last_nn is not None:
+                d = abs(rr - self.last_nn)
+                self.diff.add(beat.n, d)
+                self.nn50.add(beat.n, 1 if d > NN50 else 0)
+        else:
+            self.artifacts += 1
+        self.last_rr = rr
+        self.last_nn = rr if nn else None
+
+    def expire(self, n):
+        """
+        Drops the intervals that have left the windows by sample number n.
+        """
+
+        self.rr.expire(n)
+        self.diff.expire(n)
+        self.nn50.expire(n)
+
+    def mean_rr(self, name):
+        return self.rr[name].mean()
+
+    def sdnn(self, name):
+        # the sample standard deviation
+        window = self.rr[name]
+        num = len(window)
+        if num < 2:
+            return None
+        return sqrt(window.variance()*num/(num - 1))
+
+    def rmssd(self, name):
+        window = self.diff[name]
+        if len(window) == 0:
+            return None
+        m = window.mean()
+        return sqrt(window.variance() + m*m)
+
+    def pnn50(self, name):
+        window = self.nn50[name]
+        if len(window) == 0:
+            return None
+        return 100*window.mean()
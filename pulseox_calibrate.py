@@ -0,0 +1,386 @@
+#!/usr/bin/python
+
+'''
+Fits the SpO2 calibration of each pulse oximeter to the SpO2 a reference
+oximeter read, and writes it to a profile for the device that the programs
+load instead of pulseox_engine.K.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+The sessions file lists the recordings made with each device (see
+pulseox_replay.py) and the reference SpO2 during each, one per line:
+
+    # device    recording               reference
+    unit1       unit1/rawdata.cap       97
+    unit1       unit1/desat.cap         unit1/desat_reference.txt
+    unit2       unit2/rawdata.txt       98.5
+
+The reference is either the SpO2 [%] for the whole recording or a file of
+host time and SpO2 lines, which is interpolated at the time of every beat.
+Beats more than REFERENCE_GAP from a reference reading are left out.
+Relative paths are relative to the sessions file.
+
+Every recording is replayed once through a PulseOxEngine and the ratio R of
+each beat the quality stage accepts is cached in a .beats.npz file next to
+it, or in --cache, until the recording changes. R doesn't depend on the
+calibration, so fitting again only costs the fit.
+
+The SpO2 of a beat is 100*(a - b*(R+K))/(c + d*(R+K)). K is fitted by
+working out the error of every beat for a grid of candidates K_STEP apart
+across K_RANGE at once, with the grid split across a process pool, and
+then for a finer grid around the best of them. With --curve a, b and d are
+then fitted by nonlinear least squares as well, c being kept as it is
+since scaling all four changes nothing. Without references over a range
+of SpO2 of at least CURVE_SPREAD only K is fitted. The error is a squared error that
+stops growing at RESIDUAL_LIMIT so the odd beat that's far off doesn't
+sway the fit.
+
+    python pulseox_calibrate.py -j 8 -o calibration sessions.txt
+
+writes calibration/unit1.json and calibration/unit2.json, which are loaded
+with
+
+    profile = load_profile(profile_path('calibration', 'unit1'))
+    engine = PulseOxEngine(K=profile['K'], curve=profile['curve'])
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from numpy import abs as np_abs, arange, array, array_split, column_stack, concatenate, \
+                  errstate, float64, full, int64, interp, isnan, linspace, load, loadtxt, \
+                  minimum, nan, savez, searchsorted, sqrt, zeros
+from numpy.linalg import lstsq
+
+from pulseox_engine import K, UC_SAMPLE_PERIOD, PulseOxEngine
+from pulseox_replay import read_recording
+from pulseox_signal import SPO2_CURVE
+
+K_RANGE = (-0.3, 0.3)
+K_STEP = 0.001
+K_REFINE = 100 # steps of the finer grid per step of the coarse one
+RESIDUAL_LIMIT = 5.0 # percent SpO2
+REFERENCE_GAP = 10.0 # seconds
+CURVE_SPREAD = 5.0 # percent SpO2
+CURVE_ITERATIONS = 20
+STEP_HALVINGS = 10
+MIN_BEATS = 30
+BLOCK = 1000000 # candidates times beats worked out at a time
+
+
+def read_sessions(path):
+    """
+    Returns a list of (device, recording, reference) read from a sessions
+    file, the reference a float or the path of a reference file.
+    """
+
+    base = os.path.dirname(path)
+    sessions = []
+    with open(path) as fi:
+        for line in fi:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) == 0:
+                continue
+            if len(fields) != 3:
+                raise ValueError('%s: expected device, recording and reference: %r' %
+                                 (path, line.strip()))
+            device, recording, reference = fields
+            try:
+                reference = float(reference)
+            except ValueError:
+                reference = os.path.join(base, reference)
+            sessions.append((device, os.path.join(base, recording), reference))
+    return sessions
+
+
+def reference_at(reference, t):
+    """
+    Returns the reference SpO2 at the host times t, nan where there is none.
+    reference is a constant SpO2 or the path of a file of (t, SpO2) lines.
+    """
+
+    if not isinstance(reference, str):
+        return full(len(t), float(reference))
+    data = loadtxt(reference, ndmin=2)
+    tr, S = data[:, 0], data[:, 1]
+    if len(tr) == 0:
+        return full(len(t), nan)
+    SpO2 = interp(t, tr, S)
+    # time to the nearest reading
+    k = searchsorted(tr, t)
+    before = np_abs(t - tr[minimum(k, len(tr)) - 1])
+    after = np_abs(tr[minimum(k, len(tr) - 1)] - t)
+    SpO2[minimum(before, after) > REFERENCE_GAP] = nan
+    return SpO2
+
+
+def extract_beats(t, n, red, ir, sample_period=UC_SAMPLE_PERIOD, view='short'):
+    """
+    Replays a recording like pulseox_replay.replay() and returns a dict of
+    arrays n, t, R and quality of the beats accepted.
+    """
+
+    engine = PulseOxEngine(view, sample_period=sample_period)
+    datasets = column_stack([red, ir, n]).astype(int64)
+    beats = []
+    k = 0
+    with errstate(divide='ignore', invalid='ignore'):
+        while k < len(datasets):
+            num = engine.until_refresh()
+            due = engine.push(datasets[k:k+num])
+            k += num
+            if due:
+                engine.process(t=t[min(k, len(datasets))-1])
+                beats += [b for b in engine.new_beats if b.accepted]
+    return dict(n=array([b.n for b in beats], dtype=int64),
+                t=array([b.t for b in beats], dtype=float64),
+                R=array([b.R for b in beats], dtype=float64),
+                quality=array([b.quality for b in beats], dtype=float64))
+
+
+def beats_path(path, cache=None):
+    # where the beats of a recording are cached
+    if cache is None:
+        return os.path.splitext(path)[0]+'.beats.npz'
+    name = os.path.splitext(os.path.abspath(path).strip(os.sep).replace(os.sep, '_'))[0]
+    return os.path.join(cache, name+'.beats.npz')
+
+
+def cached_beats(path, cache=None, view='short'):
+    """
+    Returns extract_beats() of the recording at path, from its .beats.npz
+    file if that was written for the recording as it is now, and whether
+    it was.
+    """
+
+    st = os.stat(path)
+    source = array([st.st_size, st.st_mtime], dtype=float64)
+    cpath = beats_path(path, cache)
+    if os.path.exists(cpath):
+        data = load(cpath)
+        if (data['source'] == source).all() and str(data['view']) == view:
+            return dict([(name, data[name]) for name in ('n', 't', 'R', 'quality')]), True
+
+    beats = extract_beats(*read_recording(path), view=view)
+    # written under another name first so a reader never sees half of it
+    with open(cpath+'.tmp', 'wb') as fo:
+        savez(fo, source=source, view=array(view), **beats)
+    os.rename(cpath+'.tmp', cpath)
+    return beats, False
+
+
+def _extract(args):
+    # pool worker: the beats of one recording
+    path, cache, view = args
+    t0 = time.time()
+    beats, cached = cached_beats(path, cache, view)
+    return path, beats, cached, time.time()-t0
+
+
+def curve_errors(R, S, Ks, curve=SPO2_CURVE):
+    """
+    Returns the mean over the beats of the squared SpO2 error, capped at
+    RESIDUAL_LIMIT, for each calibration constant in Ks. R are the ratios
+    of the beats and S their reference SpO2s.
+    """
+
+    a, b, c, d = curve
+    Ks = array(Ks, dtype=float64)
+    total = zeros(len(Ks))
+    step = max(BLOCK//max(len(Ks), 1), 1)
+    for i in range(0, len(R), step):
+        x = R[None, i:i+step] + Ks[:, None]
+        e = 100*(a - b*x)/(c + d*x) - S[None, i:i+step]
+        total += minimum(e*e, RESIDUAL_LIMIT**2).sum(axis=1)
+    return total/max(len(R), 1)
+
+
+def _grid(args):
+    # pool worker: curve_errors() for a piece of the grid
+    device, R, S, Ks, curve = args
+    return device, Ks, curve_errors(R, S, Ks, curve)
+
+
+def fit_curve(x, S, curve=SPO2_CURVE, iterations=CURVE_ITERATIONS):
+    """
+    Returns the a, b, c, d that fit the SpO2 100*(a - b*x)/(c + d*x) to S,
+    starting from curve and leaving c as it is. Each iteration is a Gauss-
+    Newton step over the beats within RESIDUAL_LIMIT of the curve before,
+    halved until it lowers the capped error without putting the curve's
+    pole among the x, so the fit is never worse than curve.
+    """
+
+    a, b, c, d = curve
+    e = 100*(a - b*x)/(c + d*x) - S
+    error = minimum(e*e, RESIDUAL_LIMIT**2).mean()
+    for i in range(iterations):
+        keep = np_abs(e) <= RESIDUAL_LIMIT
+        if keep.sum() < 3:
+            break
+        xk, qk = x[keep], c + d*x[keep]
+        # derivatives of the SpO2 by a, b and d
+        J = column_stack([100/qk, -100*xk/qk, -(e[keep] + S[keep])*xk/qk])
+        step = lstsq(J, -e[keep], rcond=-1)[0]
+        for halving in range(STEP_HALVINGS):
+            na, nb, nd = a + step[0], b + step[1], d + step[2]
+            q = c + nd*x
+            if (q > 0).all():
+                ne = 100*(na - nb*x)/q - S
+                nerror = minimum(ne*ne, RESIDUAL_LIMIT**2).mean()
+                if nerror < error:
+                    break
+            step = step/2
+        else:
+            break
+        a, b, d, e, error = na, nb, nd, ne, nerror
+    return float(a), float(b), float(c), float(d)
+
+
+def errors(R, S, K, curve):
+    # the SpO2 error of every beat
+    a, b, c, d = curve
+    x = R + K
+    return 100*(a - b*x)/(c + d*x) - S
+
+
+def summary(e):
+    # RMS error and bias of the beats within RESIDUAL_LIMIT, and how many
+    # weren't
+    inside = np_abs(e) <= RESIDUAL_LIMIT
+    if inside.sum() == 0:
+        return nan, nan, len(e)
+    return float(sqrt((e[inside]**2).mean())), float(e[inside].mean()), int((~inside).sum())
+
+
+def profile_path(directory, device):
+    """
+    Returns the path of the profile of device in directory.
+    """
+
+    return os.path.join(directory, device.replace(os.sep, '_').replace(':', '_')+'.json')
+
+
+def load_profile(path):
+    """
+    Returns the profile written to path as a dict with the calibration
+    constant 'K' and the curve coefficients 'curve', which default to
+    pulseox_engine.K and pulseox_signal.SPO2_CURVE, and whatever else was
+    written with them.
+    """
+
+    with open(path) as fi:
+        profile = json.load(fi)
+    profile['K'] = float(profile.get('K', K))
+    profile['curve'] = tuple([float(v) for v in profile.get('curve', SPO2_CURVE)])
+    return profile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit the SpO2 calibration of pulse oximeters.')
+    parser.add_argument('sessions', help='file of device, recording and reference lines')
+    parser.add_argument('-o', '--outdir', default='calibration', help='directory for the profiles')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--cache', help='directory for the cached beats instead of '
+                                        'next to the recordings')
+    parser.add_argument('--view', choices=['short', 'long'], default='short')
+    parser.add_argument('--curve', action='store_true',
+                        help='fit the coefficients of the curve as well as K')
+    args = parser.parse_args(argv)
+
+    for directory in (args.outdir, args.cache):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    sessions = read_sessions(args.sessions)
+    recordings = sorted(set([recording for device, recording, reference in sessions]))
+
+    t0 = time.time()
+    if args.jobs > 1 and len(recordings) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        imap = pool.imap_unordered
+    else:
+        pool = None
+        imap = map
+
+    beats = {}
+    for path, found, cached, elapsed in imap(_extract, [(path, args.cache, args.view)
+                                                        for path in recordings]):
+        beats[path] = found
+        print('%s: %d beats %s in %.2f s' %
+              (path, len(found['R']), 'cached' if cached else 'extracted', elapsed))
+    t1 = time.time()
+
+    # the ratio and reference of every beat of each device
+    pairs = {}
+    for device, recording, reference in sessions:
+        found = beats[recording]
+        S = reference_at(reference, found['t'])
+        known = ~isnan(S)
+        R_list, S_list, names = pairs.setdefault(device, ([], [], []))
+        R_list.append(found['R'][known])
+        S_list.append(S[known])
+        names.append(recording)
+    devices = []
+    for device in sorted(pairs):
+        R_list, S_list, names = pairs[device]
+        R = concatenate(R_list)
+        S = concatenate(S_list)
+        if len(R) < MIN_BEATS:
+            print('%s: only %d beats with a reference, not calibrated' % (device, len(R)))
+            continue
+        devices.append((device, R, S, names))
+
+    # the coarse grid of every device, spread over the pool
+    grid = linspace(K_RANGE[0], K_RANGE[1], int(round((K_RANGE[1]-K_RANGE[0])/K_STEP))+1)
+    pieces = max(args.jobs, 1)
+    jobs = [(device, R, S, Ks, SPO2_CURVE) for device, R, S, names in devices
+            for Ks in array_split(grid, pieces)]
+    coarse = {}
+    if pool is None and args.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+    for device, Ks, e in (map(_grid, jobs) if pool is None else pool.imap_unordered(_grid, jobs)):
+        best = coarse.get(device)
+        k = int(e.argmin())
+        if best is None or e[k] < best[1]:
+            coarse[device] = (Ks[k], e[k])
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print('%-12s %6s %10s %12s %12s %9s' % ('device', 'beats', 'K', 'rms before', 'rms after',
+                                            'outliers'))
+    for device, R, S, names in devices:
+        Kc = coarse[device][0]
+        fine = Kc + K_STEP*arange(-K_REFINE, K_REFINE+1)/float(K_REFINE)
+        Kf = float(fine[curve_errors(R, S, fine).argmin()])
+
+        curve = SPO2_CURVE
+        if args.curve:
+            if S.max() - S.min() >= CURVE_SPREAD:
+                curve = fit_curve(R + Kf, S)
+            else:
+                print('%s: references span less than %.0f%% SpO2, curve not fitted' %
+                      (device, CURVE_SPREAD))
+
+        rms0, bias0, outliers0 = summary(errors(R, S, K, SPO2_CURVE))
+        rms, bias, outliers = summary(errors(R, S, Kf, curve))
+        profile = dict(device=device, K=Kf, curve=list(curve), beats=len(R),
+                       rms_error=rms, bias=bias, outliers=outliers, recordings=names,
+                       created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        path = profile_path(args.outdir, device)
+        with open(path, 'w') as fo:
+            json.dump(profile, fo, indent=2, sort_keys=True)
+        print('%-12s %6d %10.6f %12.2f %12.2f %9d' % (device, len(R), Kf, rms0, rms, outliers))
+
+    t2 = time.time()
+    print('%d recordings, %d devices: beats in %.2f s, fit in %.2f s' %
+          (len(recordings), len(devices), t1-t0, t2-t1))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+'''
+Binary capture files for the raw data read from the pulse oximeter.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A capture file is preallocated and memory-mapped so appending a read is one
+slice assignment into the map instead of several str() and write() calls.
+The layout is:
+
+    header   64 bytes, see HEADER_DTYPE
+    records  capacity fixed-width records, see RECORD_DTYPE
+    index    host time of every index_interval-th record
+
+Records are appended in time order so any time range can be located with
+the index and handed out as a view of the map without copying. When the
+file is full it's grown to twice its capacity and the index moved to the
+new end.
+
+    python pulseox_capture.py convert debug_data/rawdata.txt session.cap
+    python pulseox_capture.py info session.cap
+'''
+
+import os
+import sys
+
+from numpy import column_stack, diff, dtype, memmap, ndarray, searchsorted, uint32, zeros
+
+from pulseox_engine import UC_SAMPLE_PERIOD
+
+MAGIC = b'PULSEOX' # null padded to 8 bytes by the S8 field
+VERSION = 1
+
+HEADER_DTYPE = dtype([('magic', 'S8'), ('version', '<u2'), ('record_size', '<u2'),
+                      ('index_interval', '<u4'), ('capacity', '<u8'), ('count', '<u8'),
+                      ('sample_period', '<f8'), ('reserved', 'S24')])
+HEADER_SIZE = HEADER_DTYPE.itemsize # 64 bytes
+
+# host time of the read followed by the dataset in the order it was sent:
+# red sample, IR sample, sample number
+RECORD_DTYPE = dtype([('t', '<f8'), ('red', '<u4'), ('ir', '<u4'), ('n', '<u4')])
+RECORD_WORDS = RECORD_DTYPE.itemsize//4
+INDEX_DTYPE = dtype('<f8')
+
+INDEX_INTERVAL = 1024 # records per index entry
+DEFAULT_CAPACITY = 1 << 20 # records, about 1.7 hours at 166.7 Hz
+
+
+def _index_size(capacity, index_interval):
+    return (capacity + index_interval - 1)//index_interval
+
+
+def _file_size(capacity, index_interval):
+    return HEADER_SIZE + capacity*RECORD_DTYPE.itemsize + \
+           _index_size(capacity, index_interval)*INDEX_DTYPE.itemsize
+
+
+class CaptureWriter():
+    """
+    Appends records to a new capture file.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, index_interval=INDEX_INTERVAL,
+                 sample_period=UC_SAMPLE_PERIOD):
+        self.path = path
+        self.index_interval = index_interval
+
+        with open(path, 'wb') as fo:
+            fo.truncate(_file_size(capacity, index_interval))
+
+        header = memmap(path, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['record_size'] = RECORD_DTYPE.itemsize
+        header['index_interval'] = index_interval
+        header['capacity'] = capacity
+        header['count'] = 0
+        header['sample_period'] = sample_period
+        header.flush()
+        del header
+
+        self.count = 0
+        self._map(capacity)
+
+    def _map(self, capacity):
+        self.capacity = capacity
+        self.header = memmap(self.path, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        self.records = memmap(self.path, dtype=RECORD_DTYPE, mode='r+',
+                              offset=HEADER_SIZE, shape=(capacity,))
+        self.index = memmap(self.path, dtype=INDEX_DTYPE, mode='r+',
+                            offset=HEADER_SIZE+capacity*RECORD_DTYPE.itemsize,
+                            shape=(_index_size(capacity, self.index_interval),))
+        # Plain ndarray views for append() since slicing a memmap is slower.
+        # The datasets land in the last three words of a record in one copy.
+        records = self.records.view(ndarray)
+        self._t = records['t']
+        self._datasets = records.view(uint32).reshape(capacity, RECORD_WORDS)[:, 2:]
+        self._count = self.header.view(ndarray)['count']
+
+    def _grow(self):
+        index = self.index[:].copy()
+        self.flush()
+        del self.header, self.records, self.index, self._t, self._datasets, self._count
+
+        capacity = 2*self.capacity
+        with open(self.path, 'r+b') as fo:
+            fo.truncate(_file_size(capacity, self.index_interval))
+        self._map(capacity)
+        self.index[:len(index)] = index
+        self.header['capacity'] = capacity
+
+    def append(self, t, datasets):
+        """
+        Appends an (N, 3) array of (red, IR, sample number) rows that were
+        read at host time t.
+        """
+
+        num = len(datasets)
+        while self.count + num > self.capacity:
+            self._grow()
+
+        start = self.count
+        end = start + num
+        self._t[start:end] = t
+        self._datasets[start:end] = datasets
+
+        # index entries for every multiple of index_interval in start..end-1
+        first = (start + self.index_interval - 1)//self.index_interval
+        last = (end - 1)//self.index_interval
+        if first <= last:
+            self.index[first:last+1] = t
+
+        # the count is written last so a reader never sees a partial record
+        self.count = end
+        self._count[0] = end
+
+    def flush(self):
+        self.records.flush()
+        self.index.flush()
+        self.header.flush()
+
+    def close(self):
+        if self.header is None:
+            return
+        self.flush()
+        self.header = self.records = self.index = None
+        self._t = self._datasets = self._count = None
+
+
+class CaptureReader():
+    """
+    Read-only access to a capture file. Everything returned is a view of the
+    memory-mapped file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        """
+        Maps the records appended since the file was opened, for following
+        a capture that's still being written.
+        """
+
+        path = self.path
+        header = memmap(path, dtype=HEADER_DTYPE, mode='r', shape=(1,))[0]
+        if header['magic'] != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        if header['version'] != VERSION or header['record_size'] != RECORD_DTYPE.itemsize:
+            raise ValueError('%s has unsupported version %d' % (path, header['version']))
+
+        self.capacity = int(header['capacity'])
+        self.count = int(header['count'])
+        self.index_interval = int(header['index_interval'])
+        self.sample_period = float(header['sample_period'])
+
+        if self.count == 0:
+            self.records = zeros(0, dtype=RECORD_DTYPE)
+        else:
+            self.records = memmap(path, dtype=RECORD_DTYPE, mode='r',
+                                  offset=HEADER_SIZE, shape=(self.count,))
+        num_index = _index_size(self.count, self.index_interval)
+        if num_index == 0:
+            self.index = zeros(0, dtype=INDEX_DTYPE)
+        else:
+            self.index = memmap(path, dtype=INDEX_DTYPE, mode='r',
+                                offset=HEADER_SIZE+self.capacity*RECORD_DTYPE.itemsize,
+                                shape=(num_index,))
+
+    def __len__(self):
+        return self.count
+
+    def _locate(self, t):
+        # index of the first record with host time >= t
+        # Every record before the last index entry < t is read before t and
+        # every record after the next entry is read at or after t.
+        block = searchsorted(self.index, t, side='left') - 1
+        if block < 0:
+            return 0
+        lo = block*self.index_interval
+        hi = min(lo + self.index_interval, self.count)
+        return lo + searchsorted(self.records['t'][lo:hi], t, side='left')
+
+    def time_range(self, t0, t1):
+        """
+        Returns the records read at host times t0 <= t < t1.
+        """
+
+        return self.records[self._locate(t0):self._locate(t1)]
+
+    def arrays(self, records=None):
+        """
+        Returns t, n, red, ir for records (all of them by default), the same
+        as pulseox_replay.read_rawdata().
+        """
+
+        if records is None:
+            records = self.records
+        return records['t'], records['n'], records['red'], records['ir']
+
+
+def convert_rawdata(txt_path, cap_path):
+    """
+    Converts a rawdata.txt file written with DEBUG_DATA into a capture file.
+    Returns the number of records written.
+    """
+
+    from pulseox_replay import read_rawdata
+
+    t, n, red, ir = read_rawdata(txt_path)
+    writer = CaptureWriter(cap_path, capacity=max(len(t), 1))
+    # consecutive lines read at the same time are appended together
+    if len(t) > 0:
+        datasets = column_stack([red, ir, n])
+        breaks = [0] + ((diff(t) != 0).nonzero()[0] + 1).tolist() + [len(t)]
+        for start, end in zip(breaks[:-1], breaks[1:]):
+            writer.append(t[start], datasets[start:end])
+    writer.close()
+    return len(t)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 3 and argv[0] == 'convert':
+        num = convert_rawdata(argv[1], argv[2])
+        print('%d records written to %s' % (num, argv[2]))
+    elif len(argv) == 2 and argv[0] == 'info':
+        reader = CaptureReader(argv[1])
+        t = reader.records['t']
+        print('%s: %d records of %d, %d bytes each' %
+              (argv[1], len(reader), reader.capacity, RECORD_DTYPE.itemsize))
+        if len(reader):
+            print('host time %.3f to %.3f, sample numbers %d to %d' %
+                  (t[0], t[-1], reader.records['n'][0], reader.records['n'][-1]))
+    else:
+        print('usage: %s convert RAWDATA.txt OUT.cap | info FILE.cap' % os.path.basename(sys.argv[0]))
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+'''
+Device backends the GUI and other hosts read packets from.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A backend has open(), read() and close(). open() returns True if the device
+is ready, read() blocks until the next packet arrives and returns its bytes
+laid out like Send_Data() in uc_code/pulseox_USB.c sends them, UC_NUM_DATASETS
+datasets ordered oldest to newest, and close() releases the device.
+
+A backend also has protocol, the pulseox_protocol version its packets are
+in, to pass to decode_packets(), and sample_period. In protocol v2 read()
+returns the packets the firmware has queued joined end to end, reading on
+while they come back full, so a host that was held up gets the backlog in
+one read.
+
+USBDevice talks to the real pulse oximeter. SimulatedDevice stands in for
+the TSL230R and ATmega32U2 so everything downstream can be run and timed
+without the hardware.
+'''
+
+import time
+
+from numpy import arange, concatenate, exp, float64, pi, random, sin, uint32, zeros
+
+from pulseox_engine import K, UC_SAMPLE_PERIOD
+from pulseox_protocol import DATASET_FIELDS, PROTOCOL_V1, PROTOCOL_V2, REQ_GET_PROTOCOL, \
+                             REQ_SET_NTH_SAMPLE, REQ_SET_PROTOCOL, RED, IR, SAMPLE_NUM, \
+                             UC_NUM_DATASETS, V2_MIN_DATASETS, V2_NUM_DATASETS, \
+                             V2_PACKET_SIZE, V2_RING_SIZE, encode_v2
+from pulseox_signal import SPO2_CURVE
+
+USB_VID = 0xFFFE
+USB_PID = 0x0001
+IN_EP = 0x81
+IN_EP_SIZE = 60
+READ_TIMEOUT = 800 # milliseconds
+CONTROL_TIMEOUT = 100 # milliseconds
+UC_TIMER_PERIOD = 0.001 # seconds, OCR0A = 250 at 16 MHz/64, a dataset every NTH_SAMPLE
+V2_BANKS = 2 # packets the double-banked IN endpoint holds
+
+
+class USBDevice():
+    """
+    The pulse oximeter on the USB bus. dev is a device found with
+    find_usb_devices(). Without it open() opens the first device with the
+    vendor and product id.
+
+    open() negotiates the protocol, the newest both sides speak unless
+    protocol asks for one. With v2 nth_sample sets the firmware's
+    NTH_SAMPLE, making the sample period nth_sample*UC_TIMER_PERIOD.
+    """
+
+    def __init__(self, vid=USB_VID, pid=USB_PID, dev=None, protocol=None, nth_sample=None):
+        self.vid = vid
+        self.pid = pid
+        self.dev = dev
+        self.handle = None
+        self.requested = protocol
+        self.nth_sample = nth_sample
+        self.protocol = PROTOCOL_V1
+        self.sample_period = UC_SAMPLE_PERIOD
+
+    def open(self):
+        if self.dev is not None:
+            dev = self.dev
+            device_found = True
+        else:
+            # pyusb is only needed once a real device is used
+            import usb
+
+            device_found = False
+            busses = usb.busses()
+            for bus in busses:
+                if device_found == True:
+                    break
+                devices = bus.devices
+                for dev in devices:
+                    if (dev.idVendor == self.vid) & (dev.idProduct == self.pid):
+                        device_found = True
+                        vid = hex(int(dev.idVendor)).upper()
+                        pid = hex(int(dev.idProduct)).upper()
+                        print('Found vendorid:'+vid+', productid:'+pid+'.')
+                        break
+
+        if device_found == True:
+            self.handle = dev.open()
+            self.handle.setConfiguration(1)
+            self.handle.claimInterface(0)
+            self.negotiate()
+        elif device_found == False:
+            vid = hex(self.vid).upper()
+            pid = hex(self.pid).upper()
+            print('Device (vendorid:'+vid+', productid:'+pid+') not found.')
+
+        return device_found
+
+    def negotiate(self):
+        """
+        Switches the firmware to the newest protocol both sides speak, or
+        the one asked for. v1 firmware stalls REQ_GET_PROTOCOL.
+        """
+
+        import usb
+
+        self.protocol = PROTOCOL_V1
+        self.sample_period = UC_SAMPLE_PERIOD
+        wanted = PROTOCOL_V2 if self.requested is None else self.requested
+        if wanted == PROTOCOL_V1:
+            return
+        vendor_in = usb.TYPE_VENDOR | usb.RECIP_DEVICE | usb.ENDPOINT_IN
+        vendor_out = usb.TYPE_VENDOR | usb.RECIP_DEVICE | usb.ENDPOINT_OUT
+        try:
+            newest = self.handle.controlMsg(vendor_in, REQ_GET_PROTOCOL, 1,
+                                            timeout=CONTROL_TIMEOUT)[0]
+        except usb.USBError:
+            return
+        if newest < wanted:
+            return
+        self.handle.controlMsg(vendor_out, REQ_SET_PROTOCOL, [], value=wanted,
+                               timeout=CONTROL_TIMEOUT)
+        self.protocol = wanted
+        if self.nth_sample is not None:
+            self.handle.controlMsg(vendor_out, REQ_SET_NTH_SAMPLE, [], value=self.nth_sample,
+                                   timeout=CONTROL_TIMEOUT)
+            self.sample_period = self.nth_sample*UC_TIMER_PERIOD
+
+    def read(self):
+        # pyusb returns a tuple of ints
+        if self.protocol == PROTOCOL_V1:
+            return self.handle.interruptRead(IN_EP, IN_EP_SIZE, READ_TIMEOUT)
+        import usb
+
+        # a full packet means there's a backlog behind it
+        packet = bytearray(self.handle.interruptRead(IN_EP, V2_PACKET_SIZE, READ_TIMEOUT))
+        data = packet
+        while len(packet) == V2_PACKET_SIZE:
+            try:
+                packet = bytearray(self.handle.interruptRead(IN_EP, V2_PACKET_SIZE,
+                                                             READ_TIMEOUT))
+            except usb.USBError:
+                # the queue ran dry just as the last packet filled up. If the
+                # device has gone the next read fails too.
+                break
+            data += packet
+        return data
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.releaseInterface()
+            self.handle = None
+
+
+def find_usb_devices(vid=USB_VID, pid=USB_PID, protocol=None, nth_sample=None):
+    """
+    Returns a dict of an unopened USBDevice for every pulse oximeter on the
+    USB bus, keyed by bus and device name so a device keeps its key for as
+    long as it stays plugged in. protocol and nth_sample are passed on to
+    each.
+    """
+
+    import usb
+
+    found = {}
+    for bus in usb.busses():
+        for dev in bus.devices:
+            if (dev.idVendor == vid) & (dev.idProduct == pid):
+                found['usb:%s:%s' % (bus.dirname, dev.filename)] = USBDevice(vid, pid, dev, protocol,
+                                                                             nth_sample)
+    return found
+
+
+def perfusion_ratio(SpO2, K=K, curve=SPO2_CURVE):
+    """
+    Returns the ratio R of the red to IR log intensity swings that the SpO2
+    calculation in pulseox_signal.analyze_beats() turns into SpO2.
+    """
+
+    # solves SpO2 = 100*(a - b*(R+K))/(c + d*(R+K)) for R
+    a, b, c, d = curve
+    return (100*a - c*SpO2)/(d*SpO2 + 100*b) - K
+
+
+class SimulatedDevice():
+    """
+    A simulated TSL230R pulse oximeter.
+
+    Like the firmware it buffers a dataset every sample_period seconds and
+    a read returns the newest UC_NUM_DATASETS of them. When realtime is
+    True the datasets are produced against the wall clock, speed times
+    faster than the real device, and read() blocks until there's at least
+    one new dataset the way interruptRead() waits on the IN endpoint. When
+    realtime is False every read returns the next UC_NUM_DATASETS datasets
+    immediately.
+
+    heart_rate [bpm] and SpO2 [%] set the synthetic photoplethysmograms and
+    can be changed while reading. noise is the standard deviation of the
+    sample noise as a fraction of the signal level, motion the number of
+    motion artifacts per minute, drop the probability that a packet is
+    lost, and sample_num the sample number of the first dataset. Sample
+    numbers are uint32 so starting near 2**32 exercises the wraparound.
+
+    K and curve are the calibration the SpO2 is produced for, so a device
+    that reads off can be simulated by giving ones that differ from the
+    engine's.
+
+    With protocol v2 every dataset is queued and sent once, as in
+    Send_Data_V2(): two packets wait in the endpoint's banks, each filled
+    once V2_MIN_DATASETS are queued, behind a ring of V2_RING_SIZE that
+    loses its oldest dataset when it's full. A read that isn't realtime
+    returns the next UC_NUM_DATASETS datasets, the same ones as v1.
+    """
+
+    def __init__(self, heart_rate=75, SpO2=97, noise=0.0003, motion=0, drop=0,
+                 sample_num=0, realtime=True, speed=1.0, seed=None,
+                 sample_period=UC_SAMPLE_PERIOD, K=K, curve=SPO2_CURVE,
+                 protocol=PROTOCOL_V1):
+        self.heart_rate = heart_rate
+        self.SpO2 = SpO2
+        self.noise = noise
+        self.motion = motion
+        self.drop = drop
+        self.realtime = realtime
+        self.speed = speed
+        self.sample_period = sample_period
+        self.K = K
+        self.curve = curve
+        self.protocol = protocol
+
+        self.rs = random.RandomState(seed)
+        self.first_sample_num = sample_num
+        self.red_level = 40000.0 # TSL230R counts with the red LED on
+        self.ir_level = 60000.0
+        self.ir_perfusion = 0.03 # IR log intensity swing over a beat
+
+        self.is_open = False
+
+    def open(self):
+        self.produced = 0 # datasets buffered so far
+        self.delivered = 0 # produced when the last packet was read
+        self.dropped = 0 # packets lost
+        self.phase = 0.0 # of the heart beat, in beats
+        self.artifacts = [] # (start, duration, amplitude) in datasets
+        # the firmware's output buffer starts out zeroed
+        self.buffered = zeros((UC_NUM_DATASETS, DATASET_FIELDS), dtype=uint32)
+        # v2: the datasets queued in the ring and the packets in the banks
+        self.ring = zeros((0, DATASET_FIELDS), dtype=uint32)
+        self.banks = []
+        self.overflow = 0 # datasets the ring lost
+        self.t_open = time.time()
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+
+    def _clock(self):
+        # datasets the device would have buffered by now
+        return int((time.time() - self.t_open)*self.speed/self.sample_period)
+
+    def _produce(self, num):
+        # buffers the next num datasets
+        k = self.produced + arange(num)
+        t = k*self.sample_period
+
+        # the phase is carried over so heart_rate can change between reads
+        phase = (self.phase + self.heart_rate/60.0*self.sample_period*arange(1, num+1)) % 1
+        self.phase = phase[-1]
+
+        # A sharp systolic upstroke and a small dicrotic wave. Intensity is
+        # lowest at systole when the most blood is in the light path.
+        beat = exp(-((phase-0.15)/0.06)**2) + 0.1*exp(-((phase-0.45)/0.08)**2)
+        wander = 0.01*sin(2*pi*0.2*t) # respiration
+
+        # Motion artifacts change both intensities by the same factor.
+        motion = zeros(num, dtype=float64)
+        if self.motion > 0:
+            events = self.rs.poisson(self.motion/60.0*num*self.sample_period)
+            for start in self.produced + self.rs.uniform(0, num, events):
+                duration = self.rs.uniform(0.5, 2)/self.sample_period
+                amplitude = self.rs.uniform(-0.1, 0.1)
+                self.artifacts.append((start, duration, amplitude))
+            artifacts = []
+            for start, duration, amplitude in self.artifacts:
+                x = (k - start)/duration
+                inside = (x >= 0) & (x < 1)
+                motion[inside] += amplitude*sin(pi*x[inside])**2
+                if start + duration > k[-1]:
+                    artifacts.append((start, duration, amplitude))
+            self.artifacts = artifacts
+
+        ir_swing = self.ir_perfusion*beat
+        red_swing = perfusion_ratio(self.SpO2, self.K, self.curve)*ir_swing
+        red = self.red_level*exp(-red_swing - wander + motion)
+        ir = self.ir_level*exp(-ir_swing - wander + motion)
+        if self.noise > 0:
+            red *= 1 + self.noise*self.rs.randn(num)
+            ir *= 1 + self.noise*self.rs.randn(num)
+
+        datasets = zeros((num, DATASET_FIELDS), dtype=uint32)
+        datasets[:, RED] = red.round()
+        datasets[:, IR] = ir.round()
+        datasets[:, SAMPLE_NUM] = (self.first_sample_num + k) % 2**32
+
+        self.produced += num
+        if self.protocol == PROTOCOL_V1:
+            self.buffered = concatenate([self.buffered, datasets])[-UC_NUM_DATASETS:]
+            return
+
+        # Empty banks were filled as soon as V2_MIN_DATASETS were queued,
+        # and whatever's left over the ring's size is lost oldest first.
+        ring = concatenate([self.ring, datasets])
+        while len(self.banks) < V2_BANKS and len(ring) >= V2_MIN_DATASETS:
+            self.banks.append(self._packet(ring[:V2_MIN_DATASETS]))
+            ring = ring[V2_MIN_DATASETS:]
+        if len(ring) > V2_RING_SIZE:
+            self.overflow += len(ring) - V2_RING_SIZE
+            ring = ring[len(ring) - V2_RING_SIZE:]
+        self.ring = ring
+
+    def _packet(self, datasets):
+        return encode_v2(int(datasets[0, SAMPLE_NUM]), datasets, self.overflow)
+
+    def read(self):
+        """
+        Returns the bytes of the next packet, or in v2 of the packets
+        queued.
+        """
+
+        if self.protocol == PROTOCOL_V2:
+            return self._read_v2()
+
+        target = self.delivered + (UC_NUM_DATASETS if not self.realtime else 1)
+        # a dropped packet's datasets are overwritten before the next read
+        while self.drop > 0 and self.rs.rand() < self.drop:
+            target += UC_NUM_DATASETS
+            self.dropped += 1
+
+        if self.realtime:
+            now = self._clock()
+            if now < target:
+                time.sleep((target - now)*self.sample_period/self.speed)
+                now = target
+            target = max(now, target)
+
+        if target > self.produced:
+            self._produce(target - self.produced)
+        self.delivered = self.produced
+        return self.buffered.astype('<u4').tobytes()
+
+    def _read_v2(self):
+        data = b''
+        while True:
+            # wait for a bank to be filled
+            while not self.banks:
+                if not self.realtime:
+                    self._produce(UC_NUM_DATASETS)
+                    continue
+                now = self._clock()
+                if now > self.produced:
+                    self._produce(now - self.produced)
+                else:
+                    time.sleep((V2_MIN_DATASETS - len(self.ring))*self.sample_period/self.speed)
+            if self.realtime and self._clock() > self.produced:
+                self._produce(self._clock() - self.produced)
+
+            packet = self.banks.pop(0)
+            # the bank read is filled again straight away
+            while len(self.banks) < V2_BANKS and len(self.ring) >= V2_MIN_DATASETS:
+                count = min(len(self.ring), V2_NUM_DATASETS)
+                self.banks.append(self._packet(self.ring[:count]))
+                self.ring = self.ring[count:]
+            if self.drop > 0 and self.rs.rand() < self.drop:
+                self.dropped += 1
+                continue
+            data += packet
+            if len(packet) < V2_PACKET_SIZE:
+                return data
@@ -0,0 +1,409 @@
+'''
+Turns the datasets read from the pulse oximeter into photoplethysmograms,
+heart beats, heart rate and SpO2. Importing this module doesn't require
+PyQt4, pyusb or a display so it can be used by the GUI, by batch jobs, and
+by servers alike.
+Author: Jonathan Thomson
+Released Under the MIT License
+'''
+
+import time
+
+from numpy import column_stack, int64, isnan, median
+
+from pulseox_beats import HRV, RR_RANGE, BeatTracker
+from pulseox_filter import ppg_filter
+from pulseox_ingest import Ingest
+from pulseox_protocol import UC_NUM_DATASETS, refresh_due
+from pulseox_quality import BeatQuality
+from pulseox_signal import SPO2_CURVE, StreamAnalyzer, analyze_window
+from pulseox_stats import WindowedStats
+
+# So that a heart rate of 250 bpm has a well defined trace take 40 samples per
+# beat at 250 [bpm] which is 166.7 samples/sec. Therefore at a heart rate of
+# 80 [bpm] (midrange normal) one beat will be composed of 125 samples.
+#
+# The microcontroller outputs 5 datasets every read. A dataset is a sample
+# from the red LED, a sample from the IR LED, and the sample number. The
+# microcontroller puts a new dataset in the output buffer every 6 milliseconds.
+# Therefore the buffer is completely refreshed every 30 ms. If interruptRead()
+# is called every 30 ms, that's 33.3 reads per second. Therefore the effective
+# sample rate is 166.7 Hz (33.3[reads/s] * 5[dataset/read])
+#
+# A shorter READ_PERIOD results in more samples per heart beat and therefore
+# a better looking trace. However since this heart beat trace is composed of
+# more samples and the number of samples that will fit in a graph window is
+# fixed, then fewer heart beats will fit in the graph window at one time. A
+# shorter READ_PERIOD won't necessarily result in more accurate calculations.
+# For example, when data was acquired at an effective rate of 1000 Hz and the
+# SpO2 was calculated it barely differed from the SpO2 calculated from the same
+# data downsampled to 10 Hz (i.e. SpO2 percent error was 0.258%). Additionally
+# heart rate calculations will be inaccurate if a short READ_PERIOD results
+# in only a few heart beats fitting within BUFFERSIZE.
+#
+# With a UC_SAMPLE_PERIOD of 0.005, a BUFFERSIZE of 1500, and a heart rate of
+# 60 [bpm] then 7.5 beats will fit in the buffer and plot window. Heart rates
+# above 300 [bpm] will have less than 40 samples/beat.
+# With a UC_SAMPLE_PERIOD of 0.006, a BUFFERSIZE of 1500, and a heart rate of
+# 60 [bpm] then 9 beats will fit in the buffer and plot window. Heart rates
+# above 250 [bpm] will have less than 40 samples/beat.
+
+# Start of hard constants. If you'd like to change these you'll have to
+# modify the microcontroller code. UC_NUM_DATASETS cannot be greater
+# than 5.
+#UC_SAMPLE_PERIOD = 0.005 # seconds, new dataset buffered in uc every 5 ms
+UC_SAMPLE_PERIOD = 0.006 # seconds, new dataset buffered in uc every 6 ms
+READ_PERIOD = UC_NUM_DATASETS*UC_SAMPLE_PERIOD # seconds
+# End of hard constants.
+
+#K = 0.012
+#K = -0.005 # SpO2 calculation calibration constant, offtarget=?
+K = -0.024542 # SpO2 calculation calibration constant, offtarget=97, 98.7
+#K = -0.036883 # SpO2 calculation calibration constant, offtarget=96.5
+#K = -0.049273 # SpO2 calculation calibration constant, offtarget=96
+
+# With filtering, the beats found on the filtered PPGs are moved onto the
+# peaks and troughs of the unfiltered ones within SNAP_WIDTH of where the
+# filter's delay at SNAP_FREQUENCY puts them.
+SNAP_FREQUENCY = 1.25 # Hz, 75 bpm
+SNAP_WIDTH = 0.1 # seconds
+
+# Values outside these ranges are still counted but the windowed statistics
+# are quickest inside them.
+HR_RANGE = (0, 300) # bpm
+SPO2_RANGE = (50, 110) # percent
+
+
+def view_constants(view, sample_period=UC_SAMPLE_PERIOD):
+    """
+    Returns a dict of the soft constants for the 'short' or 'long' view.
+    """
+
+    # Start of soft constants. You can adjust soft constants as you see fit.
+
+    if (view == 'short'):
+        # The short view is better for viewing a detailed photoplethysmogram.
+        # Fewer beats are displayed on the screen, but more points are used
+        # to plot each beat.
+        GRAPH_HEIGHT = 680
+        GRAPH_WIDTH = 780
+        WINDOW_HEIGHT = GRAPH_HEIGHT+70
+        WINDOW_WIDTH = GRAPH_WIDTH+20
+
+        BUFFERSIZE = 1500
+
+        NUM_POINTS_PER_PLOT = 500 # set this less than BUFFERSIZE for quicker plotting
+        STEP = BUFFERSIZE//NUM_POINTS_PER_PLOT
+        SAMPLES_PER_REFRESH = 15*STEP # must be a multiple of UC_NUM_DATASETS
+
+    elif (view == 'long'):
+        # The long view is better if you'd like to see a longer photoplethysmogram
+        # to monitor respiration. More beats are displayed on the screen, but
+        # fewer points are used to plot each beat.
+        GRAPH_HEIGHT = 680
+        GRAPH_WIDTH = 1210
+        WINDOW_HEIGHT = GRAPH_HEIGHT+70
+        WINDOW_WIDTH = GRAPH_WIDTH+20
+
+        BUFFERSIZE = 12000
+
+        NUM_POINTS_PER_PLOT = 1000
+        STEP = BUFFERSIZE//NUM_POINTS_PER_PLOT
+        SAMPLES_PER_REFRESH = 10*STEP
+
+    else:
+        raise ValueError("view must be 'short' or 'long', not %r" % (view,))
+
+    # Beat detection at the edge of the data is unreliable. So any beats beyond
+    # EDGE_THRESHOLD should be discarded. 83 is half the number of samples that
+    # make up one beat at 60 [bpm] when the sample rate is 166.7 Hz.
+    EDGE_THRESHOLD = BUFFERSIZE-round((1/sample_period)/2)
+
+    # The displayed heart rate is the median of the last 3 seconds and the
+    # displayed SpO2 the median of the last 20 seconds. Both are also kept
+    # over the last 5 minutes for the trend.
+    HR_WINDOW = 3 # seconds
+    SPO2_WINDOW = 20 # seconds
+    TREND_WINDOW = 300 # seconds
+    # The heart rate variability is displayed over the last minute and
+    # kept over TREND_WINDOW, the standard length of a short-term record.
+    HRV_WINDOW = 60 # seconds
+    # The signal quality shown is the mean score of the beats in the last
+    # QUALITY_WINDOW.
+    QUALITY_WINDOW = 10 # seconds
+    # End of soft contants.
+
+    return dict(GRAPH_HEIGHT=GRAPH_HEIGHT, GRAPH_WIDTH=GRAPH_WIDTH,
+                WINDOW_HEIGHT=WINDOW_HEIGHT, WINDOW_WIDTH=WINDOW_WIDTH,
+                BUFFERSIZE=BUFFERSIZE, NUM_POINTS_PER_PLOT=NUM_POINTS_PER_PLOT,
+                STEP=STEP, SAMPLES_PER_REFRESH=SAMPLES_PER_REFRESH,
+                EDGE_THRESHOLD=EDGE_THRESHOLD, HR_WINDOW=HR_WINDOW,
+                SPO2_WINDOW=SPO2_WINDOW, TREND_WINDOW=TREND_WINDOW, HRV_WINDOW=HRV_WINDOW,
+                QUALITY_WINDOW=QUALITY_WINDOW)
+
+
+class PulseOxEngine():
+    """
+    Processing chain for one pulse oximeter.
+
+    Datasets are handed to push() as they're read. Whenever push() returns
+    True enough new samples have arrived for process() to be called, which
+    returns tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out, the
+    last two the labels shown. The numeric heart rate and SpO2 are
+    left in heartrate and SpO2 (None while they're unknown) and the SpO2 of
+    each beat in the window in SpO2_beats, and the sample numbers of its
+    peaks and troughs in beats, a (systole, diastole) pair of arrays or
+    None. The heart rates and SpO2s of
+    every refresh are kept in heartrate_stats and SpO2_stats, windows
+    named 'display' and 'trend' of pulseox_stats.WindowedStats.
+
+    Every beat is also reported once, as a pulseox_beats.Beat in the list
+    new_beats of the process() call that first confirmed it, and added to
+    hrv, a pulseox_beats.HRV with 'display' and 'trend' windows.
+
+    If quality is True every beat is scored by a pulseox_quality.BeatQuality
+    and only the beats it accepts go into the heart rate and SpO2: the heart
+    rate from the interval to the beat before if that was accepted too and
+    the SpO2 of the beat itself. The mean score of the beats over the last
+    QUALITY_WINDOW is left in signal_quality. Otherwise the heart rate and
+    SpO2 of every refresh's window are used, whatever the beats look like.
+
+    All configuration is per instance. The constants of the view can be
+    overridden with keyword arguments named like the ones view_constants()
+    returns, e.g. PulseOxEngine('long', BUFFERSIZE=100000).
+
+    If profiler is a pulseox_profile.Profiler the stages of process() are
+    timed into it.
+
+    If filter is True the beats are looked for on PPGs filtered by
+    pulseox_filter.ppg_filter(), or by the FilterChains filter(sample_period)
+    returns if it's a function, instead of on the raw PPGs. The displayed
+    PPGs and the SpO2 still come from the raw data.
+
+    K and curve are the SpO2 calibration, the constant added to each beat's
+    ratio R and the coefficients of pulseox_signal.ratio_SpO2()'s curve.
+    pulseox_calibrate.py fits both to reference SpO2s and writes them to a
+    profile for a device, which load_profile() there reads back.
+
+    If ingest is True the datasets pushed are passed through a
+    pulseox_ingest.Ingest first, which drops the ones already pushed, fills
+    in short runs of missing ones and unwraps the sample numbers. Then reads
+    may overlap or skip datasets. Otherwise every dataset pushed is assumed
+    to follow the last one.
+    """
+
+    def __init__(self, view='short', K=K, incremental=True,
+                 sample_period=UC_SAMPLE_PERIOD, profiler=None, ingest=True, filter=False,
+                 quality=True, curve=SPO2_CURVE, **constants):
+        c = view_constants(view, sample_period)
+        for name in constants:
+            if name not in c:
+                raise TypeError('unknown constant %s' % name)
+        c.update(constants)
+        if 'BUFFERSIZE' in constants and 'EDGE_THRESHOLD' not in constants:
+            c['EDGE_THRESHOLD'] = c['BUFFERSIZE']-round((1/sample_period)/2)
+
+        self.view = view
+        self.constants = c
+        self.buffersize = c['BUFFERSIZE']
+        self.graph_width = c['GRAPH_WIDTH']
+        self.samples_per_refresh = c['SAMPLES_PER_REFRESH']
+        self.edge_threshold = c['EDGE_THRESHOLD']
+        # windows in sample numbers
+        self.hr_span = int(round(c['HR_WINDOW']/sample_period))
+        self.spo2_span = int(round(c['SPO2_WINDOW']/sample_period))
+        self.trend_span = int(round(c['TREND_WINDOW']/sample_period))
+        self.hrv_span = int(round(c['HRV_WINDOW']/sample_period))
+        self.quality_span = int(round(c['QUALITY_WINDOW']/sample_period))
+        self.sample_period = sample_period
+        self.K = K
+        self.curve = curve
+        self.incremental = incremental
+        self.profiler = profiler
+        if ingest:
+            self.ingest = Ingest(profiler=profiler)
+        else:
+            self.ingest = None
+        if filter is True:
+            self.filter = ppg_filter
+        else:
+            self.filter = filter or None
+        self.quality = quality
+
+        self.reset()
+
+    def reset(self):
+        # The stream analyzer holds the raw data for both the incremental and
+        # the batch path. The batch path processes its window views.
+        if self.filter is not None:
+            filters = (self.filter(self.sample_period), self.filter(self.sample_period))
+            self.snap = (filters[0].delay(SNAP_FREQUENCY),
+                         int(round(SNAP_WIDTH/self.sample_period)))
+        else:
+            filters = None
+            self.snap = None
+        self.stream = StreamAnalyzer(self.buffersize, self.graph_width,
+                                     self.edge_threshold, self.sample_period, self.K,
+                                     filters, self.snap, self.curve)
+        self.stream.profiler = self.profiler
+        if self.ingest is not None:
+            self.ingest.reset()
+
+        self.heartrate_stats = WindowedStats(dict(display=self.hr_span, trend=self.trend_span),
+                                             HR_RANGE[0], HR_RANGE[1])
+        self.SpO2_stats = WindowedStats(dict(display=self.spo2_span, trend=self.trend_span),
+                                        SPO2_RANGE[0], SPO2_RANGE[1])
+        self.beat_tracker = BeatTracker(self.sample_period, self.K,
+                                        BeatQuality() if self.quality else None, self.curve)
+        self.hrv = HRV(dict(display=self.hrv_span, trend=self.trend_span))
+        self.new_beats = []
+        self.quality_stats = WindowedStats(dict(display=self.quality_span), 0, 1)
+        self.signal_quality = None
+        self.accepted = False # whether the newest beat was
+
+        self.heartrate = None
+        self.SpO2 = None
+        self.SpO2_beats = None
+        self.beats = None
+
+    def push(self, datasets):
+        """
+        Adds an (N, 3) array of (red, IR, sample number) rows ordered oldest
+        to newest. Returns True if a refresh is due.
+        """
+
+        if self.ingest is not None:
+            datasets = self.ingest.process(datasets)
+            if len(datasets) == 0:
+                return False
+        i = self.stream.total % self.buffersize
+        self.stream.push(datasets)
+        # After the ingest stage the number of datasets needn't be a multiple
+        # of UC_NUM_DATASETS so every position is checked.
+        return refresh_due(i, len(datasets), self.buffersize, self.samples_per_refresh, 1)
+
+    def until_refresh(self):
+        """
+        Returns how many datasets can be pushed, a read at a time, before
+        the next refresh is due, assuming none are duplicates or missing.
+        """
+
+        i = self.stream.total % self.buffersize
+        k = 1
+        while ((i + k) % self.buffersize) % self.samples_per_refresh != 0 and k < self.buffersize:
+            k += 1
+        # rounded up to whole reads
+        return -(-k//UC_NUM_DATASETS)*UC_NUM_DATASETS
+
+    def window(self):
+        # n, Ired, Iir of the last buffersize samples
+        return self.stream.window()
+
+    def process(self, t=None):
+        """
+        Processes the current window and updates the heart rate and SpO2.
+        t is the host time the newest dataset was read, which the beats are
+        timed from. It's the time process() is called if not given.
+        """
+
+        if self.incremental:
+            analysis = self.stream.update()
+        else:
+            # the window is already contiguous in the stream analyzer's
+            # mirrored buffers so there's nothing to unroll
+            n, Ired, Iir = self.stream.window()
+            if self.filter is not None:
+                # filtered a read at a time by the stream analyzer as well
+                detect = self.stream.detection_window()
+            else:
+                detect = None
+            analysis = analyze_window(n, Ired, Iir, self.graph_width, self.edge_threshold,
+                                      self.sample_period, self.K, self.profiler,
+                                      detect, self.snap, self.curve)
+        return self.update_vitals(*analysis, t=t)
+
+    def update_vitals(self, tn, nPPG_red, nPPG_ir, systole, diastole, time_elapsed, SpO2,
+                      t=None):
+        self.SpO2_beats = SpO2
+        window, Ired, Iir = self.stream.window()
+        if t is None:
+            t = time.time()
+        # the beats confirmed since the last refresh
+        self.new_beats = self.beat_tracker.update(window, Ired, Iir, systole, diastole, t)
+        for beat in self.new_beats:
+            self.hrv.add(beat)
+        # sample number of the newest sample in the window
+        n = int(window[-1])
+        self.hrv.expire(n)
+
+        if (systole != 'NA' and diastole != 'NA'):
+            self.beats = (window[systole], window[diastole])
+        else:
+            self.beats = None
+
+        if self.quality:
+            return (tn, nPPG_red, nPPG_ir, systole, diastole) + self.gate_vitals(n)
+
+        if (systole != 'NA' and diastole != 'NA'):
+            self.heartrate_stats.add(n, 60*(len(systole)-1)/time_elapsed)
+            self.heartrate = self.heartrate_stats['display'].median()
+            hr_out = str(int(round(self.heartrate)))
+
+            mSpO2 = median(SpO2)
+            if not isnan(mSpO2):
+                self.SpO2_stats.add(n, mSpO2)
+                self.SpO2 = self.SpO2_stats['display'].median()
+                SpO2_out = str( round(self.SpO2*10)/10 )
+            else:
+                self.SpO2 = None
+                SpO2_out = '--'
+        else:
+            self.heartrate = None
+            self.SpO2 = None
+            hr_out = 'NA'
+            SpO2_out = 'NA'
+
+        return tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out
+
+    def gate_vitals(self, n):
+        # Adds the new beats the quality stage accepted to the heart rate
+        # and SpO2 windows, which are then up to sample number n. Returns
+        # hr_out, SpO2_out.
+        for beat in self.new_beats:
+            self.quality_stats.add(beat.n, beat.quality)
+            if beat.accepted:
+                if self.accepted and RR_RANGE[0] <= beat.rr <= RR_RANGE[1]:
+                    self.heartrate_stats.add(beat.n, 60/beat.rr)
+                # the same plausible range as analyze_beats()
+                if 85 < beat.SpO2 < 100:
+                    self.SpO2_stats.add(beat.n, beat.SpO2)
+            self.accepted = beat.accepted
+        self.quality_stats.expire(n)
+        self.heartrate_stats.expire(n)
+        self.SpO2_stats.expire(n)
+
+        self.signal_quality = self.quality_stats['display'].mean()
+        self.heartrate = self.heartrate_stats['display'].median()
+        self.SpO2 = self.SpO2_stats['display'].median()
+        if self.heartrate is None:
+            return 'NA', 'NA'
+        if self.SpO2 is None:
+            return str(int(round(self.heartrate))), '--'
+        return str(int(round(self.heartrate))), str( round(self.SpO2*10)/10 )
+
+    def feed(self, n, red, ir):
+        """
+        Pushes raw sample arrays and processes every refresh that would have
+        been due had they arrived a read at a time from the device. Returns
+        the list of process() results.
+        """
+
+        datasets = column_stack([red, ir, n]).astype(int64)
+        results = []
+        k = 0
+        while k < len(datasets):
+            num = self.until_refresh()
+            if self.push(datasets[k:k+num]):
+                results.append(self.process())
+            k += num
+        return results
@@ -0,0 +1,212 @@
+'''
+Streaming filters for the photoplethysmograms ahead of beat detection.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+The firmware's moving average of 128 periods is the only smoothing the raw
+PPGs get, so the beats are found on a signal that still has the baseline
+wander of breathing and movement in it. That's why PEAK_DELTA has to be as
+large as it is. A FilterChain removes the wander and the noise above the
+heart rate before the beats are looked for.
+
+Every stage keeps its state between calls, so filtering a read costs the
+same however long the window is, and nothing is filtered twice. The
+biquads are the second-order sections of Robert Bristow-Johnson's Audio EQ
+Cookbook in transposed direct form II, and a Butterworth filter of order 2k
+is k of them with the Qs of its pole pairs.
+
+    chain = ppg_filter(UC_SAMPLE_PERIOD)
+    filtered = chain.process(-log(Ired)) # a read at a time, oldest first
+'''
+
+from cmath import exp as cexp, phase
+from math import cos, pi, sin
+
+from numpy import asarray, empty, float64
+
+HEART_RATE_BAND = (0.5, 5.0) # Hz, 30 to 300 bpm
+DC_POLE = 0.995 # pole of the DC blocker, about 0.13 Hz at 166.7 Hz
+
+
+class Biquad():
+    """
+    Second-order IIR section y = (b0 + b1 z^-1 + b2 z^-2)/(1 + a1 z^-1 + a2 z^-2) x.
+    """
+
+    def __init__(self, b0, b1, b2, a1, a2):
+        self.b0, self.b1, self.b2, self.a1, self.a2 = b0, b1, b2, a1, a2
+        self.z1 = self.z2 = 0.0
+
+    def reset(self, x=0.0):
+        # the state after a constant input x, so it doesn't start with a step
+        y = x*(self.b0 + self.b1 + self.b2)/(1 + self.a1 + self.a2)
+        self.z2 = self.b2*x - self.a2*y
+        self.z1 = self.b1*x - self.a1*y + self.z2
+        return y
+
+    def process(self, x):
+        # x is a list of floats, filtered in place
+        b0, b1, b2, a1, a2 = self.b0, self.b1, self.b2, self.a1, self.a2
+        z1, z2 = self.z1, self.z2
+        for k in range(len(x)):
+            xk = x[k]
+            y = b0*xk + z1
+            z1 = b1*xk - a1*y + z2
+            z2 = b2*xk - a2*y
+            x[k] = y
+        self.z1, self.z2 = z1, z2
+
+    def response(self, w):
+        z = cexp(-1j*w)
+        return (self.b0 + self.b1*z + self.b2*z*z)/(1 + self.a1*z + self.a2*z*z)
+
+
+def _cookbook(kind, f0, fs, Q):
+    w0 = 2*pi*f0/fs
+    alpha = sin(w0)/(2*Q)
+    c = cos(w0)
+    if kind == 'lowpass':
+        b = [(1 - c)/2, 1 - c, (1 - c)/2]
+    elif kind == 'highpass':
+        b = [(1 + c)/2, -(1 + c), (1 + c)/2]
+    else:
+        raise ValueError("kind must be 'lowpass' or 'highpass', not %r" % (kind,))
+    a0 = 1 + alpha
+    return Biquad(b[0]/a0, b[1]/a0, b[2]/a0, -2*c/a0, (1 - alpha)/a0)
+
+
+def butterworth(kind, f0, fs, order=2):
+    """
+    Returns the Biquads of an even order Butterworth lowpass or highpass
+    filter with its -3 dB point at f0 [Hz], sampled at fs [Hz].
+    """
+
+    if order < 2 or order % 2:
+        raise ValueError('order must be even, not %r' % (order,))
+    pairs = order//2
+    return [_cookbook(kind, f0, fs, 1/(2*cos((2*k + 1)*pi/(4*pairs))))
+            for k in range(pairs)]
+
+
+class DCBlocker():
+    """
+    y[n] = x[n] - x[n-1] + pole*y[n-1], removes the DC level and drift
+    slower than about (1 - pole)*fs/(2 pi) [Hz].
+    """
+
+    def __init__(self, pole=DC_POLE):
+        self.pole = pole
+        self.x1 = self.y1 = 0.0
+
+    def reset(self, x=0.0):
+        self.x1 = x
+        self.y1 = 0.0
+        return 0.0
+
+    def process(self, x):
+        pole = self.pole
+        x1, y1 = self.x1, self.y1
+        for k in range(len(x)):
+            xk = x[k]
+            y1 = xk - x1 + pole*y1
+            x1 = xk
+            x[k] = y1
+        self.x1, self.y1 = x1, y1
+
+    def response(self, w):
+        z = cexp(-1j*w)
+        return (1 - z)/(1 - self.pole*z)
+
+
+class Derivative():
+    """
+    y[n] = (x[n] - x[n-1])*fs, the slope of the signal.
+    """
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.x1 = 0.0
+
+    def reset(self, x=0.0):
+        self.x1 = x
+        return 0.0
+
+    def process(self, x):
+        fs = self.fs
+        x1 = self.x1
+        for k in range(len(x)):
+            xk = x[k]
+            x[k] = (xk - x1)*fs
+            x1 = xk
+        self.x1 = x1
+
+    def response(self, w):
+        return (1 - cexp(-1j*w))*self.fs
+
+
+class FilterChain():
+    """
+    Stages applied one after the other, each keeping its state between
+    calls to process().
+    """
+
+    def __init__(self, stages, fs):
+        self.stages = list(stages)
+        self.fs = fs
+
+    def reset(self, x=0.0):
+        """
+        Puts every stage in the state it would be in after a constant input
+        x and returns the output that state gives.
+        """
+
+        for stage in self.stages:
+            x = stage.reset(x)
+        return x
+
+    def process(self, x):
+        """
+        Returns the next len(x) filtered samples of x as a float64 array.
+        """
+
+        y = asarray(x, dtype=float64).tolist()
+        for stage in self.stages:
+            stage.process(y)
+        out = empty(len(y))
+        out[:] = y
+        return out
+
+    def response(self, f):
+        # complex frequency response at f [Hz]
+        w = 2*pi*f/self.fs
+        h = 1.0
+        for stage in self.stages:
+            h *= stage.response(w)
+        return h
+
+    def delay(self, f):
+        """
+        Returns by how many samples a sinusoid of f [Hz] is delayed, for
+        locating the features of the input from those of the output.
+        Negative if it leads, like a derivative.
+        """
+
+        return -phase(self.response(f))/(2*pi*f/self.fs)
+
+
+def ppg_filter(sample_period, band=HEART_RATE_BAND, order=2, dc=False, derivative=False):
+    """
+    Returns the FilterChain used ahead of beat detection: an optional DC
+    blocker, a Butterworth band-pass of the heart rate band made of a
+    highpass and a lowpass of the given order, and an optional derivative.
+    """
+
+    fs = 1/sample_period
+    stages = []
+    if dc:
+        stages.append(DCBlocker())
+    stages += butterworth('highpass', band[0], fs, order)
+    stages += butterworth('lowpass', band[1], fs, order)
+    if derivative:
+        stages.append(Derivative(fs))
+    return FilterChain(stages, fs)
@@ -12,111 +12,69 @@ USB code borrowed from DeviceAccessPy.py by Opendous Inc. under MIT License
 http://code.google.com/p/micropendous/source/browse/trunk/Micropendous/Firmware/LoopBack/DeviceAccessPy.py?r=404
 '''
 
+import os
 import sys
-import struct
-import usb
 import time
-import threading
 from PyQt4 import QtGui, QtCore
-from math import sin, pi
-from numpy import NaN, Inf, arange, array, append, diff, isnan, isscalar, log, mean, median, ceil
+from numpy import float64, frombuffer
+
+from pulseox_acquire import Reader, read_timing
+from pulseox_calibrate import load_profile
+from pulseox_capture import CaptureWriter
+from pulseox_device import UC_TIMER_PERIOD, SimulatedDevice, USBDevice
+from pulseox_engine import PulseOxEngine, UC_SAMPLE_PERIOD, view_constants
+from pulseox_history import History, HISTORY_SECONDS
+from pulseox_parallel import ProcessEngine
+from pulseox_profile import Profiler, timer
+from pulseox_protocol import decode_packets
+from pulseox_render import envelope_points, envelope_ppgs, normalize_samples
+from pulseox_trend import TrendWriter
 
 DEBUG_DATA = False
+# Time each stage into histograms, show their 99th percentiles in the window
+# and print a summary on exit.
 DEBUG_TIMING = True
 
-# So that a heart rate of 250 bpm has a well defined trace take 40 samples per
-# beat at 250 [bpm] which is 166.7 samples/sec. Therefore at a heart rate of
-# 80 [bpm] (midrange normal) one beat will be composed of 125 samples.
-#
-# The microcontroller outputs 5 datasets every read. A dataset is a sample
-# from the red LED, a sample from the IR LED, and the sample number. The
-# microcontroller puts a new dataset in the output buffer every 6 milliseconds.
-# Therefore the buffer is completely refreshed every 30 ms. If interruptRead()
-# is called every 30 ms, that's 33.3 reads per second. Therefore the effective
-# sample rate is 166.7 Hz (33.3[reads/s] * 5[dataset/read])
-#
-# A shorter READ_PERIOD results in more samples per heart beat and therefore
-# a better looking trace. However since this heart beat trace is composed of
-# more samples and the number of samples that will fit in a graph window is
-# fixed, then fewer heart beats will fit in the graph window at one time. A
-# shorter READ_PERIOD won't necessarily result in more accurate calculations.
-# For example, when data was acquired at an effective rate of 1000 Hz and the
-# SpO2 was calculated it barely differed from the SpO2 calculated from the same
-# data downsampled to 10 Hz (i.e. SpO2 percent error was 0.258%). Additionally
-# heart rate calculations will be inaccurate if a short READ_PERIOD results
-# in only a few heart beats fitting within BUFFERSIZE.
-#
-# With a UC_SAMPLE_PERIOD of 0.005, a BUFFERSIZE of 1500, and a heart rate of 
-# 60 [bpm] then 7.5 beats will fit in the buffer and plot window. Heart rates
-# above 300 [bpm] will have less than 40 samples/beat.
-# With a UC_SAMPLE_PERIOD of 0.006, a BUFFERSIZE of 1500, and a heart rate of 
-# 60 [bpm] then 9 beats will fit in the buffer and plot window. Heart rates
-# above 250 [bpm] will have less than 40 samples/beat.
-
-# Start of hard constants. If you'd like to change these you'll have to
-# modify the microcontroller code. UC_NUM_DATASETS cannot be greater
-# than 5.
-USB_VID = 0xFFFE
-USB_PID = 0x0001
-UC_NUM_DATASETS = 5
-#UC_SAMPLE_PERIOD = 0.005 # seconds, new dataset buffered in uc every 5 ms
-UC_SAMPLE_PERIOD = 0.006 # seconds, new dataset buffered in uc every 6 ms
-READ_PERIOD = UC_NUM_DATASETS*UC_SAMPLE_PERIOD # seconds
-# End of hard constants.
+# Only process the samples read since the last refresh instead of the whole
+# buffer. The results are the same either way.
+INCREMENTAL_PROCESSING = True
 
+# Look for heart beats on band-pass filtered PPGs (see pulseox_filter.py),
+# which copes far better with noise and baseline wander. The traces shown
+# and the SpO2 are still calculated from the raw data.
+FILTER_PPG = False
 
-def set_constants(view):
-
-    global GRAPH_HEIGHT, GRAPH_WIDTH
-    global WINDOW_HEIGHT, WINDOW_WIDTH
-    global BUFFERSIZE
-    global NUM_POINTS_PER_PLOT, STEP, SAMPLES_PER_REFRESH
-    global EDGE_THRESHOLD
-    global HRBUFFERSIZE, SPO2BUFFERSIZE
-
-    # Start of soft constants. You can adjust soft constants as you see fit.
-
-    if (view == 'short'):
-        # The short view is better for viewing a detailed photoplethysmogram.
-        # Fewer beats are displayed on the screen, but more points are used
-        # to plot each beat.
-        GRAPH_HEIGHT = 680
-        GRAPH_WIDTH = 780
-        WINDOW_HEIGHT = GRAPH_HEIGHT+70
-        WINDOW_WIDTH = GRAPH_WIDTH+20
+# Append the heart rate and SpO2 of every refresh and beat to the trend store
+# in trend_data (see pulseox_trend.py). Needs PROCESS_IN_WORKER_PROCESS off.
+TREND_DATA = False
 
-        BUFFERSIZE = 1500
+# Read from a simulated pulse oximeter instead of the USB device.
+SIMULATED_DEVICE = False
 
-        NUM_POINTS_PER_PLOT = 500 # set this less than BUFFERSIZE for quicker plotting
-        STEP = BUFFERSIZE/NUM_POINTS_PER_PLOT
-        SAMPLES_PER_REFRESH = 15*STEP # must be a multiple of UC_NUM_DATASETS
+# Take a dataset every NTH_SAMPLE ms instead of every 6 ms, or None for the
+# firmware's default. Needs firmware that speaks protocol v2.
+NTH_SAMPLE = None
 
-    elif (view == 'long'):
-        # The long view is better if you'd like to see a longer photoplethysmogram
-        # to monitor respiration. More beats are displayed on the screen, but
-        # fewer points are used to plot each beat.
-        GRAPH_HEIGHT = 680
-        GRAPH_WIDTH = 1210
-        WINDOW_HEIGHT = GRAPH_HEIGHT+70
-        WINDOW_WIDTH = GRAPH_WIDTH+20
+# Path of the calibration profile pulseox_calibrate.py wrote for the device,
+# or None for pulseox_engine.K.
+CALIBRATION = None
 
-        BUFFERSIZE = 12000
+# Process the data in a worker process (see pulseox_parallel.py) so the
+# processing never holds up the reads or the painting.
+PROCESS_IN_WORKER_PROCESS = False
 
-        NUM_POINTS_PER_PLOT = 1000
-        STEP = BUFFERSIZE/NUM_POINTS_PER_PLOT
-        SAMPLES_PER_REFRESH = 10*STEP
 
-    # Beat detection at the edge of the data is unreliable. So any beats beyond
-    # EDGE_THRESHOLD should be discarded. 83 is half the number of samples that
-    # make up one beat at 60 [bpm] when the sample rate is 166.7 Hz.
-    EDGE_THRESHOLD = BUFFERSIZE-round((1/UC_SAMPLE_PERIOD)/2)
+# Zooming in and out of the history with the mouse wheel, and how far in.
+ZOOM_STEP = 1.25 # per notch
+MIN_SPAN = 1.0 # seconds
 
-    # buffer approx. the last 3 seconds
-    HRBUFFERSIZE = int(round(3/(UC_SAMPLE_PERIOD*SAMPLES_PER_REFRESH)))
 
-    # buffer approx. the last 20 seconds
-    SPO2BUFFERSIZE = int(round(20/(UC_SAMPLE_PERIOD*SAMPLES_PER_REFRESH)))
-    # End of soft contants.
+def set_constants(view):
+    # Sets VIEW and the soft constants of the view (GRAPH_WIDTH, BUFFERSIZE,
+    # STEP, ...) as globals for the GUI. See view_constants().
+    global VIEW
+    VIEW = view
+    globals().update(view_constants(view))
 
 
 class MainWindow(QtGui.QWidget):
@@ -125,7 +83,16 @@ class MainWindow(QtGui.QWidget):
 
         set_constants('short')
 
+        if (DEBUG_TIMING == True):
+            self.profiler = Profiler()
+        else:
+            self.profiler = None
+
         self.pod = PulseOxData(self)
+        # of the device, known once it's opened
+        self.sample_period = UC_SAMPLE_PERIOD
+        # everything read, drawn at whatever zoom from a decimation pyramid
+        self.history = History(int(HISTORY_SECONDS/self.sample_period))
 
         self.thread = Worker(self)
         self.status = 'stopped'
@@ -173,45 +140,44 @@ class MainWindow(QtGui.QWidget):
         self.connect(self.button, QtCore.SIGNAL('clicked()'), self.clickedButton)
         self.connect(self.rbshort, QtCore.SIGNAL('toggled(bool)'), self.toggledButton)
         self.connect(self.thread, QtCore.SIGNAL('newData()'), self.newData)
+        self.connect(self.thread, QtCore.SIGNAL('failed(QString)'), self.failed)
 
-        if (DEBUG_DATA == True):
-            self.fo_rawdata = open('debug_data/rawdata.txt', 'w')
+        # opened on the first start, when the sample period is known
+        self.capture = None
+        self.trend = None
+
+    def init_device(self):
+        if (SIMULATED_DEVICE == True):
+            if NTH_SAMPLE is None:
+                self.device = SimulatedDevice()
+            else:
+                self.device = SimulatedDevice(sample_period=NTH_SAMPLE*UC_TIMER_PERIOD)
+        else:
+            self.device = USBDevice(nth_sample=NTH_SAMPLE)
+        if not self.device.open():
+            return False
+
+        # The engine times everything from the sample period, which v1
+        # firmware keeps at its own whatever NTH_SAMPLE asks for.
+        if self.device.sample_period != self.sample_period:
+            self.sample_period = self.device.sample_period
+            self.history = History(int(HISTORY_SECONDS/self.sample_period))
+            self.thread.setup()
+
+        if (DEBUG_DATA == True and self.capture is None):
+            if not os.path.isdir('debug_data'):
+                os.makedirs('debug_data')
+            self.capture = CaptureWriter('debug_data/rawdata.cap',
+                                         sample_period=self.sample_period)
             self.fo_SpO2data = open('debug_data/SpO2data.txt', 'w')
 
-        if (DEBUG_TIMING == True):
-            self.fo_rdtime = open('debug_data/readDatatime.txt', 'w')
-            self.fo_pdtime = open('debug_data/processDatatime.txt', 'w')
-            self.fo_gtime = open('debug_data/Graphtime.txt', 'w')
-
-    def init_USB(self):
-        device_found = False
-        busses = usb.busses()
-        for bus in busses:
-            if device_found == True:
-                break
-            devices = bus.devices
-            for dev in devices:
-                if (dev.idVendor == USB_VID) & (dev.idProduct == USB_PID):
-                    device_found = True
-                    vid = hex(int(dev.idVendor)).upper()
-                    pid = hex(int(dev.idProduct)).upper()
-                    print 'Found vendorid:'+vid+', productid:'+pid+'.'
-                    break
-
-        if device_found == True:
-            self.handle = dev.open()
-            self.handle.setConfiguration(1)
-            self.handle.claimInterface(0)
-        elif device_found == False:
-            vid = hex(USB_VID).upper()
-            pid = hex(USB_PID).upper()
-            print 'Device (vendorid:'+vid+', productid:'+pid+') not found.'
-
-        return device_found
+        if (TREND_DATA == True and self.trend is None):
+            self.trend = TrendWriter('trend_data')
+        return True
 
     def clickedButton(self):
         if self.status == 'stopped':
-            if not self.init_USB():
+            if not self.init_device():
                 return
             self.thread.start()
             self.button.setText('Stop')
@@ -227,43 +193,54 @@ class MainWindow(QtGui.QWidget):
             self.plot.repaint()
 
     def toggledButton(self):
-        if self.status == 'running':
-            self.thread.stop()
-            self.thread.wait()
-            self.status = 'was running'
-            #self.plot.repaint()
-
+        # The views are just sizes of the window and spans of the history
+        # now, so the reads and the processing carry on regardless.
         if (self.rbshort.isChecked() == True):
             set_constants('short')
         elif (self.rblong.isChecked() == True):
             set_constants('long')
 
-        self.thread.setup()
         self.plot.set_width_height()
         self.setMinimumSize(WINDOW_WIDTH, WINDOW_HEIGHT)
         self.setMaximumSize(WINDOW_WIDTH, WINDOW_HEIGHT)
-
-        if self.status == 'was running':
-            if not self.init_USB():
-                return
-            self.thread.start()
-            self.status = 'running'
-            self.plot.repaint()
+        self.plot.repaint()
 
     def newData(self):
         self.plot.repaint()
 
+    def failed(self, message):
+        # the worker thread has already stopped
+        self.thread.wait()
+        self.button.setText('Start')
+        self.status = 'stopped'
+        self.setWindowTitle('Pulse Oximeter (stopped)')
+        self.plot.repaint()
+        QtGui.QMessageBox.warning(self, 'Pulse Oximeter', 'Reading stopped:\n' + message)
+
     def closeEvent(self, event):
         self.thread.stop()
         self.thread.wait()
-        if (DEBUG_DATA == True):
-            self.fo_rawdata.close()
+        if (PROCESS_IN_WORKER_PROCESS == True):
+            self.thread.engine.stop()
+        if (self.capture is not None):
+            self.capture.close()
             self.fo_SpO2data.close()
+        if (self.trend is not None):
+            self.trend.close()
 
         if (DEBUG_TIMING == True):
-            self.fo_rdtime.close()
-            self.fo_pdtime.close()
-            self.fo_gtime.close()
+            print(self.profiler.report())
+
+
+def polygon(points):
+    # Copies an (N, 2) array of x, y into a new QPolygonF through its buffer
+    # instead of appending N QPointFs one at a time. QPointF is two qreals,
+    # which are doubles on the desktop.
+    poly = QtGui.QPolygonF(len(points))
+    buf = poly.data()
+    buf.setsize(points.size*float64().itemsize)
+    frombuffer(buf, dtype=float64).reshape(points.shape)[:] = points
+    return poly
 
 
 class Graph(QtGui.QLabel):
@@ -276,153 +253,235 @@ class Graph(QtGui.QLabel):
 
         self.heart_peak = QtGui.QImage('heart_peak.png')
         self.heart_trough = QtGui.QImage('heart_trough.png')
+
+        # created once instead of every repaint
+        self.font = QtGui.QFont('Serif', 7, QtGui.QFont.Light)
+        self.white = QtGui.QColor(255, 255, 255)
+        self.pen_red = QtGui.QPen(QtGui.QColor(255, 0, 0))
+        self.pen_ir = QtGui.QPen(QtGui.QColor(0, 0, 0))
+        self.pen_marks = QtGui.QPen(QtGui.QColor(0, 255, 0))
+        self.pen_timing = QtGui.QPen(QtGui.QColor(128, 128, 128))
         self.hw = self.heart_peak.width()/2
         self.hh = self.heart_peak.height()
         self.floor_red = (GRAPH_HEIGHT/2)-self.hh
         self.floor_ir = GRAPH_HEIGHT-self.hh
         self.sf = self.floor_red-self.hh
 
+        # The graph shows span samples of the history ending at end, or at
+        # the newest sample if end is None. The wheel zooms about the
+        # pointer, dragging scrolls and a double click goes back to live.
+        self.span = BUFFERSIZE
+        self.end = None
+        self.drag = None
+
     def set_width_height(self):
         self.setMinimumSize(GRAPH_WIDTH, GRAPH_HEIGHT)
         self.setMaximumSize(GRAPH_WIDTH, GRAPH_HEIGHT)
         self.floor_red = (GRAPH_HEIGHT/2)-self.hh
         self.floor_ir = GRAPH_HEIGHT-self.hh
         self.sf = self.floor_red-self.hh # scaling factor
+        self.span = BUFFERSIZE
+
+    def visible(self):
+        # first and last + 1 positions of the history shown
+        history = self.parent.history
+        if self.end is None:
+            end = history.total
+        else:
+            end = max(min(self.end, history.total), history.start + 1)
+        return end - self.span, end
+
+    def view(self, beats):
+        # Everything paintEvent() draws from the history: the visible
+        # positions, the column envelope from the first held position q0
+        # on, starting x0 across, and the positions and samples of the
+        # beat marks shown. Only called through history.consistent() so it
+        # all comes from between the same two pushes of the worker.
+        history = self.parent.history
+        p0, p1 = self.visible()
+        q0 = max(p0, history.start)
+        x0 = GRAPH_WIDTH*float(q0 - p0)/self.span
+        width = max(GRAPH_WIDTH - int(x0), 1)
+        x, lo, hi = history.envelope(q0, p1, width)
+        marks = []
+        if beats is not None:
+            for n in beats:
+                p = history.positions(n)
+                p = p[(p >= q0) & (p < p1)]
+                marks.append((p, history.samples(p)))
+        return p0, p1, x0, width, x, lo, hi, marks, history.total
+
+    def wheelEvent(self, event):
+        history = self.parent.history
+        p0, p1 = self.visible()
+        span = self.span*ZOOM_STEP**(-event.delta()/120.0)
+        span = int(min(max(span, MIN_SPAN/self.parent.sample_period), history.capacity))
+        if self.end is not None:
+            # about the position under the pointer, live stays live
+            at = p0 + self.span*float(event.x())/GRAPH_WIDTH
+            self.end = int(round(at + (p1 - at)*float(span)/self.span))
+        self.span = span
+        self.repaint()
+
+    def mousePressEvent(self, event):
+        self.drag = (event.x(), self.visible()[1])
+
+    def mouseMoveEvent(self, event):
+        if self.drag is None:
+            return
+        x, end = self.drag
+        end -= int(round((event.x() - x)*float(self.span)/GRAPH_WIDTH))
+        self.end = None if end >= self.parent.history.total else end
+        self.repaint()
+
+    def mouseReleaseEvent(self, event):
+        self.drag = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.end = None
+        self.repaint()
 
     def paintEvent(self, event):
         if (DEBUG_TIMING == True):
-            t0 = time.time()
+            t0 = timer()
 
         paint = QtGui.QPainter()
         paint.begin(self)
 
-        font = QtGui.QFont('Serif', 7, QtGui.QFont.Light)
-        paint.setFont(font)
+        paint.setFont(self.font)
 
         size = self.size()
 
         # background
-        paint.setPen(QtGui.QColor(255, 255, 255))
-        paint.setBrush(QtGui.QColor(255, 255, 255))
+        paint.setPen(self.white)
+        paint.setBrush(self.white)
         paint.drawRect(0, 0, size.width(), size.height())
 
-        tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out \
-        = self.parent.pod.getData()
-        self.parent.pod.lock.release()
-
-        plot_red = self.sf*nPPG_red
-        plot_ir = self.sf*nPPG_ir
-
-        # plot red PPG (photoplethysmogram)
-        paint.setPen(QtGui.QColor(255, 0, 0))
-        paint.setBrush(QtGui.QColor(255, 255, 255))
-        for i in range(0, BUFFERSIZE-STEP, STEP):
-            cv = plot_red[i]
-            nv = plot_red[i+STEP]
-            paint.drawLine(tn[i], self.floor_red-cv, tn[i+STEP], self.floor_red-nv)
-
-        # plot IR PPG
-        paint.setPen(QtGui.QColor(0, 0, 0))
-        paint.setBrush(QtGui.QColor(255, 255, 255))
-        for i in range(0, BUFFERSIZE-STEP, STEP):
-            cv = plot_ir[i]
-            nv = plot_ir[i+STEP]
-            paint.drawLine(tn[i], self.floor_ir-cv, tn[i+STEP], self.floor_ir-nv)
-
-        # mark peaks and troughs
-        paint.setPen(QtGui.QColor(0, 255, 0))
-        paint.setBrush(QtGui.QColor(255, 255, 255))
-        if (systole != 'NA' and diastole != 'NA'):
-            for i in range(len(systole)):
-                red_pk = plot_red[systole[i]]
-                ir_pk = plot_ir[systole[i]]
-                t1 = tn[systole[i]]-self.hw
-                paint.drawImage(t1, self.floor_red-(red_pk+self.hh), self.heart_peak)
-                paint.drawImage(t1, self.floor_ir-(ir_pk+self.hh), self.heart_peak)
-
-                if i < len(diastole):
-                    red_th = plot_red[diastole[i]]
-                    ir_th = plot_ir[diastole[i]]
-                    t1 = tn[diastole[i]]-self.hw
-                    paint.drawImage(t1, self.floor_red-red_th, self.heart_trough)
-                    paint.drawImage(t1, self.floor_ir-ir_th, self.heart_trough)
+        hr_out, SpO2_out, beats = self.parent.pod.getData()
+
+        # Each PPG (photoplethysmogram) is drawn as one polyline of the
+        # lowest and highest sample in each pixel column, taken from the
+        # history's decimation pyramid so the time doesn't depend on the
+        # span shown. Before the history is full the span starts part way
+        # across.
+        p0, p1, x0, width, x, lo, hi, marks, total \
+        = self.parent.history.consistent(self.view, beats)
+        if len(x) > 0:
+            bottom, top, norm = envelope_ppgs(lo, hi)
+            x = x*float(GRAPH_WIDTH - x0)/width + x0
+
+            paint.setPen(self.pen_red)
+            paint.drawPolyline(polygon(envelope_points(x, bottom[:, 0], top[:, 0],
+                                                       self.floor_red, self.sf)))
+
+            paint.setPen(self.pen_ir)
+            paint.drawPolyline(polygon(envelope_points(x, bottom[:, 1], top[:, 1],
+                                                       self.floor_ir, self.sf)))
+
+            # mark the peaks and troughs of the newest window that are shown
+            paint.setPen(self.pen_marks)
+            if marks:
+                for (p, samples), image, above in zip(marks, [self.heart_peak, self.heart_trough],
+                                                      [self.hh, 0]):
+                    heights = self.sf*normalize_samples(samples, norm)
+                    for k in range(len(p)):
+                        t1 = GRAPH_WIDTH*(p[k] - p0 + 0.5)/self.span - self.hw
+                        paint.drawImage(t1, self.floor_red-(heights[k, 0]+above), image)
+                        paint.drawImage(t1, self.floor_ir-(heights[k, 1]+above), image)
+
+        paint.setPen(self.pen_timing)
+        sample_period = self.parent.sample_period
+        paint.drawText(5, 12, '%.1f s' % (self.span*sample_period) +
+                       ('' if self.end is None else
+                        ', %.1f s ago' % ((total - p1)*sample_period)))
 
         self.parent.heartrate_label.setText('Heart Rate\n' + hr_out)
         self.parent.SpO2_label.setText('SpO2\n' + SpO2_out)
+
+        if (DEBUG_TIMING == True):
+            paint.setPen(self.pen_timing)
+            paint.drawText(5, size.height()-5, self.parent.profiler.readout())
+
         paint.end()
 
         if (DEBUG_TIMING == True):
-            t1 = time.time()
-            self.parent.fo_gtime.write(str(t1-t0))
-            self.parent.fo_gtime.write('\n')
+            self.parent.profiler.add('paint', timer()-t0)
 
 class PulseOxData():
+    # Hands the results of each refresh from the worker thread to the GUI
+    # thread without a lock. setData() builds a new frame, a tuple that's
+    # never modified after it's published, and swaps it in with a single
+    # assignment. getData() takes whatever frame is current. So the worker
+    # never waits on painting, and a frame that's being painted can't change
+    # underneath the painter because the next one is a different object.
     def __init__(self, parent = None):
-        self.lock = threading.Lock()
+        if parent is not None:
+            self.profiler = parent.profiler
+        else:
+            self.profiler = None
+
+        # version, hr_out, SpO2_out, beats. The PPGs themselves are drawn
+        # from the history.
+        self.frame = (0, 'NA', 'NA', None)
+        self.read_version = 0 # newest version getData() returned
 
-        self.tn = 0
-        self.nPPG_red = 0
-        self.nPPG_ir = 0
-        self.systole = 0
-        self.diastole = 0
-        self.hr_out = 'NA'
-        self.SpO2_out = 'NA'
+        self.dropped = 0 # frames replaced before they were read
+        self.skipped = 0 # frames the reader never saw
+        self.repeated = 0 # frames the reader got more than once
 
     def getData(self):
-        self.lock.acquire()
-        return self.tn, self.nPPG_red, self.nPPG_ir, self.systole, \
-               self.diastole, self.hr_out, self.SpO2_out
-        # lock is released by getData() caller.
-
-    def setData(self, tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out):
-        self.lock.acquire()
-        self.tn = tn
-        self.nPPG_red = nPPG_red
-        self.nPPG_ir = nPPG_ir
-        self.systole = systole
-        self.diastole = diastole
-        self.hr_out = hr_out
-        self.SpO2_out = SpO2_out
-        self.lock.release()
+        frame = self.frame
+        version = frame[0]
+        if version == self.read_version:
+            self.repeated += 1
+        elif version > self.read_version + 1:
+            skipped = version - self.read_version - 1
+            self.skipped += skipped
+            if self.profiler is not None:
+                self.profiler.count('skipped frames', skipped)
+        self.read_version = version
+        return frame[1:]
+
+    def setData(self, hr_out, SpO2_out, beats=None):
+        version = self.frame[0]
+        if self.read_version < version:
+            self.dropped += 1
+            if self.profiler is not None:
+                self.profiler.count('dropped frames')
+        self.frame = (version + 1, hr_out, SpO2_out, beats)
 
 class Worker(QtCore.QThread):
     def __init__(self, parent = None):
         QtCore.QThread.__init__(self, parent)
         self.parent = parent
 
-        self.in_ep = 0x81
-        self.in_ep_size = 60
-
         self.setup()
 
     def setup(self):
-        self.first_loop = True
         self.raw_data_ready = False
         self.plot_data_ready = True
 
-        self.cb_red = array([0]*BUFFERSIZE) # red circular buffer
-        self.cb_ir = array([0]*BUFFERSIZE)  # IR circular buffer
-        self.cb_n = array([0]*BUFFERSIZE)  # sample number circular buffer
-        self.i = 0
-
-        self.heartrate_buffer = [60]*HRBUFFERSIZE
-        self.hrbi = 0
-
-        #self.K = 0.012
-        #self.K = -0.005 # SpO2 calculation calibration constant, offtarget=?
-        self.K = -0.024542 # SpO2 calculation calibration constant, offtarget=97, 98.7
-        #self.K = -0.036883 # SpO2 calculation calibration constant, offtarget=96.5
-        #self.K = -0.049273 # SpO2 calculation calibration constant, offtarget=96
-
-        self.SpO2_buffer = [98]*SPO2BUFFERSIZE
-        self.SpO2bi = 0
+        if (CALIBRATION is not None):
+            profile = load_profile(CALIBRATION)
+            calibration = dict(K=profile['K'], curve=profile['curve'])
+        else:
+            calibration = {}
+
+        if (PROCESS_IN_WORKER_PROCESS == True):
+            if hasattr(self, 'engine'):
+                self.engine.stop()
+            self.engine = ProcessEngine(VIEW, incremental=INCREMENTAL_PROCESSING,
+                                        sample_period=self.parent.sample_period,
+                                        profiler=self.parent.profiler, filter=FILTER_PPG,
+                                        **calibration)
+            self.engine.start()
+        else:
+            self.engine = PulseOxEngine(VIEW, incremental=INCREMENTAL_PROCESSING,
+                                        sample_period=self.parent.sample_period,
+                                        profiler=self.parent.profiler, filter=FILTER_PPG,
+                                        **calibration)
 
-        tn = float(GRAPH_WIDTH)*array(range(BUFFERSIZE))/(BUFFERSIZE-1)
-        nPPG_red = array([0.5*sin(2*pi*(1/150.0)*i)+0.5 for i in range(BUFFERSIZE)])
-        nPPG_ir = nPPG_red
-        systole, diastole = self.peakdet(nPPG_red, 0.25)
-        systole = systole[:-1]
-        self.parent.pod.setData(tn, nPPG_red, nPPG_ir, systole, diastole, 'NA', 'NA')
+        self.parent.pod.setData('NA', 'NA')
 
         self.read_t0 = 0
 
@@ -432,35 +491,37 @@ class Worker(QtCore.QThread):
     def run(self):
         self.thread_run = True
 
-        while self.thread_run:
-            read_t1 = time.time()
-            # A Timer object was being used but it has the problem that if one
-            # timer's call is delayed nearly the entire timer period then
-            # another call can follow just moments after the first call
-            # finishes. If that happens duplicate data would be read.
-            if (read_t1 - self.read_t0 > READ_PERIOD):
+        # The reader thread sleeps until each read is due and queues the
+        # packets, so this thread only wakes up when there's data and a slow
+        # processData() doesn't delay the next read. Because the deadlines
+        # are kept by the reader the reads don't drift or get repeated if
+        # one is late.
+        period, late = read_timing(self.parent.device)
+        self.reader = Reader(self.parent.device, period, self.parent.profiler, late=late)
+        self.reader.start()
+
+        # get() raises the reader's device error. It, or one decoding or
+        # processing a read, ends the thread and is shown by the window.
+        try:
+            while self.thread_run:
+                reads = self.reader.get(0.5)
+                if not reads:
+                    if not self.reader.is_alive():
+                        break
+                    continue
+
                 # This sets raw_data_ready to True after several
-                # calls once there's enough new raw data to process.
-                self.readData()
+                # reads once there's enough new raw data to process.
+                for read_t0, data in reads:
+                    self.read_t0 = read_t0
+                    # heart beat --> more blood in light path --> more light absorbed
+                    # --> less light detected by sensor --> lower frequency output
+                    self.storeDatasets(decode_packets(data, self.parent.device.protocol))
 
                 if (self.raw_data_ready == True):
                     self.raw_data_ready = False
 
-                    # refresh so the GUI doesn't become unresponsive
-                    #app.processEvents()
-
-                    # Unroll the circular buffers and assign the data to new
-                    # variables to indicate we're working with intensity. This
-                    # is still the frequency data output from the TSL230 but
-                    # it's proprotional to intensity.
-                    Ired = self.cb_red[self.i:]
-                    Ired = append(Ired, self.cb_red[:self.i])
-                    Iir = self.cb_ir[self.i:]
-                    Iir = append(Iir, self.cb_ir[:self.i])
-                    n = self.cb_n[self.i:]
-                    n = append(n, self.cb_n[:self.i])
-
-                    self.processData(n, Ired, Iir)
+                    self.processData()
 
                     # Because processing and plotting data take some time, it's
                     # better to do them separately and plot the data one timer
@@ -475,260 +536,47 @@ class Worker(QtCore.QThread):
                     #self.parent.plot.repaint()
                     # Is this better? What about timing?
                     self.emit(QtCore.SIGNAL('newData()'))
-
-
-    def readData(self):
-        if (DEBUG_TIMING == True):
-            t1 = time.time()
-            self.parent.fo_rdtime.write(str(t1-self.read_t0))
-            self.parent.fo_rdtime.write('\n')
-
-        self.read_t0 = time.time()
-
-        # rawdata holds the frequency data output from the TSL230
-        # smoothed by a moving average
-        data = self.parent.handle.interruptRead(self.in_ep, self.in_ep_size, 800)
-
-        # heart beat --> more blood in light path --> more light absorbed
-        # --> less light detected by sensor --> lower frequency output
-
-        # dataset 0
-        self.cb_red[self.i] = (data[3]<<24)+(data[2]<<16)+(data[1]<<8)+data[0]
-        self.cb_ir[self.i] = (data[7]<<24)+(data[6]<<16)+(data[5]<<8)+data[4]
-        self.cb_n[self.i] = (data[11]<<24)+(data[10]<<16)+(data[9]<<8)+data[8]
-
-        # This makes for a nicer plot. Otherwise the the traces would be too
-        # small to see until all the initial zeroes in the buffer are replaced
-        # with new data.
-        if (self.first_loop == True):
-            self.first_loop = False
-            self.cb_red[:] = self.cb_red[0]
-            self.cb_ir[:] = self.cb_ir[0]
-            cb_n0 = self.cb_n[0]
-            self.cb_n[:] = range(cb_n0-len(self.cb_n), cb_n0)
-            self.cb_n[0] = cb_n0
-
-        # dataset 1
-        self.cb_red[self.i+1] = (data[15]<<24)+(data[14]<<16)+(data[13]<<8)+data[12]
-        self.cb_ir[self.i+1] = (data[19]<<24)+(data[18]<<16)+(data[17]<<8)+data[16]
-        self.cb_n[self.i+1] = (data[23]<<24)+(data[22]<<16)+(data[21]<<8)+data[20]
-
-        # dataset 2
-        self.cb_red[self.i+2] = (data[27]<<24)+(data[26]<<16)+(data[25]<<8)+data[24]
-        self.cb_ir[self.i+2] = (data[31]<<24)+(data[30]<<16)+(data[29]<<8)+data[28]
-        self.cb_n[self.i+2] = (data[35]<<24)+(data[34]<<16)+(data[33]<<8)+data[32]
-
-        # dataset 3
-        self.cb_red[self.i+3] = (data[39]<<24)+(data[38]<<16)+(data[37]<<8)+data[36]
-        self.cb_ir[self.i+3] = (data[43]<<24)+(data[42]<<16)+(data[41]<<8)+data[40]
-        self.cb_n[self.i+3] = (data[47]<<24)+(data[46]<<16)+(data[45]<<8)+data[44]
-
-        # dataset 4
-        self.cb_red[self.i+4] = (data[51]<<24)+(data[50]<<16)+(data[49]<<8)+data[48]
-        self.cb_ir[self.i+4] = (data[55]<<24)+(data[54]<<16)+(data[53]<<8)+data[52]
-        self.cb_n[self.i+4] = (data[59]<<24)+(data[58]<<16)+(data[57]<<8)+data[56]
-
+        except Exception as e:
+            self.emit(QtCore.SIGNAL('failed(QString)'), str(e))
+        finally:
+            self.reader.stop()
+
+    def storeDatasets(self, datasets):
+        # datasets is an (N, 3) array of (red, IR, sample number) rows ordered
+        # oldest to newest. N is UC_NUM_DATASETS for a single read but may be
+        # any multiple of it when several queued packets are decoded at once.
+        # The engine uses the sample numbers to drop datasets that were
+        # already read and fill in ones that were missed.
         if (DEBUG_DATA == True):
-            self.parent.fo_rawdata.write(' '+str(self.read_t0)+ \
-            ' '+str(self.cb_n[self.i])+' '+str(self.cb_red[self.i])+ \
-            ' '+str(self.cb_ir[self.i]))
-            self.parent.fo_rawdata.write('\n')
-
-            self.parent.fo_rawdata.write(' '+str(self.read_t0)+ \
-            ' '+str(self.cb_n[self.i+1])+' '+str(self.cb_red[self.i+1])+ \
-            ' '+str(self.cb_ir[self.i+1]))
-            self.parent.fo_rawdata.write('\n')
-
-            self.parent.fo_rawdata.write(' '+str(self.read_t0)+ \
-            ' '+str(self.cb_n[self.i+2])+' '+str(self.cb_red[self.i+2])+ \
-            ' '+str(self.cb_ir[self.i+2]))
-            self.parent.fo_rawdata.write('\n')
-
-            self.parent.fo_rawdata.write(' '+str(self.read_t0)+ \
-            ' '+str(self.cb_n[self.i+3])+' '+str(self.cb_red[self.i+3])+ \
-            ' '+str(self.cb_ir[self.i+3]))
-            self.parent.fo_rawdata.write('\n')
-
-            self.parent.fo_rawdata.write(' '+str(self.read_t0)+ \
-            ' '+str(self.cb_n[self.i+4])+' '+str(self.cb_red[self.i+4])+ \
-            ' '+str(self.cb_ir[self.i+4]))
-            self.parent.fo_rawdata.write('\n')
-
-        self.i = (self.i + 5) % BUFFERSIZE # index of the oldest sample
-
-        if (self.i % SAMPLES_PER_REFRESH == 0):
+            self.parent.capture.append(self.read_t0, datasets)
+        self.parent.history.push(datasets)
+
+        if self.engine.push(datasets):
             self.raw_data_ready = True
 
-    def processData(self, n, Ired, Iir):
+    def processData(self):
         if (DEBUG_TIMING == True):
-            t0 = time.time()
+            t0 = timer()
 
-        tn = float(GRAPH_WIDTH)*(n - n[0])/(n[-1] - n[0])
+        result = self.engine.process()
+        if result is None:
+            # the worker process's frame was already collected
+            return
+        hr_out, SpO2_out = result[5:7]
+        self.parent.pod.setData(hr_out, SpO2_out, self.engine.beats)
 
-        # photoplethysmograms
-        PPG_red = -1*log(Ired/float(max(Ired)))
-        PPG_ir = -1*log(Iir/float(max(Iir)))
+        if (DEBUG_DATA == True and self.engine.SpO2 is not None):
+            self.parent.fo_SpO2data.write(' '+str(time.time())+' '+str(self.engine.SpO2_beats))
+            self.parent.fo_SpO2data.write('\n')
 
-        mxr = float(max(PPG_red))
-        mxi = float(max(PPG_ir))
-
-        if (mxr > mxi):
-            nf = mxr
-        else:
-            nf = mxi
-
-        # limiting the normalization factor will prevent the traces from getting
-        # too small but may cause them to overlap.
-        #if (nf > 0.10):
-        #   nf = 0.10
-
-        # normalize PPGs for plotting
-        nPPG_red = PPG_red/nf
-        nPPG_ir = PPG_ir/nf
-
-        # Locate heartbeats
-        # systole - PPG peak (heartbeat), intensity trough
-        # diastole - PPG trough, intensity peak
-        # Find peaks on mean of normalized PPGs so delta can be constant
-        # and differences in the peak locations on the separate PPGs are
-        # averaged out.
-        #systole, diastole = self.peakdet(((PPG_red/mxr)+(PPG_ir/mxi)), 0.5)
-        #systole, diastole = self.peakdet(((PPG_red/mxr)+(PPG_ir/mxi)), 0.25)
-        systole, diastole = self.peakdet(((PPG_red/mxr)+(PPG_ir/mxi)), 0.15)
-        if (len(systole) > 2 and len(diastole) > 2):
-
-            # last PPG peak found is wrong if it's near the end of the data
-            if (systole[-1] > EDGE_THRESHOLD):
-                systole = systole[:-1]
-
-            # last PPG trough found is wrong if it's near the end of the data
-            if (diastole[-1] > EDGE_THRESHOLD):
-                diastole = diastole[:-1]
-
-            # to be consistent when calculating R, the first PPG 
-            # trough should always be after the first PPG peak
-            if (diastole[0] <= systole[0]):
-                diastole = diastole[1:]
-
-            time_elapsed = UC_SAMPLE_PERIOD*(n[systole[-1]] - n[systole[0]])
-            self.heartrate_buffer[self.hrbi] = 60*(len(systole)-1)/time_elapsed
-            self.hrbi = (self.hrbi + 1) % HRBUFFERSIZE
-            hr_out = str(int(round(median(self.heartrate_buffer))))
-
-            SpO2 = []
-            for i in range(len(diastole)):
-                # Introduction to Pulse oximetry, Sagar G V, August 21, 2012
-                # page 4
-                # R = ln(I_rxR_peak/I_rxR_trough)/ln(I_rxIR_peak/I_rxIR_trough) Eq. 7
-                # for red LED light at 660 nm and infrared LED light at 940 nm:
-                # SpO2 = ((0.81 - 0.18*R)./(0.63 + 0.11*R))*100%
-                #
-                # Intensity peaks occur during diastole and troughs
-                # during systole
-
-                # 5 points surrounding intensity trough
-                rs = range(systole[i]-2, systole[i]+3)
-
-                Rred = log(Ired[diastole[i]]/mean(Ired[rs]))
-                Rir = log(Iir[diastole[i]]/mean(Iir[rs]))
-                R = Rred/Rir
-
-                #SpO2new = 100*(0.81 - 0.18*R[-1])/(0.63 + 0.11*R[-1])
-                #SpO2new = 5.05*R[-1]**2 - 47.62*R[-1] + 129.57 # 96 --> 98.1 ***
-                SpO2new = 100*(0.81 - 0.18*(R+self.K))/(0.63 + 0.11*(R+self.K))
-
-                if (SpO2new > 85 and SpO2new < 100):
-                    SpO2.append(SpO2new)
-
-            mSpO2 = median(SpO2)
-            if not isnan(mSpO2):
-                self.SpO2_buffer[self.SpO2bi] = mSpO2
-                self.SpO2bi = (self.SpO2bi + 1) % SPO2BUFFERSIZE
-                SpO2_out = str( round(median(self.SpO2_buffer)*10)/10 )
-
-                if (DEBUG_DATA == True):
-                    self.parent.fo_SpO2data.write(' '+str(time.time())+' '+str(SpO2))
-                    self.parent.fo_SpO2data.write('\n')
-            else:
-                SpO2_out = '--'
-        else:
-            systole = 'NA'
-            diastole = 'NA'
-            hr_out = 'NA'
-            SpO2_out = 'NA'
-
-        self.parent.pod.setData(tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out)
+        if (TREND_DATA == True):
+            self.parent.trend.add(self.engine, self.read_t0)
 
         if (DEBUG_TIMING == True):
-            t1 = time.time()
-            self.parent.fo_pdtime.write(str(t1-t0))
-            self.parent.fo_pdtime.write('\n')
-
-    def peakdet(self, v, delta):
-        """
-        Converted from MATLAB script at http://billauer.co.il/peakdet.html
-    
-        Returns two arrays
-    
-        function [maxtab, mintab]=peakdet(v, delta, x)
-        %PEAKDET Detect peaks in a vector
-        %        [MAXTAB, MINTAB] = PEAKDET(V, DELTA) finds the local
-        %        maxima and minima ("peaks") in the vector V.
-        %        MAXTAB and MINTAB consists of two columns. Column 1
-        %        contains indices in V, and column 2 the found values.
-        %      
-        %        With [MAXTAB, MINTAB] = PEAKDET(V, DELTA, X) the indices
-        %        in MAXTAB and MINTAB are replaced with the corresponding
-        %        X-values.
-        %
-        %        A point is considered a maximum peak if it has the maximal
-        %        value, and was preceded (to the left) by a value lower by
-        %        DELTA.
-    
-        % Eli Billauer, 3.4.05 (Explicitly not copyrighted).
-        % This function is released to the public domain; Any use is allowed.
-        """
-
-        maxtab = []
-        mintab = []
-
-        if not isscalar(delta):
-            sys.exit('Input argument delta must be a scalar')
-
-        if delta <= 0:
-            sys.exit('Input argument delta must be positive')
-
-        mn, mx = Inf, -Inf
-        mnpos, mxpos = NaN, NaN
-
-        lookformax = True
-        L = len(v)
-        for i in arange(1,L+1):
-            # detects heart beats better by scanning from right to left
-            this = v[-i]
-            if this > mx:
-                mx = this
-                mxpos = L-i
-            if this < mn:
-                mn = this
-                mnpos = L-i
-
-            if lookformax:
-                if this < mx-delta:
-                    maxtab.insert(0, mxpos) # lower indices are more to the left
-                    mn = this
-                    mnpos = L-i
-                    lookformax = False
-            else:
-                if this > mn+delta:
-                    mintab.insert(0, mnpos)
-                    mx = this
-                    mxpos = L-i
-                    lookformax = True
-
-        return maxtab, mintab
-
-app = QtGui.QApplication(sys.argv)
-mw = MainWindow()
-mw.show()
-app.exec_()
+            self.parent.profiler.add('processData', timer()-t0)
+
+if __name__ == '__main__':
+    app = QtGui.QApplication(sys.argv)
+    mw = MainWindow()
+    mw.show()
+    app.exec_()
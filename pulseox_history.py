@@ -0,0 +1,236 @@
+'''
+The raw intensities of a long session and a min/max decimation pyramid over
+them, so a graph of any stretch of it can be drawn without going through
+every sample.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Level 0 of the pyramid is the samples themselves. Each bucket of level k is
+the minimum and maximum of DECIMATION buckets of level k-1, so it covers
+DECIMATION**k samples. Every level is a ring buffer of the same length of
+time, and a push only recomputes the buckets its samples fall in, which
+is a few per level however long the history is.
+
+To draw the samples between two positions in a graph width pixels wide the
+coarsest level with buckets no wider than a pixel column is used, so each
+column is reduced from at most DECIMATION buckets. A few beats are drawn
+from the samples themselves and hours from the top of the pyramid, in about
+the same time. A column's edges are rounded to its level's buckets, which
+moves them by less than a column.
+
+Positions count the datasets pushed, after the ingest stage. They're the
+same as the sample numbers unless there were gaps in the data, which are
+left out, so the sample number of every position is kept too.
+
+    history = History(int(HISTORY_SECONDS/UC_SAMPLE_PERIOD))
+    history.push(datasets) # as they're read
+    x, lo, hi = history.envelope(history.total - 3000, history.total, 780)
+
+The history is written by one thread and may be read by others without a
+lock. version is odd while a push is writing, and every method returns
+copies, so a reader that calls them through consistent() gets results that
+all come from between the same two pushes. A read that a push overlapped is
+simply done again, which is rare since a push takes a fraction of a
+millisecond every read period.
+
+    x, lo, hi = history.consistent(history.envelope, p0, p1, 780)
+'''
+
+import time
+
+from numpy import arange, asarray, empty, int32, int64, maximum, minimum, searchsorted, zeros
+
+from pulseox_ingest import Ingest
+from pulseox_protocol import IR, RED, SAMPLE_NUM
+
+HISTORY_SECONDS = 4*3600 # seconds, about 50 MB at 166.7 samples/s
+DECIMATION = 4 # buckets of a level per bucket of the next
+MIN_BUCKETS = 256 # the top level has at least this many buckets
+
+
+def _ring(start, stop, size):
+    # indexes positions start to stop of a ring buffer of size, with a
+    # slice unless they wrap around
+    i = start % size
+    if i + stop - start <= size:
+        return slice(i, i + stop - start)
+    return arange(start, stop) % size
+
+
+class History():
+    """
+    The last capacity (red, IR) samples pushed and their sample numbers,
+    with a min/max pyramid. capacity is rounded up to a whole number of
+    buckets of the top level.
+
+    If ingest is True the datasets pushed are passed through a
+    pulseox_ingest.Ingest first, like PulseOxEngine's, so the history
+    can be fed the reads directly.
+    """
+
+    def __init__(self, capacity, factor=DECIMATION, ingest=True, profiler=None):
+        self.factor = factor
+        self.levels = 1
+        while capacity//factor**self.levels >= MIN_BUCKETS:
+            self.levels += 1
+        top = factor**(self.levels - 1)
+        self.capacity = -(-capacity//top)*top
+
+        self.n = zeros(self.capacity, dtype=int64)
+        # lo[k] and hi[k] are the (red, IR) min and max of the buckets of
+        # level k. Level 0 is the samples, lo[0] and hi[0] the same array.
+        samples = zeros((self.capacity, 2), dtype=int32)
+        self.lo = [samples]
+        self.hi = [samples]
+        for k in range(1, self.levels):
+            size = self.capacity//factor**k
+            self.lo.append(zeros((size, 2), dtype=int32))
+            self.hi.append(zeros((size, 2), dtype=int32))
+
+        if ingest:
+            self.ingest = Ingest(profiler=profiler)
+        else:
+            self.ingest = None
+        self.total = 0 # datasets pushed
+        self.version = 0 # pushes started plus pushes finished
+
+    @property
+    def start(self):
+        """
+        The oldest position every level still holds.
+        """
+
+        top = self.factor**(self.levels - 1)
+        return max(0, ((self.total - 1)//top + 1)*top - self.capacity)
+
+    def push(self, datasets):
+        """
+        Appends an (N, 3) array of (red, IR, sample number) rows ordered
+        oldest to newest.
+        """
+
+        if self.ingest is not None:
+            datasets = self.ingest.process(datasets)
+        num = len(datasets)
+        if num == 0:
+            return
+        self.version += 1
+        first = self.total
+        total = first + num
+        if num > self.capacity:
+            datasets = datasets[num - self.capacity:]
+            first = total - self.capacity
+
+        i = _ring(first, total, self.capacity)
+        self.n[i] = datasets[:, SAMPLE_NUM]
+        self.lo[0][i, 0] = datasets[:, RED]
+        self.lo[0][i, 1] = datasets[:, IR]
+
+        # the buckets of each level the new samples fall in, reduced from
+        # the buckets of the level below
+        for k in range(1, self.levels):
+            a = first//self.factor**k
+            b = (total - 1)//self.factor**k + 1
+            below = -(-total//self.factor**(k - 1))
+            j = _ring(a*self.factor, min(b*self.factor, below), len(self.lo[k - 1]))
+            i = _ring(a, b, len(self.lo[k]))
+            if b - a == 1:
+                self.lo[k][i] = self.lo[k - 1][j].min(axis=0)
+                self.hi[k][i] = self.hi[k - 1][j].max(axis=0)
+            else:
+                starts = arange(0, min(b*self.factor, below) - a*self.factor, self.factor)
+                self.lo[k][i] = minimum.reduceat(self.lo[k - 1][j], starts)
+                self.hi[k][i] = maximum.reduceat(self.hi[k - 1][j], starts)
+
+        self.total = total
+        self.version += 1
+
+    def consistent(self, read, *args):
+        """
+        Returns read(*args), done again until no push started or finished
+        while it ran. read should only read the history through its methods
+        and attributes, which return copies.
+        """
+
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                result = read(*args)
+                if self.version == version:
+                    return result
+            # lets the writer finish
+            time.sleep(0)
+
+    def level(self, span, width):
+        """
+        Returns the coarsest level with buckets no wider than a column when
+        span samples are drawn width columns wide.
+        """
+
+        k = 0
+        while k + 1 < self.levels and self.factor**(k + 1)*width <= span:
+            k += 1
+        return k
+
+    def envelope(self, p0, p1, width):
+        """
+        Returns x, lo, hi for drawing the samples at positions p0 to p1
+        width pixels wide. lo and hi are (N, 2) arrays of the (red, IR)
+        minimum and maximum of each of N pixel columns at the x coordinates
+        x. If there are fewer samples than columns they're the samples
+        themselves, lo and hi the same. p0 and p1 are clipped to what's
+        held. N is 0 if there's nothing there.
+        """
+
+        p0 = max(p0, self.start)
+        p1 = min(p1, self.total)
+        span = p1 - p0
+        if span <= 0:
+            return empty(0), empty((0, 2), dtype=int32), empty((0, 2), dtype=int32)
+
+        k = self.level(span, width)
+        if k == 0 and span <= 2*width:
+            samples = self.lo[0][arange(p0, p1) % self.capacity]
+            return (arange(span) + 0.5)*float(width)/span, samples, samples
+
+        # the first bucket of each column, which are all different since
+        # the buckets are no wider than the columns
+        size = self.factor**k
+        a = p0//size
+        starts = (p0 + (arange(width)*span)//width)//size - a
+        i = arange(a, (p1 - 1)//size + 1) % len(self.lo[k])
+        lo = minimum.reduceat(self.lo[k][i], starts)
+        hi = maximum.reduceat(self.hi[k][i], starts)
+        return arange(width) + 0.5, lo, hi
+
+    def samples(self, positions):
+        """
+        Returns the (red, IR) samples at positions as an (N, 2) array.
+        """
+
+        return self.lo[0][asarray(positions, dtype=int64) % self.capacity]
+
+    def sample_numbers(self, positions):
+        return self.n[asarray(positions, dtype=int64) % self.capacity]
+
+    def positions(self, n):
+        """
+        Returns the positions of the samples with sample numbers n, or -1
+        for those that aren't held.
+        """
+
+        n = asarray(n, dtype=int64)
+        start, total = self.start, self.total
+        out = zeros(len(n), dtype=int64) - 1
+        if total == start or len(n) == 0:
+            return out
+        # the samples held are in order in at most two pieces of the ring
+        i, j = start % self.capacity, (total - 1) % self.capacity + 1
+        pieces = [(start, i, j)] if i < j else [(start, i, self.capacity),
+                                                (start + self.capacity - i, 0, j)]
+        for p, i, j in pieces:
+            k = searchsorted(self.n[i:j], n)
+            found = (k < j - i)
+            found[found] = self.n[i:j][k[found]] == n[found]
+            out[found] = p + k[found]
+        return out
@@ -0,0 +1,307 @@
+'''
+Draws polylines, images and text into PNG and SVG files without PyQt4 or a
+display, with nothing but numpy and zlib.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A Raster is an RGB image held in a (height, width, 3) uint8 array. Lines
+are drawn a pixel wide by stepping along every segment of a polyline a
+pixel at a time, all the segments at once, which for the min/max columns
+of pulseox_render.envelope_points() is a few thousand pixels per trace.
+RGBA images like heart_peak.png are blended in by their alpha, and text is
+drawn with FONT, a 3x5 pixel font of the digits, capitals and the few
+other characters the reports use, scaled up. An SVG takes the same calls
+and writes them out as vector elements, with the images embedded.
+
+    raster = Raster(1210, 170)
+    raster.polyline(points, RED)
+    raster.image(read_png('heart_peak.png'), x, y)
+    raster.text(5, 5, 'HR 72', GREY)
+    raster.save('sheet.png')
+'''
+
+import base64
+import struct
+import zlib
+
+from numpy import abs as np_abs, arange, asarray, concatenate, cumsum, float64, frombuffer, \
+                  int64, isfinite, maximum, ones, round as np_round, uint8, zeros
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {2: 3, 6: 4} # colour type: channels, 8 bit RGB and RGBA only
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+GREY = (128, 128, 128)
+
+# 3x5 glyphs, rows top to bottom
+FONT = {
+    '0': ('###', '#.#', '#.#', '#.#', '###'), '1': ('.#.', '##.', '.#.', '.#.', '###'),
+    '2': ('###', '..#', '###', '#..', '###'), '3': ('###', '..#', '.##', '..#', '###'),
+    '4': ('#.#', '#.#', '###', '..#', '..#'), '5': ('###', '#..', '###', '..#', '###'),
+    '6': ('###', '#..', '###', '#.#', '###'), '7': ('###', '..#', '..#', '.#.', '.#.'),
+    '8': ('###', '#.#', '###', '#.#', '###'), '9': ('###', '#.#', '###', '..#', '###'),
+    'A': ('.#.', '#.#', '###', '#.#', '#.#'), 'B': ('##.', '#.#', '##.', '#.#', '##.'),
+    'C': ('.##', '#..', '#..', '#..', '.##'), 'D': ('##.', '#.#', '#.#', '#.#', '##.'),
+    'E': ('###', '#..', '##.', '#..', '###'), 'F': ('###', '#..', '##.', '#..', '#..'),
+    'G': ('.##', '#..', '#.#', '#.#', '.##'), 'H': ('#.#', '#.#', '###', '#.#', '#.#'),
+    'I': ('###', '.#.', '.#.', '.#.', '###'), 'J': ('..#', '..#', '..#', '#.#', '.#.'),
+    'K': ('#.#', '#.#', '##.', '#.#', '#.#'), 'L': ('#..', '#..', '#..', '#..', '###'),
+    'M': ('#.#', '###', '###', '#.#', '#.#'), 'N': ('##.', '#.#', '#.#', '#.#', '#.#'),
+    'O': ('.#.', '#.#', '#.#', '#.#', '.#.'), 'P': ('##.', '#.#', '##.', '#..', '#..'),
+    'Q': ('.#.', '#.#', '#.#', '##.', '.##'), 'R': ('##.', '#.#', '##.', '#.#', '#.#'),
+    'S': ('.##', '#..', '.#.', '..#', '##.'), 'T': ('###', '.#.', '.#.', '.#.', '.#.'),
+    'U': ('#.#', '#.#', '#.#', '#.#', '###'), 'V': ('#.#', '#.#', '#.#', '#.#', '.#.'),
+    'W': ('#.#', '#.#', '###', '###', '#.#'), 'X': ('#.#', '#.#', '.#.', '#.#', '#.#'),
+    'Y': ('#.#', '#.#', '.#.', '.#.', '.#.'), 'Z': ('###', '..#', '.#.', '#..', '###'),
+    ':': ('...', '.#.', '...', '.#.', '...'), '.': ('...', '...', '...', '...', '.#.'),
+    '-': ('...', '...', '###', '...', '...'), '+': ('...', '.#.', '###', '.#.', '...'),
+    '%': ('#.#', '..#', '.#.', '#..', '#.#'), '/': ('..#', '..#', '.#.', '#..', '#..'),
+    '(': ('.#.', '#..', '#..', '#..', '.#.'), ')': ('.#.', '..#', '..#', '..#', '.#.'),
+    '_': ('...', '...', '...', '...', '###'), ',': ('...', '...', '...', '.#.', '#..'),
+    ' ': ('...', '...', '...', '...', '...'),
+}
+GLYPH_WIDTH = 3 # pixels before scaling
+GLYPH_HEIGHT = 5
+TEXT_SCALE = 2
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+           struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def png_bytes(pixels):
+    """
+    Returns the PNG file of an (height, width, 3) RGB or (height, width, 4)
+    RGBA uint8 array.
+    """
+
+    pixels = asarray(pixels, dtype=uint8)
+    height, width, channels = pixels.shape
+    colour = 2 if channels == 3 else 6
+    # every row unfiltered, filter type 0
+    rows = concatenate([zeros((height, 1), dtype=uint8),
+                        pixels.reshape(height, width*channels)], axis=1)
+    header = struct.pack('>IIBBBBB', width, height, 8, colour, 0, 0, 0)
+    return PNG_SIGNATURE + _chunk(b'IHDR', header) + \
+           _chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + _chunk(b'IEND', b'')
+
+
+def write_png(path, pixels):
+    with open(path, 'wb') as fo:
+        fo.write(png_bytes(pixels))
+
+
+def read_png(path):
+    """
+    Returns an (height, width, 4) RGBA uint8 array of an 8 bit RGB or RGBA
+    non-interlaced PNG file, fully opaque if it's RGB. Meant for small
+    images like the heart markers, the filters are undone a byte at a time.
+    """
+
+    with open(path, 'rb') as fi:
+        data = fi.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('%s is not a PNG file' % path)
+
+    k = 8
+    idat = []
+    while k < len(data):
+        length, = struct.unpack('>I', data[k:k+4])
+        kind = data[k+4:k+8]
+        body = data[k+8:k+8+length]
+        if kind == b'IHDR':
+            width, height, depth, colour, _, _, interlace = struct.unpack('>IIBBBBB', body)
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+        k += 12 + length
+    if depth != 8 or colour not in PNG_CHANNELS or interlace != 0:
+        raise ValueError('%s is not an 8 bit RGB or RGBA non-interlaced PNG' % path)
+
+    bpp = PNG_CHANNELS[colour]
+    stride = width*bpp
+    raw = bytearray(zlib.decompress(b''.join(idat)))
+    out = bytearray(height*stride)
+    prior = bytearray(stride)
+    for y in range(height):
+        kind = raw[y*(stride + 1)]
+        line = raw[y*(stride + 1) + 1:(y + 1)*(stride + 1)]
+        for i in range(stride):
+            a = line[i - bpp] if i >= bpp else 0
+            b = prior[i]
+            if kind == 1:
+                line[i] = (line[i] + a) & 0xff
+            elif kind == 2:
+                line[i] = (line[i] + b) & 0xff
+            elif kind == 3:
+                line[i] = (line[i] + (a + b)//2) & 0xff
+            elif kind == 4:
+                c = prior[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    line[i] = (line[i] + a) & 0xff
+                elif pb <= pc:
+                    line[i] = (line[i] + b) & 0xff
+                else:
+                    line[i] = (line[i] + c) & 0xff
+        out[y*stride:(y + 1)*stride] = line
+        prior = line
+
+    pixels = frombuffer(bytes(out), dtype=uint8).reshape(height, width, bpp)
+    if bpp == 3:
+        pixels = concatenate([pixels, 255*ones((height, width, 1), dtype=uint8)], axis=2)
+    return pixels
+
+
+def line_pixels(points):
+    """
+    Returns the x and y of the pixels along a polyline through an (N, 2)
+    array of points, a pixel per step along the longer axis of each segment.
+    """
+
+    points = asarray(points, dtype=float64)
+    points = points[isfinite(points).all(axis=1)]
+    if len(points) == 0:
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    if len(points) == 1:
+        p = np_round(points).astype(int64)
+        return p[:, 0], p[:, 1]
+
+    start = points[:-1]
+    delta = points[1:] - start
+    steps = maximum(np_abs(delta).max(axis=1).astype(int64), 1)
+    total = int(steps.sum())
+    # the step each pixel is along its segment, from 0 to steps-1, then the
+    # last point
+    segment = steps.cumsum()
+    first = concatenate([[0], segment[:-1]])
+    index = zeros(total, dtype=int64)
+    index[first[1:]] = 1
+    index = cumsum(index)
+    along = (arange(total) - first[index])/steps[index].astype(float64)
+    x = start[index, 0] + along*delta[index, 0]
+    y = start[index, 1] + along*delta[index, 1]
+    x = concatenate([x, points[-1:, 0]])
+    y = concatenate([y, points[-1:, 1]])
+    return np_round(x).astype(int64), np_round(y).astype(int64)
+
+
+def _glyphs(text):
+    # the FONT glyphs of text as 5x3 boolean arrays, lower case as capitals
+    out = []
+    for c in text.upper():
+        rows = FONT.get(c, FONT[' '])
+        out.append(asarray([[ch == '#' for ch in row] for row in rows]))
+    return out
+
+
+class Raster():
+    """
+    An RGB image width by height pixels filled with background.
+    """
+
+    def __init__(self, width, height, background=WHITE):
+        self.width = width
+        self.height = height
+        self.pixels = zeros((height, width, 3), dtype=uint8)
+        self.pixels[:, :] = background
+
+    def polyline(self, points, colour):
+        x, y = line_pixels(points)
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        self.pixels[y[inside], x[inside]] = colour
+
+    def image(self, rgba, x, y):
+        """
+        Blends an (h, w, 4) RGBA image in with its top left corner at x, y.
+        """
+
+        h, w = rgba.shape[:2]
+        x, y = int(round(x)), int(round(y))
+        # the part inside
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        src = rgba[y0-y:y1-y, x0-x:x1-x].astype(float64)
+        alpha = src[:, :, 3:]/255.0
+        dst = self.pixels[y0:y1, x0:x1]
+        dst[:] = np_round(src[:, :, :3]*alpha + dst*(1 - alpha)).astype(uint8)
+
+    def text(self, x, y, text, colour, scale=TEXT_SCALE):
+        """
+        Draws text with its top left corner at x, y.
+        """
+
+        for glyph in _glyphs(text):
+            block = glyph.repeat(scale, axis=0).repeat(scale, axis=1)
+            ys, xs = block.nonzero()
+            xs = xs + x
+            ys = ys + y
+            inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+            self.pixels[ys[inside], xs[inside]] = colour
+            x += (GLYPH_WIDTH + 1)*scale
+
+    def save(self, path):
+        write_png(path, self.pixels)
+
+
+class SVG():
+    """
+    The same calls as Raster, written out as an SVG document width by
+    height pixels.
+    """
+
+    def __init__(self, width, height, background=WHITE):
+        self.width = width
+        self.height = height
+        self.elements = ['<rect width="%d" height="%d" fill="%s"/>' % (width, height, _rgb(background))]
+        self.images = {} # id of each image embedded, by the id() of its array
+
+    def polyline(self, points, colour):
+        points = asarray(points, dtype=float64)
+        points = points[isfinite(points).all(axis=1)]
+        if len(points) == 0:
+            return
+        coordinates = ' '.join(['%.1f,%.1f' % (px, py) for px, py in points.tolist()])
+        self.elements.append('<polyline points="%s" fill="none" stroke="%s" stroke-width="1"/>' %
+                             (coordinates, _rgb(colour)))
+
+    def image(self, rgba, x, y):
+        # each image is embedded once and used wherever it's drawn
+        key = id(rgba)
+        if key not in self.images:
+            name = 'image%d' % len(self.images)
+            self.images[key] = (name, rgba)
+        self.elements.append('<use xlink:href="#%s" x="%.1f" y="%.1f"/>' % (self.images[key][0], x, y))
+
+    def text(self, x, y, text, colour, scale=TEXT_SCALE):
+        size = GLYPH_HEIGHT*scale
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        self.elements.append('<text x="%d" y="%d" font-family="monospace" font-size="%d" '
+                             'fill="%s">%s</text>' % (x, y + size, size*1.4, _rgb(colour), text))
+
+    def document(self):
+        defs = []
+        for name, rgba in self.images.values():
+            data = base64.b64encode(png_bytes(rgba)).decode('ascii')
+            defs.append('<image id="%s" width="%d" height="%d" xlink:href="data:image/png;base64,%s"/>' %
+                        (name, rgba.shape[1], rgba.shape[0], data))
+        return '\n'.join(['<svg xmlns="http://www.w3.org/2000/svg" '
+                          'xmlns:xlink="http://www.w3.org/1999/xlink" width="%d" height="%d" '
+                          'viewBox="0 0 %d %d">' % (self.width, self.height, self.width, self.height),
+                          '<defs>'] + defs + ['</defs>'] + self.elements + ['</svg>', ''])
+
+    def save(self, path):
+        with open(path, 'w') as fo:
+            fo.write(self.document())
+
+
+def _rgb(colour):
+    return '#%02x%02x%02x' % tuple(colour)
@@ -0,0 +1,156 @@
+'''
+Uses the sample numbers the microcontroller stamps on every dataset to put
+the datasets read from it back in order.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A read returns the newest UC_NUM_DATASETS datasets the microcontroller has
+buffered. If the host reads more often than a dataset is buffered it gets
+some datasets twice, and if it reads less often or a packet is lost it
+misses some. Before, the host assumed every read held exactly the next five
+datasets. Ingest drops the datasets it has already seen, interpolates short
+runs of missing ones and leaves longer gaps in place, which the processing
+handles since it uses the sample numbers for timing. It also unwraps the
+uint32 sample numbers so they keep increasing when they roll over.
+
+So the host may poll at any rate and drain any number of queued packets at
+once.
+'''
+
+from numpy import arange, concatenate, int64, maximum, round as np_round, zeros
+
+from pulseox_protocol import DATASET_FIELDS, RED, IR, SAMPLE_NUM
+
+MAX_INTERPOLATED = 10 # longest run of missing datasets filled in, 60 ms
+RESYNC_THRESHOLD = 2**16 # a step back further than this is a device restart
+
+SAMPLE_NUM_MODULUS = 2**32
+
+# names of the counters in a profiler
+COUNTERS = dict(duplicates='duplicate datasets', missing='missing datasets',
+                interpolated='interpolated datasets', gaps='gaps', resyncs='resyncs')
+
+
+class Ingest():
+    """
+    Takes the (N, 3) datasets of each read and returns the ones not seen
+    before, oldest to newest, with runs of up to max_interpolated missing
+    datasets filled in by linear interpolation. The sample number column of
+    the result is unwrapped into an int64 that doesn't roll over.
+
+    The duplicate, missing and interpolated datasets, the gaps left
+    unfilled and the restarts of the sample numbers are counted, and also
+    added to profiler if one is given.
+    """
+
+    def __init__(self, max_interpolated=MAX_INTERPOLATED, profiler=None):
+        self.max_interpolated = max_interpolated
+        self.profiler = profiler
+        self.reset()
+
+    def reset(self):
+        self.last_raw = None # sample number of the last dataset read
+        self.tail = None # the same, unwrapped
+        self.last = None # unwrapped sample number of the newest dataset returned
+        self.last_values = None # and its red, IR
+
+        self.duplicates = 0
+        self.missing = 0
+        self.interpolated = 0
+        self.gaps = 0
+        self.resyncs = 0
+
+    def _count(self, name, n):
+        setattr(self, name, getattr(self, name) + n)
+        if self.profiler is not None:
+            self.profiler.count(COUNTERS[name], n)
+
+    def process(self, datasets):
+        num = len(datasets)
+        if num == 0:
+            return zeros((0, DATASET_FIELDS), dtype=int64)
+
+        raw = datasets[:, SAMPLE_NUM].astype(int64)
+        if self.last_raw is not None and self.tail == self.last \
+           and raw[0] == (self.last_raw + 1) % SAMPLE_NUM_MODULUS and raw[-1] - raw[0] == num - 1 and (raw[1:] - raw[:-1] == 1).all():
+            # the usual case, just the datasets that follow the last ones
+            out = datasets.astype(int64)
+            out[:, SAMPLE_NUM] = self.last + 1 + arange(num)
+            self.last_raw = int(raw[-1])
+            self.last = self.tail = int(out[-1, SAMPLE_NUM])
+            self.last_values = out[-1, [RED, IR]]
+            return out
+
+        # step from the previous sample number as a signed 32 bit difference
+        step = zeros(num, dtype=int64)
+        step[1:] = raw[1:] - raw[:-1]
+        if self.last_raw is None:
+            step[0] = 1
+            tail = raw[0] - 1
+        else:
+            step[0] = raw[0] - self.last_raw
+            tail = self.tail
+        step %= SAMPLE_NUM_MODULUS
+        step[step >= SAMPLE_NUM_MODULUS//2] -= SAMPLE_NUM_MODULUS
+
+        # A big step backwards means the microcontroller restarted. Carry on
+        # from where it was, leaving a gap of one dataset.
+        restart = step < -RESYNC_THRESHOLD
+        if restart.any():
+            self._count('resyncs', int(restart.sum()))
+            step[restart] = 2
+
+        n = tail + step.cumsum()
+        self.last_raw = int(raw[-1])
+        self.tail = int(n[-1])
+
+        # keep only the datasets newer than every one before them
+        last = n[0] - 1 if self.last is None else self.last
+        keep = n > maximum.accumulate(concatenate([[last], n[:-1]]))
+        if not keep.all():
+            self._count('duplicates', int(num - keep.sum()))
+            if not keep.any():
+                return zeros((0, DATASET_FIELDS), dtype=int64)
+            datasets = datasets[keep]
+            n = n[keep]
+            restart = restart[keep]
+        out = datasets.astype(int64)
+        out[:, SAMPLE_NUM] = n
+
+        # runs of missing datasets before each one
+        missing = n - concatenate([[last], n[:-1]]) - 1
+        gaps = missing.nonzero()[0].tolist()
+        if gaps:
+            pieces = []
+            start = 0
+            for k in gaps:
+                run = int(missing[k])
+                if restart[k]:
+                    # nothing's missing, there's just no telling what happened
+                    self._count('gaps', 1)
+                    continue
+                self._count('missing', run)
+                if run > self.max_interpolated:
+                    self._count('gaps', 1)
+                    continue
+                if k == 0:
+                    a = self.last_values
+                else:
+                    a = out[k-1, [RED, IR]]
+                b = out[k, [RED, IR]]
+                frac = arange(1, run+1)/float(run+1)
+                filled = zeros((run, DATASET_FIELDS), dtype=int64)
+                filled[:, RED] = np_round(a[0] + frac*(b[0] - a[0]))
+                filled[:, IR] = np_round(a[1] + frac*(b[1] - a[1]))
+                filled[:, SAMPLE_NUM] = n[k] - run + arange(run)
+                pieces.append(out[start:k])
+                pieces.append(filled)
+                start = k
+                self._count('interpolated', run)
+            if pieces:
+                pieces.append(out[start:])
+                out = concatenate(pieces)
+
+        self.last = int(out[-1, SAMPLE_NUM])
+        self.last_values = out[-1, [RED, IR]]
+        return out
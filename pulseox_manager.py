@@ -0,0 +1,414 @@
+#!/usr/bin/python
+
+'''
+Serves every pulse oximeter plugged into the host from one process.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Each device gets its own acquisition context, a Channel, with a Reader
+thread that sleeps between reads and a PulseOxEngine holding its buffers.
+The processing is done by a fixed pool of worker threads shared by all the
+devices. A channel is handed to the pool whenever its reader queues a read
+and is only ever processed by one worker at a time, so an engine never sees
+two threads.
+
+The bus is rescanned every SCAN_PERIOD seconds. Devices that appeared are
+added, and devices that disappeared or whose reads failed are removed (and
+added again on the next scan if they're still there). A device that can't
+be opened is tried again after twice as long each time, up to RETRY_PERIOD.
+
+At most max_devices are served. Every device costs about 33 reader wakeups
+a second and a refresh every 90 ms (short view) of well under a
+millisecond, and all of the Python processing shares one core because of
+the GIL, so MAX_DEVICES leaves room for the long view and for the spikes
+when windows are rebuilt. benchmarks/bench_manager.py measures it.
+
+With processes=True each device's processing runs in a worker process of
+its own instead (see pulseox_parallel.py) and the pool only hands the
+datasets over and collects the frames, so the processing spreads over
+every core.
+
+    python pulseox_manager.py             # every USB device
+    python pulseox_manager.py --simulate 8
+    python pulseox_manager.py --simulate 8 --processes
+
+If calibration is a directory of profiles written by pulseox_calibrate.py
+each device uses the one named after its key, if there is one, instead of
+K.
+'''
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from numpy import errstate
+
+from pulseox_acquire import Reader, read_timing
+from pulseox_calibrate import load_profile, profile_path
+from pulseox_device import UC_TIMER_PERIOD, SimulatedDevice, find_usb_devices
+from pulseox_engine import K, UC_SAMPLE_PERIOD, PulseOxEngine
+from pulseox_parallel import ProcessEngine
+from pulseox_profile import Profiler, timer
+from pulseox_protocol import decode_packets
+from pulseox_signal import SPO2_CURVE
+
+MAX_DEVICES = 32
+PROCESS_WORKERS = 2
+SCAN_PERIOD = 2.0 # seconds
+RETRY_PERIOD = 60.0 # seconds, longest wait before opening a device again
+
+
+class Channel():
+    """
+    Acquisition context of one device. engine is None if the device
+    couldn't be opened.
+    """
+
+    def __init__(self, key, device, engine=None):
+        self.key = key
+        self.device = device
+        self.engine = engine
+        self.profiler = Profiler() if engine is None else engine.profiler
+        self.reader = None
+        self.state = 'new' # new, running, stopped, error or removed
+        self.error = None
+        self.refreshes = 0
+        self.last_read = None
+        self.scheduled = False # queued for or being processed by a worker
+        self.t_added = time.time()
+        self.retry_at = 0 # host time from which a failed channel is added again
+
+
+class DeviceManager():
+    """
+    Finds, opens and processes many pulse oximeters.
+
+    find is called to enumerate the devices and returns a dict of unopened
+    devices keyed by something that identifies each one for as long as it's
+    plugged in, like find_usb_devices() does. on_refresh(channel, result) is
+    called from a worker thread with the result of every process().
+
+    If processes is True every device is processed by a ProcessEngine.
+
+    Every device is read every period seconds, or as often as its protocol
+    and sample period need (see pulseox_acquire.read_timing()) if period is
+    None, and processed at its own sample period.
+    """
+
+    def __init__(self, find=find_usb_devices, max_devices=MAX_DEVICES,
+                 workers=PROCESS_WORKERS, view='short', K=K, incremental=True,
+                 period=None, on_refresh=None, processes=False, calibration=None):
+        self.find = find
+        self.max_devices = max_devices
+        self.num_workers = workers
+        self.view = view
+        self.K = K
+        self.incremental = incremental
+        self.period = period
+        self.on_refresh = on_refresh
+        self.processes = processes
+        self.calibration = calibration
+
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.work = queue.Queue()
+        self.workers = []
+        self.monitor = None
+        self.running = False
+        self.rejected = set() # devices found but not served because of max_devices
+        self.failures = {} # opens that failed in a row, by device
+
+    def start(self, scan_period=SCAN_PERIOD):
+        """
+        Starts the worker pool, adds the devices present now and rescans the
+        bus every scan_period seconds (never if it's None).
+        """
+
+        self.running = True
+        for k in range(self.num_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.scan()
+        if scan_period is not None:
+            self.wake = threading.Event()
+            self.monitor = threading.Thread(target=self._monitor, args=(scan_period,))
+            self.monitor.daemon = True
+            self.monitor.start()
+
+    def stop(self):
+        self.running = False
+        if self.monitor is not None:
+            self.wake.set()
+            self.monitor.join()
+            self.monitor = None
+        for key in list(self.channels):
+            self.remove(key)
+        for worker in self.workers:
+            self.work.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _monitor(self, scan_period):
+        while self.running:
+            self.wake.wait(scan_period)
+            if self.running:
+                self.scan()
+
+    def scan(self):
+        """
+        Adds the devices that were plugged in and removes the ones that
+        were unplugged or stopped working.
+        """
+
+        found = self.find()
+        self.rejected &= set(found)
+        for key in list(self.failures):
+            if key not in found:
+                del self.failures[key]
+        now = time.time()
+        for key in list(self.channels):
+            channel = self.channels[key]
+            if key not in found or (channel.state in ('stopped', 'error') and
+                                    now >= channel.retry_at):
+                self.remove(key)
+        for key in sorted(found):
+            if key not in self.channels:
+                self.add(key, found[key])
+
+    def add(self, key, device):
+        """
+        Opens device and starts reading it. Returns its Channel, or None if
+        max_devices are already being served.
+        """
+
+        if len(self.channels) >= self.max_devices:
+            if key not in self.rejected:
+                print('Serving the maximum of %d devices, %s not added.' % (self.max_devices, key))
+                self.rejected.add(key)
+            return None
+        self.rejected.discard(key)
+
+        K, curve = self.K, SPO2_CURVE
+        if self.calibration is not None:
+            path = profile_path(self.calibration, key)
+            if os.path.exists(path):
+                profile = load_profile(path)
+                K, curve = profile['K'], profile['curve']
+
+        # the device's sample period is only known once it's open
+        error = None
+        try:
+            opened = device.open()
+        except Exception as e:
+            opened = False
+            error = e
+        if not opened:
+            failures = self.failures.get(key, 0) + 1
+            self.failures[key] = failures
+            channel = Channel(key, device)
+            channel.error = error
+            channel.state = 'error'
+            channel.retry_at = time.time() + min(SCAN_PERIOD*2**(failures - 1), RETRY_PERIOD)
+            self.channels[key] = channel
+            return channel
+        self.failures.pop(key, None)
+
+        if self.processes:
+            engine = ProcessEngine(self.view, K=K, incremental=self.incremental,
+                                   sample_period=device.sample_period, profiler=Profiler(),
+                                   curve=curve)
+            engine.start()
+        else:
+            engine = PulseOxEngine(self.view, K=K, incremental=self.incremental,
+                                   sample_period=device.sample_period, profiler=Profiler(),
+                                   curve=curve)
+        channel = Channel(key, device, engine)
+        self.channels[key] = channel
+
+        period, late = read_timing(device)
+        if self.period is not None:
+            period, late = self.period, None
+        channel.reader = Reader(device, period, channel.profiler,
+                                notify=lambda: self._schedule(channel), late=late)
+        channel.state = 'running'
+        channel.reader.start()
+        return channel
+
+    def remove(self, key):
+        channel = self.channels.pop(key)
+        if channel.reader is not None:
+            channel.reader.stop()
+        try:
+            channel.device.close()
+        except Exception:
+            pass
+        if self.processes and channel.engine is not None:
+            channel.engine.stop()
+        channel.state = 'removed'
+
+    def _schedule(self, channel):
+        with self.lock:
+            if channel.scheduled or channel.state != 'running':
+                return
+            channel.scheduled = True
+        self.work.put(channel)
+
+    def _work(self):
+        # the window starts out flat so the first refreshes divide 0 by 0
+        with errstate(divide='ignore', invalid='ignore'):
+            while True:
+                channel = self.work.get()
+                if channel is None:
+                    break
+                # a device error, a malformed packet or a failure in the
+                # engine only stops this channel, never the worker
+                try:
+                    self._process(channel)
+                except Exception as e:
+                    channel.state = 'error'
+                    channel.error = e
+                with self.lock:
+                    channel.scheduled = False
+                # a read may have been queued after the last get()
+                if not channel.reader.queue.empty():
+                    self._schedule(channel)
+
+    def _process(self, channel):
+        reads = channel.reader.get(0)
+        if not reads and not channel.reader.is_alive():
+            if channel.state == 'running':
+                channel.state = 'stopped'
+            return
+
+        due = False
+        for read_t0, data in reads:
+            channel.last_read = read_t0
+            if channel.engine.push(decode_packets(data, channel.device.protocol)):
+                due = True
+
+        if due:
+            t0 = timer()
+            result = channel.engine.process()
+            channel.profiler.add('processData', timer()-t0)
+            if result is None:
+                return
+            channel.refreshes += 1
+            if self.on_refresh is not None:
+                self.on_refresh(channel, result)
+
+    def status(self):
+        """
+        Returns a list of dicts describing the health of each device.
+        """
+
+        now = time.time()
+        rows = []
+        # the monitor thread may add or remove channels meanwhile
+        for key, channel in sorted(self.channels.items()):
+            reader = channel.reader
+            engine = channel.engine
+            stages = channel.profiler.stages
+            row = dict(key=key, state=channel.state, refreshes=channel.refreshes,
+                       reads=0 if reader is None else reader.reads,
+                       dropped=0 if reader is None else reader.dropped,
+                       last_read_age=None if channel.last_read is None else now - channel.last_read,
+                       heartrate=None if engine is None else engine.heartrate,
+                       SpO2=None if engine is None else engine.SpO2,
+                       quality=None if engine is None else engine.signal_quality,
+                       error=None if channel.error is None else str(channel.error))
+            for name, stage in [('read_p99', 'read interval'), ('process_p99', 'processData')]:
+                row[name] = stages[stage].percentile(99) if stage in stages else None
+            row['late_reads'] = channel.profiler.counters.get('late reads', 0)
+            rows.append(row)
+        return rows
+
+    def report(self):
+        """
+        Returns the status of every device as a table.
+        """
+
+        def fmt(value, spec, scale=1):
+            return '--' if value is None else spec % (scale*value)
+
+        lines = ['%-16s %-8s %8s %6s %6s %9s %9s %5s %5s %4s %s' %
+                 ('device', 'state', 'reads', 'late', 'drop', 'read p99', 'proc p99',
+                  'HR', 'SpO2', 'SQI', 'error')]
+        for row in self.status():
+            lines.append('%-16s %-8s %8d %6d %6d %9s %9s %5s %5s %4s %s' %
+                         (row['key'], row['state'], row['reads'], row['late_reads'],
+                          row['dropped'], fmt(row['read_p99'], '%.1f', 1e3),
+                          fmt(row['process_p99'], '%.2f', 1e3),
+                          fmt(row['heartrate'], '%.0f'), fmt(row['SpO2'], '%.1f'),
+                          fmt(row['quality'], '%.2f'), row['error'] or ''))
+        if self.rejected:
+            lines.append('%d devices not served, max_devices is %d' % (len(self.rejected), self.max_devices))
+        return '\n'.join(lines)
+
+
+def simulated_devices(num, **options):
+    """
+    Returns a find function for DeviceManager that finds num simulated
+    devices with heart rates from 60 [bpm] up.
+    """
+
+    def find():
+        return dict([('sim:%d' % k, SimulatedDevice(heart_rate=60+k % 60, seed=k, **options))
+                     for k in range(num)])
+    return find
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve every pulse oximeter on the host.')
+    parser.add_argument('--simulate', type=int, metavar='N',
+                        help='serve N simulated devices instead of the USB devices')
+    parser.add_argument('--seconds', type=float, help='stop after this long')
+    parser.add_argument('--workers', type=int, default=PROCESS_WORKERS,
+                        help='processing threads shared by all devices')
+    parser.add_argument('--max-devices', type=int, default=MAX_DEVICES)
+    parser.add_argument('--view', choices=['short', 'long'], default='short')
+    parser.add_argument('--processes', action='store_true',
+                        help='process every device in a worker process of its own')
+    parser.add_argument('--calibration', metavar='DIR',
+                        help='directory of calibration profiles named after the devices')
+    parser.add_argument('--protocol', type=int, choices=[1, 2],
+                        help='USB protocol version, the newest the firmware speaks by default '
+                             'and v1 for simulated devices')
+    parser.add_argument('--nth-sample', type=int, metavar='N',
+                        help='take a dataset every N ms instead of every %g ms, '
+                             'protocol v2 only on USB devices' % (1e3*UC_SAMPLE_PERIOD))
+    args = parser.parse_args(argv)
+
+    if args.simulate is None:
+        find = lambda: find_usb_devices(protocol=args.protocol, nth_sample=args.nth_sample)
+    else:
+        options = dict(protocol=args.protocol or 1)
+        if args.nth_sample is not None:
+            options['sample_period'] = args.nth_sample*UC_TIMER_PERIOD
+        find = simulated_devices(args.simulate, **options)
+    manager = DeviceManager(find, args.max_devices, args.workers, args.view,
+                            processes=args.processes, calibration=args.calibration)
+    manager.start()
+    t0 = time.time()
+    try:
+        while args.seconds is None or time.time() - t0 < args.seconds:
+            time.sleep(1)
+            print(manager.report())
+            print('')
+    except KeyboardInterrupt:
+        pass
+    manager.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+'''
+Runs the processing of a pulse oximeter in a process of its own.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+The reading thread and the processing thread used to share one interpreter,
+so peakdet()'s loop and the SpO2 loop held the GIL that the USB reads and
+the Qt paint path were waiting on. A ProcessEngine looks to its caller like
+a PulseOxEngine, but push() only copies the datasets into a ring buffer in
+shared memory and process() only collects the latest results. The worker
+process reads the ring buffer in place, runs a PulseOxEngine over it and
+sends back a compact frame (see pulseox_render.compact_frame()) after each
+refresh. With several devices every one gets its own process, so the
+processing spreads over all the cores. Frames are dropped if they aren't
+collected in time but the beats found are always passed on.
+
+The ring buffer has a single writer and a single reader. The writer copies
+the datasets in and then advances the count of datasets written, and the
+reader never reads past that count. If the reader falls more than the
+capacity behind, the datasets it missed are counted as an overrun and its
+engine starts over.
+
+    engine = ProcessEngine('short')
+    engine.start()
+    if engine.push(decode_packets(data)):
+        tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out = engine.process()
+    engine.stop()
+'''
+
+import ctypes
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from numpy import errstate, frombuffer, int64
+
+from pulseox_beats import HRV
+from pulseox_engine import K, UC_SAMPLE_PERIOD, PulseOxEngine, view_constants
+from pulseox_profile import timer
+from pulseox_protocol import DATASET_FIELDS, ring_write
+from pulseox_render import compact_frame
+
+RING_CAPACITY = 2**16 # datasets, 6.5 minutes
+RESULT_QUEUE_SIZE = 8 # frames waiting to be collected
+STOP_TIMEOUT = 2.0 # seconds
+
+
+def _context():
+    # A forked child would inherit the reader threads and Qt's state, so
+    # the child is started fresh where Python can do that.
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn')
+    return multiprocessing
+
+
+class SharedRing():
+    """
+    A circular buffer of capacity (red, IR, sample number) datasets in
+    shared memory along with the count of datasets ever written to it.
+    """
+
+    def __init__(self, capacity=RING_CAPACITY, context=None):
+        context = _context() if context is None else context
+        self.capacity = capacity
+        self.raw = context.RawArray(ctypes.c_int64, capacity*DATASET_FIELDS)
+        self.count = context.RawValue(ctypes.c_int64, 0)
+        self._view()
+
+    def _view(self):
+        self.datasets = frombuffer(self.raw, dtype=int64).reshape(self.capacity, DATASET_FIELDS)
+
+    def __getstate__(self):
+        # only picklable while a child process is being started
+        return self.capacity, self.raw, self.count
+
+    def __setstate__(self, state):
+        self.capacity, self.raw, self.count = state
+        self._view()
+
+    @property
+    def written(self):
+        return self.count.value
+
+    def write(self, datasets):
+        num = len(datasets)
+        if num == 0:
+            return
+        written = self.count.value
+        ring_write(self.datasets, written % self.capacity, datasets)
+        # only now may the reader see them
+        self.count.value = written + num
+
+    def read(self, start, stop):
+        """
+        Returns views of the datasets numbered start up to stop, split in
+        two where they wrap around the end of the buffer.
+        """
+
+        i = start % self.capacity
+        j = i + stop - start
+        if j <= self.capacity:
+            return [self.datasets[i:j]]
+        return [self.datasets[i:], self.datasets[:j-self.capacity]]
+
+
+def _serve(ring, ready, stopping, results, view, K, incremental, sample_period, constants):
+    # main loop of the worker process
+    engine = PulseOxEngine(view, K=K, incremental=incremental, sample_period=sample_period,
+                           **constants)
+    # Half a window at a time, so that when the worker has fallen behind
+    # every beat still passes through a window that's processed.
+    chunk = max(engine.buffersize//2, 1)
+    read = 0
+    overruns = 0
+    beats = [] # beats not sent yet, which unlike frames mustn't be lost
+    # the window starts out flat so the first refreshes divide 0 by 0
+    with errstate(divide='ignore', invalid='ignore'):
+        while not stopping.is_set():
+            ready.wait(0.5)
+            # Cleared before the count is read, so a write that lands after
+            # the count was read sets it again and isn't missed.
+            ready.clear()
+            written = ring.written
+            if written == read:
+                continue
+            if written - read > ring.capacity:
+                overruns += written - read - ring.capacity
+                read = written - ring.capacity
+                engine.reset()
+
+            due = False
+            pushed = read
+            for piece in ring.read(read, written):
+                for k in range(0, len(piece), chunk):
+                    if engine.push(piece[k:k+chunk]):
+                        due = True
+                    pushed += len(piece[k:k+chunk])
+                    if due and pushed < written:
+                        # catching up, only the beats are kept
+                        engine.process()
+                        beats += engine.new_beats
+                        due = False
+
+            if ring.written - read > ring.capacity:
+                # the writer lapped the datasets while they were pushed
+                overruns += ring.written - read - ring.capacity
+                engine.reset()
+                due = False
+            read = written
+
+            if due:
+                t0 = timer()
+                tn, nPPG_red, nPPG_ir, systole, diastole, hr_out, SpO2_out = engine.process()
+                frame = compact_frame(tn, nPPG_red, nPPG_ir, systole, diastole, engine.graph_width)
+                frame += (hr_out, SpO2_out)
+                beats += engine.new_beats
+                vitals = (engine.heartrate, engine.SpO2, engine.SpO2_beats, engine.beats,
+                          engine.signal_quality, beats)
+                try:
+                    results.put_nowait((frame, vitals, timer()-t0, overruns))
+                    beats = []
+                except queue.Full:
+                    # nobody's collecting, the next frame will do
+                    pass
+
+
+class ProcessEngine():
+    """
+    A PulseOxEngine running in a worker process.
+
+    push() returns True once a frame is waiting, and process() returns the
+    newest one, the same tuple PulseOxEngine.process() does. heartrate,
+    SpO2, SpO2_beats, beats and signal_quality are those of the newest
+    frame. new_beats
+    is every beat the worker found since the last process(), including
+    those of frames that were dropped, and they're added to hrv. The
+    arguments are the same as PulseOxEngine's.
+
+    If profiler is given the time the worker took to process each frame
+    is added to it as 'process (worker)', along with counts of frames that
+    were replaced before they were collected and of datasets lost to ring
+    buffer overruns.
+    """
+
+    def __init__(self, view='short', K=K, incremental=True, sample_period=UC_SAMPLE_PERIOD,
+                 profiler=None, capacity=RING_CAPACITY, **constants):
+        self.view = view
+        self.K = K
+        self.incremental = incremental
+        self.sample_period = sample_period
+        self.profiler = profiler
+        self.capacity = capacity
+        self.constants = constants
+        self.worker = None
+
+        self.heartrate = None
+        self.SpO2 = None
+        self.SpO2_beats = None
+        self.beats = None
+        self.signal_quality = None
+        self.new_beats = []
+        self.pending_beats = [] # the beats of frames not yet collected
+        c = view_constants(view, sample_period)
+        c.update(constants)
+        self.hrv = HRV(dict(display=int(round(c['HRV_WINDOW']/sample_period)),
+                            trend=int(round(c['TREND_WINDOW']/sample_period))))
+        self.frame = None
+        self.overruns = 0
+        self.dropped = 0 # frames replaced before process() collected them
+
+    def start(self):
+        context = _context()
+        self.ring = SharedRing(self.capacity, context)
+        self.ready = context.Event()
+        self.stopping = context.Event()
+        self.results = context.Queue(RESULT_QUEUE_SIZE)
+        self.worker = context.Process(target=_serve,
+                                      args=(self.ring, self.ready, self.stopping, self.results,
+                                            self.view, self.K, self.incremental,
+                                            self.sample_period, self.constants))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        if self.worker is None:
+            return
+        self.stopping.set()
+        self.ready.set()
+        self.worker.join(STOP_TIMEOUT)
+        if self.worker.is_alive():
+            self.worker.terminate()
+            self.worker.join()
+        self.worker = None
+
+    def is_alive(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def push(self, datasets):
+        """
+        Hands an (N, 3) array of (red, IR, sample number) rows to the worker.
+        Returns True if a processed frame is waiting.
+        """
+
+        self.ring.write(datasets)
+        self.ready.set()
+        return self._collect()
+
+    def _take(self, result):
+        if self.frame is not None:
+            self.dropped += 1
+            if self.profiler is not None:
+                self.profiler.count('dropped frames (worker)')
+        self.frame, vitals, seconds, overruns = result
+        (self.heartrate, self.SpO2, self.SpO2_beats, self.beats, self.signal_quality,
+         beats) = vitals
+        for beat in beats:
+            self.hrv.add(beat)
+        self.pending_beats += beats
+        if self.profiler is not None:
+            self.profiler.add('process (worker)', seconds)
+            if overruns > self.overruns:
+                self.profiler.count('ring overruns', overruns - self.overruns)
+        self.overruns = overruns
+
+    def _collect(self):
+        # keeps only the newest of the frames the worker has sent
+        while True:
+            try:
+                self._take(self.results.get_nowait())
+            except queue.Empty:
+                return self.frame is not None
+
+    def process(self):
+        """
+        Returns the newest frame, or None if there isn't a new one.
+        """
+
+        self._collect()
+        frame, self.frame = self.frame, None
+        if frame is not None:
+            self.new_beats, self.pending_beats = self.pending_beats, []
+        return frame
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a frame is waiting or timeout seconds have passed.
+        Returns True if one is.
+        """
+
+        if self._collect():
+            return True
+        try:
+            self._take(self.results.get(True, timeout))
+        except queue.Empty:
+            return False
+        return self._collect()
@@ -0,0 +1,164 @@
+'''
+Timing instrumentation for the acquisition, processing and painting paths.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Every stage gets a histogram with logarithmically spaced buckets, so adding
+a time is a log, an int() and a list increment, and the memory used doesn't
+grow however long the program runs. Percentiles are accurate to the bucket
+width, about 12% with the default of 20 buckets per decade.
+
+    profiler = Profiler()
+    t0 = timer()
+    ...
+    profiler.add('processData', timer()-t0)
+    profiler.count('late reads')
+    print(profiler.report())
+'''
+
+import time
+from math import log10
+
+# the best clock available, time.perf_counter() doesn't exist in Python 2
+timer = getattr(time, 'perf_counter', time.time)
+
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram():
+    """
+    Counts times in seconds in buckets spaced evenly on a log scale between
+    lo and hi. Times outside the range are counted in the first or last
+    bucket but the exact min and max are kept.
+    """
+
+    def __init__(self, lo=1e-6, hi=10.0, buckets_per_decade=20):
+        self.lo = lo
+        self.buckets_per_decade = buckets_per_decade
+        self.log_lo = log10(lo)
+        self.num_buckets = int(round((log10(hi) - self.log_lo)*buckets_per_decade)) + 1
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*self.num_buckets
+        self.n = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > self.lo:
+            b = int((log10(seconds) - self.log_lo)*self.buckets_per_decade)
+            if b >= self.num_buckets:
+                b = self.num_buckets - 1
+        else:
+            b = 0
+        self.counts[b] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def _edge(self, b):
+        # upper edge of bucket b
+        return 10**(self.log_lo + float(b + 1)/self.buckets_per_decade)
+
+    def percentile(self, p):
+        """
+        Returns the time that p percent of the times are at or below, or
+        None if nothing has been added.
+        """
+
+        if self.n == 0:
+            return None
+        rank = p/100.0*self.n
+        cumulative = 0
+        for b, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= rank and c > 0:
+                return min(max(self._edge(b), self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total/self.n if self.n else None
+
+    def merge(self, other):
+        """
+        Adds the times counted by other, a Histogram with the same buckets.
+        """
+
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+
+class Profiler():
+    """
+    A histogram per stage plus event counters, both created on first use.
+    """
+
+    def __init__(self, **histogram_options):
+        self.histogram_options = histogram_options
+        self.stages = {}
+        self.order = [] # stages in the order they were first seen
+        self.counters = {}
+
+    def add(self, stage, seconds):
+        try:
+            self.stages[stage].add(seconds)
+        except KeyError:
+            self.stages[stage] = Histogram(**self.histogram_options)
+            self.order.append(stage)
+            self.stages[stage].add(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        for h in self.stages.values():
+            h.reset()
+        self.counters = dict.fromkeys(self.counters, 0)
+
+    def summary(self, stage, percentiles=PERCENTILES):
+        """
+        Returns (count, mean, max, [percentiles]) in seconds for stage.
+        """
+
+        h = self.stages[stage]
+        return h.n, h.mean(), h.max, [h.percentile(p) for p in percentiles]
+
+    def readout(self, stages=None, p=99):
+        """
+        Returns a one line summary of the p-th percentile of each stage in
+        milliseconds, short enough to be drawn in the window.
+        """
+
+        stages = self.order if stages is None else stages
+        fields = []
+        for stage in stages:
+            if stage in self.stages and self.stages[stage].n > 0:
+                fields.append('%s %.1f' % (stage, 1e3*self.stages[stage].percentile(p)))
+        for name in sorted(self.counters):
+            fields.append('%s %d' % (name, self.counters[name]))
+        return ('p%d [ms]: ' % p) + ', '.join(fields)
+
+    def report(self, percentiles=PERCENTILES):
+        """
+        Returns a table of every stage and counter.
+        """
+
+        lines = ['%-16s %8s %9s' % ('stage [ms]', 'count', 'mean') +
+                 ''.join(['%9s' % ('p%d' % p) for p in percentiles]) + '%9s' % 'max']
+        for stage in self.order:
+            n, mean, mx, values = self.summary(stage, percentiles)
+            if n == 0:
+                continue
+            lines.append('%-16s %8d %9.3f' % (stage, n, 1e3*mean) +
+                         ''.join(['%9.3f' % (1e3*v) for v in values]) + '%9.3f' % (1e3*mx))
+        for name in sorted(self.counters):
+            lines.append('%-16s %8d' % (name, self.counters[name]))
+        return '\n'.join(lines)
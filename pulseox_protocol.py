@@ -0,0 +1,202 @@
+'''
+Decodes the packets the microcontroller sends to the host.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Every interrupt read returns UC_NUM_DATASETS datasets ordered oldest to
+newest (see Send_Data() in uc_code/pulseox_USB.c). A dataset is three little
+endian uint32 values: the red sample, the IR sample, and the sample number.
+So instead of assembling each value a byte at a time the whole packet can be
+viewed as an (N, 3) uint32 array in one step.
+
+That's protocol v1, which the firmware speaks until the host asks for v2
+with the REQ_SET_PROTOCOL control request. A v2 packet is a V2_HEADER_DTYPE
+header, the protocol version, the number of datasets, the number the
+firmware has discarded because its queue was full and the sample number of
+the first dataset, followed by the red and IR samples of each dataset as
+little endian uint16s. Each dataset is sent once, up to V2_NUM_DATASETS to a
+64 byte packet, and the sample numbers of all but the first are implied.
+decode_packets() turns both into the same (N, 3) array.
+'''
+
+from numpy import arange, asarray, concatenate, cumsum, dtype, empty, frombuffer, int64, repeat, \
+                  uint8, uint32
+
+UC_NUM_DATASETS = 5
+DATASET_FIELDS = 3 # red, IR, sample number
+DATASET_DTYPE = dtype('<u4')
+DATASET_SIZE = DATASET_FIELDS*DATASET_DTYPE.itemsize # bytes
+PACKET_SIZE = UC_NUM_DATASETS*DATASET_SIZE # bytes
+
+# column of each field in a decoded dataset
+RED = 0
+IR = 1
+SAMPLE_NUM = 2
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+V2_HEADER_DTYPE = dtype([('version', 'u1'), ('count', 'u1'), ('overflow', '<u2'),
+                         ('first', '<u4')])
+V2_SAMPLE_DTYPE = dtype('<u2')
+V2_DATASET_SIZE = 2*V2_SAMPLE_DTYPE.itemsize # bytes
+V2_PACKET_SIZE = 64 # bytes, EP_SIZE in uc_code/Descriptors.h
+V2_NUM_DATASETS = (V2_PACKET_SIZE - V2_HEADER_DTYPE.itemsize)//V2_DATASET_SIZE # 14
+V2_MIN_DATASETS = 5 # the firmware sends a packet once this many are queued
+V2_RING_SIZE = 64 # datasets the firmware queues besides the two packets
+
+# vendor control requests, see EVENT_USB_Device_ControlRequest()
+REQ_GET_PROTOCOL = 0x01
+REQ_SET_PROTOCOL = 0x02
+REQ_SET_NTH_SAMPLE = 0x03
+
+# The firmware looks up each TSL230R frequency in fLUT (uc_code/fLUT.h),
+# 16 MHz over the period in timer ticks, for periods up to FLUT_SIZE-1 and
+# reads 0 beyond that. The frequencies are averaged in uint16s, so a
+# sample near either end of this range had readings that were out of range
+# or wrapped around.
+UC_CLOCK = 16000000 # Hz
+FLUT_SIZE = 2048
+SAMPLE_MIN = UC_CLOCK//(FLUT_SIZE - 1) # 7816 Hz, fLUT[FLUT_SIZE-1]
+SAMPLE_MAX = 2**16 - 1
+
+
+def _as_bytes(data):
+    # bytes, bytearray, array.array('B') and numpy arrays are viewed as uint8
+    # without copying. pyusb's interruptRead() returns a tuple of ints which
+    # has to be copied once into a bytearray.
+    if isinstance(data, (tuple, list)):
+        data = bytearray(data)
+    return frombuffer(data, dtype=uint8)
+
+
+def decode_packets(data, protocol=PROTOCOL_V1):
+    """
+    Returns an (N, 3) uint32 array of the datasets held in data, a view of
+    it for protocol v1.
+
+    data may be a single packet or any number of packets joined end to end.
+    It may also be a list of packets, in which case they are joined first.
+    Each row of the result is (red, IR, sample number) and the rows are
+    ordered oldest to newest.
+    """
+
+    if isinstance(data, list) and len(data) > 0 and not isinstance(data[0], int):
+        buf = concatenate([_as_bytes(packet) for packet in data])
+    else:
+        buf = _as_bytes(data)
+
+    if protocol == PROTOCOL_V2:
+        return _decode_v2(buf)[0]
+
+    if len(buf) % DATASET_SIZE != 0:
+        raise ValueError('packet length %d is not a multiple of %d bytes' % (len(buf), DATASET_SIZE))
+
+    return frombuffer(buf, dtype=DATASET_DTYPE).reshape(-1, DATASET_FIELDS)
+
+
+def v2_headers(data):
+    """
+    Returns the V2_HEADER_DTYPE headers of the v2 packets joined end to end
+    in data.
+    """
+
+    return _decode_v2(_as_bytes(data))[1]
+
+
+def _decode_v2(buf):
+    # Each packet is only as long as its count says, so the headers are
+    # found one after the other. The samples between them are then
+    # gathered in one step.
+    header_size = V2_HEADER_DTYPE.itemsize
+    if len(buf) == 0:
+        # a zero-length read
+        return empty((0, DATASET_FIELDS), dtype=uint32), empty(0, dtype=V2_HEADER_DTYPE)
+    raw = bytearray(buf) # indexes to ints, far faster than numpy scalars
+    offsets = []
+    k = 0
+    while k < len(raw):
+        if len(raw) - k < header_size or raw[k] != PROTOCOL_V2 or raw[k+1] > V2_NUM_DATASETS:
+            raise ValueError('bad v2 packet at byte %d' % k)
+        offsets.append(k)
+        k += header_size + raw[k+1]*V2_DATASET_SIZE
+    if k != len(raw):
+        raise ValueError('v2 packet at byte %d is cut short' % offsets[-1])
+
+    if len(offsets) == 1:
+        headers = buf[:header_size].view(V2_HEADER_DTYPE)
+        samples = buf[header_size:].view(V2_SAMPLE_DTYPE).reshape(-1, 2)
+        datasets = empty((len(samples), DATASET_FIELDS), dtype=uint32)
+        datasets[:, RED] = samples[:, 0]
+        datasets[:, IR] = samples[:, 1]
+        datasets[:, SAMPLE_NUM] = (int(headers['first'][0]) + arange(len(samples))) % 2**32
+        return datasets, headers
+
+    offsets = asarray(offsets, dtype=int64)
+    headers = buf[(offsets[:, None] + arange(header_size)).ravel()].view(V2_HEADER_DTYPE)
+    counts = headers['count'].astype(int64)
+    # index of every sample byte, and of each dataset in its packet
+    sizes = counts*V2_DATASET_SIZE
+    ends = cumsum(sizes)
+    index = arange(ends[-1]) + repeat(offsets + header_size - (ends - sizes), sizes)
+    samples = buf[index].view(V2_SAMPLE_DTYPE).reshape(-1, 2)
+    within = arange(len(samples)) - repeat(cumsum(counts) - counts, counts)
+
+    datasets = empty((len(samples), DATASET_FIELDS), dtype=uint32)
+    datasets[:, RED] = samples[:, 0]
+    datasets[:, IR] = samples[:, 1]
+    datasets[:, SAMPLE_NUM] = (repeat(headers['first'].astype(int64), counts) + within) % 2**32
+    return datasets, headers
+
+
+def encode_v2(first, datasets, overflow=0):
+    """
+    Returns the bytes of a v2 packet of up to V2_NUM_DATASETS (red, IR)
+    rows, the first with sample number first, like Send_Data_V2() sends.
+    """
+
+    header = empty(1, dtype=V2_HEADER_DTYPE)
+    header['version'] = PROTOCOL_V2
+    header['count'] = len(datasets)
+    header['overflow'] = overflow % 2**16
+    header['first'] = first % 2**32
+    samples = empty((len(datasets), 2), dtype=V2_SAMPLE_DTYPE)
+    samples[:] = datasets[:, :2]
+    return header.tobytes() + samples.tobytes()
+
+
+def ring_write(cb, i, values):
+    """
+    Copies values into the circular buffer cb starting at index i, wrapping
+    around the end of cb if needed. Returns the index following the last
+    value written.
+    """
+
+    L = len(cb)
+    num = len(values)
+    if num >= L:
+        # only the newest L values survive, the last of them at the same
+        # slot a shorter write would have left it
+        values = values[num-L:]
+        i = (i + num) % L
+        cb[i:] = values[:L-i]
+        cb[:i] = values[L-i:]
+        return i
+
+    end = i + num
+    if end <= L:
+        cb[i:end] = values
+    else:
+        cb[i:] = values[:L-i]
+        cb[:end-L] = values[L-i:]
+    return end % L
+
+
+def refresh_due(i, num, buffersize, samples_per_refresh, step=UC_NUM_DATASETS):
+    """
+    The ring index advances by step datasets per packet and a refresh is due
+    whenever it lands on a multiple of samples_per_refresh. Returns True if
+    that happened while num datasets were written starting at index i.
+    """
+
+    idx = (i + arange(step, num+1, step)) % buffersize
+    return bool((idx % samples_per_refresh == 0).any())
@@ -0,0 +1,130 @@
+'''
+A signal quality index for each beat, to keep motion artifacts and a loose
+finger clip out of the heart rate and SpO2.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A beat is scored on the samples from its peak to its trough, one cycle of
+the PPG, as soon as the trough confirms it. The score is the worst of:
+
+    the correlation of its shape with a running average of the beats
+      accepted before it, the template
+    the correlation of its red and IR PPGs, which a real pulse moves
+      together but noise doesn't
+    how close its amplitude is to the template's, the smaller of their
+      ratios
+
+A beat with samples clipped at either end of the range the firmware can
+report (see SAMPLE_MIN and SAMPLE_MAX in pulseox_protocol.py) or with a
+perfusion index outside PERFUSION_RANGE scores 0 without the rest being
+worked out. A score of QUALITY_THRESHOLD or more accepts the beat.
+
+The template is the mean of the first TEMPLATE_BEATS accepted beats and an
+exponential average after that. Until then only the red and IR agreement
+counts. After MAX_REJECTED beats in a row are rejected the template starts
+over, so a new finger position or a changed pulse shape is learned again.
+Scoring a beat is a handful of numpy operations on 32 points.
+
+    quality = BeatQuality()
+    score = quality.assess(Ired[peak:trough+1], Iir[peak:trough+1])
+'''
+
+from numpy import arange, asarray, float64, interp, linspace, log, sqrt
+
+from pulseox_protocol import SAMPLE_MAX, SAMPLE_MIN
+
+QUALITY_THRESHOLD = 0.5
+TEMPLATE_POINTS = 32 # a beat is resampled to this many points
+TEMPLATE_BEATS = 4
+TEMPLATE_WEIGHT = 0.1 # of each beat accepted in the template after that
+MAX_REJECTED = 10
+PERFUSION_RANGE = (0.05, 20.0) # percent
+CLIP_MARGIN = 0.01 # fraction of SAMPLE_MIN and SAMPLE_MAX
+
+
+def _shape(ppg):
+    # the PPG resampled to TEMPLATE_POINTS with zero mean and unit length
+    x = interp(linspace(0, len(ppg) - 1, TEMPLATE_POINTS), arange(len(ppg)), ppg)
+    x -= x.mean()
+    norm = sqrt((x*x).sum())
+    return x/norm if norm > 0 else x
+
+
+class BeatQuality():
+    """
+    Scores beats between 0 (garbage) and 1 and learns the template from the
+    ones accepted.
+    """
+
+    def __init__(self, threshold=QUALITY_THRESHOLD):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.template = None # shape of the accepted beats
+        self.amplitude = None # and their perfusion index
+        self.learned = 0 # beats in the template
+        self.rejected = 0 # beats rejected in a row
+
+    def _score(self, Ired, Iir):
+        # the score, shape and perfusion index of a cycle, the last two
+        # None if it failed outright
+        Ired = asarray(Ired, dtype=float64)
+        Iir = asarray(Iir, dtype=float64)
+        if len(Ired) < 3:
+            return 0.0, None, None
+        lowest = min(Ired.min(), Iir.min())
+        highest = max(Ired.max(), Iir.max())
+        if lowest <= SAMPLE_MIN*(1 + CLIP_MARGIN) or highest >= SAMPLE_MAX*(1 - CLIP_MARGIN):
+            return 0.0, None, None
+
+        ppg_red = -log(Ired)
+        ppg_ir = -log(Iir)
+        # the perfusion index is the pulsatile part of the IR over the
+        # steady part, which for small swings is the swing of the PPG
+        swing_red = ppg_red.max() - ppg_red.min()
+        swing_ir = ppg_ir.max() - ppg_ir.min()
+        perfusion = 100*swing_ir
+        if not PERFUSION_RANGE[0] <= perfusion <= PERFUSION_RANGE[1] or swing_red <= 0:
+            return 0.0, None, None
+
+        score = max(float((_shape(ppg_red)*_shape(ppg_ir)).sum()), 0.0)
+        shape = _shape(ppg_red/swing_red + ppg_ir/swing_ir)
+        if self.learned >= TEMPLATE_BEATS:
+            score = min(score, max(float((shape*self.template).sum()), 0.0),
+                        perfusion/self.amplitude, self.amplitude/perfusion)
+        return score, shape, perfusion
+
+    def score(self, Ired, Iir):
+        """
+        Returns the score of one cycle of intensities, the peak of the PPG
+        first, without learning from it.
+        """
+
+        return self._score(Ired, Iir)[0]
+
+    def assess(self, Ired, Iir):
+        """
+        Returns the score of one cycle of intensities, the peak of the PPG
+        first, and adds it to the template if it's accepted.
+        """
+
+        score, shape, perfusion = self._score(Ired, Iir)
+        if score < self.threshold:
+            self.rejected += 1
+            if self.rejected >= MAX_REJECTED:
+                self.reset()
+            return score
+        self.rejected = 0
+
+        if self.learned == 0:
+            self.template = shape
+            self.amplitude = perfusion
+        else:
+            # the mean of the first beats, then an exponential average
+            w = max(1.0/(self.learned + 1), TEMPLATE_WEIGHT)
+            self.template = (1 - w)*self.template + w*shape
+            self.template /= sqrt((self.template*self.template).sum())
+            self.amplitude = (1 - w)*self.amplitude + w*perfusion
+        self.learned += 1
+        return score
@@ -0,0 +1,147 @@
+'''
+Prepares the photoplethysmograms for plotting. Doesn't need PyQt4.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A window has more samples than the graph is pixels wide, 1500 samples in
+780 pixels for the short view and 12000 in 1210 for the long view. Plotting
+every STEP-th sample throws away whatever happens between them so narrow
+peaks come and go as the window slides. Instead the samples that land in
+each pixel column are reduced to their minimum and maximum, in the order
+they occur, which draws exactly the same picture as plotting every sample.
+
+The history view (see pulseox_history.py) gets each column's minimum and
+maximum intensities from the decimation pyramid instead, so it only knows
+their range and not their order. Drawing the bottom and then the top of
+each column fills in the same pixels.
+'''
+
+from numpy import arange, asarray, concatenate, diff, empty, flatnonzero, float64, \
+                  int64, isnan, log, maximum, minimum, nan_to_num, searchsorted, unique
+
+
+def column_starts(x, width):
+    """
+    Returns the index of the first sample in each pixel column for samples
+    at increasing x coordinates.
+    """
+
+    columns = x.astype(int64)
+    columns[columns >= width] = width - 1
+    return concatenate([[0], flatnonzero(columns[1:] != columns[:-1]) + 1])
+
+
+def minmax_indices(x, y, width):
+    """
+    Returns the indices of the samples to plot so that every pixel column
+    keeps its minimum and maximum y. x must be increasing, like tn.
+    """
+
+    num = len(y)
+    if num <= 2*width:
+        return arange(num)
+
+    starts = column_starts(x, width)
+    counts = diff(concatenate([starts, [num]]))
+
+    mins = minimum.reduceat(y, starts)
+    maxs = maximum.reduceat(y, starts)
+    if isnan(mins).any():
+        # a flat window normalizes to nan, which equals nothing
+        y = nan_to_num(y)
+        mins = minimum.reduceat(y, starts)
+        maxs = maximum.reduceat(y, starts)
+
+    # position of the first minimum and the first maximum in each column
+    imin = _first_match(y, mins, starts, counts)
+    imax = _first_match(y, maxs, starts, counts)
+
+    idx = empty(2*len(starts), dtype=int64)
+    idx[0::2] = minimum(imin, imax)
+    idx[1::2] = maximum(imin, imax)
+    return idx
+
+
+def _first_match(y, values, starts, counts):
+    # index of the first sample in each column equal to that column's value
+    positions = flatnonzero(y == values.repeat(counts))
+    return positions[searchsorted(positions, starts)]
+
+
+def trace_points(x, y, width, floor, scale):
+    """
+    Returns an (N, 2) array of the pixel coordinates of the decimated trace
+    of y drawn scale pixels high above the baseline floor.
+    """
+
+    idx = minmax_indices(x, y, width)
+    points = empty((len(idx), 2), dtype=float64)
+    points[:, 0] = x[idx]
+    points[:, 1] = floor - scale*y[idx]
+    return points
+
+
+def compact_frame(tn, nPPG_red, nPPG_ir, systole, diastole, width):
+    """
+    Returns tn, nPPG_red, nPPG_ir, systole, diastole cut down to the
+    samples trace_points() would draw for either PPG plus the peaks and
+    troughs, with systole and diastole indexing the result. It plots the
+    same as the full frame but is much smaller to send between processes.
+    """
+
+    keep = [minmax_indices(tn, nPPG_red, width), minmax_indices(tn, nPPG_ir, width)]
+    marked = systole != 'NA' and diastole != 'NA'
+    if marked:
+        keep += [asarray(systole, dtype=int64), asarray(diastole, dtype=int64)]
+    keep = unique(concatenate(keep))
+
+    if marked:
+        systole = searchsorted(keep, systole).tolist()
+        diastole = searchsorted(keep, diastole).tolist()
+    return tn[keep], nPPG_red[keep], nPPG_ir[keep], systole, diastole
+
+
+def envelope_ppgs(lo, hi):
+    """
+    Returns bottom, top, norm for the (red, IR) minimum and maximum
+    intensities of each column returned by History.envelope(). bottom and
+    top are (N, 2) arrays of the normalized PPGs at the bottom and top of
+    each column, normalized like analyze_window() does over the columns
+    given, and norm is what other samples are normalized by with
+    normalize_samples().
+    """
+
+    Imax = maximum(hi.max(axis=0), 1).astype(float64)
+    # the highest PPG is where the least light gets through
+    top = -log(maximum(lo, 1)/Imax)
+    bottom = -log(maximum(hi, 1)/Imax)
+    nf = float(top.max())
+    if nf <= 0:
+        # flat, drawn along the floor
+        nf = 1.0
+    norm = (Imax, nf)
+    return bottom/nf, top/nf, norm
+
+
+def normalize_samples(samples, norm):
+    """
+    Returns the normalized PPGs of (N, 2) (red, IR) samples with the norm
+    of envelope_ppgs().
+    """
+
+    Imax, nf = norm
+    return -log(maximum(samples, 1)/Imax)/nf
+
+
+def envelope_points(x, bottom, top, floor, scale):
+    """
+    Returns an (2N, 2) array of the pixel coordinates of the bottom and top
+    of each of N columns at x, drawn scale pixels high above floor.
+    """
+
+    points = empty((2*len(x), 2), dtype=float64)
+    points[0::2, 0] = x
+    points[1::2, 0] = x
+    points[0::2, 1] = floor - scale*bottom
+    points[1::2, 1] = floor - scale*top
+    return points
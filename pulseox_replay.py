@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+'''
+Replays recorded sessions through the same processing the GUI uses, as fast
+as the CPU allows, and writes the heart rate and SpO2 time series of each.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Recordings are the debug_data/rawdata.cap capture files written by
+pulseox_graph.py when DEBUG_DATA is True (see pulseox_capture.py) or the
+older rawdata.txt files, where each line holds the host time of the read,
+the sample number, the red sample and the IR sample. Many recordings can be
+replayed at once across a process pool:
+
+    python pulseox_replay.py -j 8 -o scores/ night1/rawdata.txt night2/rawdata.txt
+'''
+
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from numpy import array, column_stack, errstate, float64, int64, loadtxt, nan, savetxt, zeros
+
+from pulseox_engine import K, UC_SAMPLE_PERIOD, PulseOxEngine
+from pulseox_signal import SPO2_CURVE
+
+
+def read_rawdata(path):
+    """
+    Returns t, n, red, ir arrays read from a rawdata.txt file.
+    """
+
+    data = loadtxt(path, ndmin=2)
+    if len(data) == 0:
+        data = zeros((0, 4))
+    return data[:, 0], data[:, 1].astype(int64), data[:, 2].astype(int64), data[:, 3].astype(int64)
+
+
+def read_recording(path):
+    """
+    Returns t, n, red, ir arrays and the sample period from a rawdata.txt
+    file or a capture file written by pulseox_capture. rawdata.txt files
+    don't record the sample period, so UC_SAMPLE_PERIOD is assumed.
+    """
+
+    if path.endswith('.cap'):
+        from pulseox_capture import CaptureReader
+        reader = CaptureReader(path)
+        return reader.arrays() + (reader.sample_period,)
+    return read_rawdata(path) + (UC_SAMPLE_PERIOD,)
+
+
+def read_SpO2data(path):
+    """
+    Returns a list of (t, SpO2 list) read from a SpO2data.txt file.
+    """
+
+    rows = []
+    number = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan')
+    with open(path) as fi:
+        for line in fi:
+            fields = line.split(None, 1)
+            if len(fields) < 2:
+                continue
+            values = fields[1].replace('np.float64', '')
+            rows.append((float(fields[0]), [float(v) for v in number.findall(values)]))
+    return rows
+
+
+def replay(t, n, red, ir, sample_period=UC_SAMPLE_PERIOD, view='short', incremental=True,
+           K=K, curve=SPO2_CURVE):
+    """
+    Pushes the recorded datasets, sampled every sample_period seconds,
+    through a PulseOxEngine, refreshing wherever the GUI would have, and
+    returns an (M, 4) array with one row per refresh: host time and sample
+    number of the newest sample, heart rate and SpO2 (nan while unknown).
+    """
+
+    engine = PulseOxEngine(view, K=K, incremental=incremental, curve=curve,
+                           sample_period=sample_period)
+    datasets = column_stack([red, ir, n]).astype(int64)
+    rows = []
+    k = 0
+    # the window starts out flat so the first refreshes divide 0 by 0
+    with errstate(divide='ignore', invalid='ignore'):
+        while k < len(datasets):
+            num = engine.until_refresh()
+            due = engine.push(datasets[k:k+num])
+            k += num
+            if due:
+                engine.process()
+                last = min(k, len(datasets))-1
+                hr = engine.heartrate
+                SpO2 = engine.SpO2
+                rows.append((t[last], n[last],
+                             nan if hr is None else hr,
+                             nan if SpO2 is None else SpO2))
+    return array(rows, dtype=float64).reshape(-1, 4)
+
+
+def replay_file(args):
+    # pool worker: replays one recording and writes its time series
+    path, outdir, view, incremental, K, curve = args
+    t0 = time.time()
+    t, n, red, ir, sample_period = read_recording(path)
+    series = replay(t, n, red, ir, sample_period, view, incremental, K, curve)
+    elapsed = time.time()-t0
+
+    outpath = None
+    if outdir is not None:
+        name = os.path.splitext(path.strip(os.sep).replace(os.sep, '_'))[0]
+        outpath = os.path.join(outdir, name+'.vitals.txt')
+        savetxt(outpath, series, fmt=['%.6f', '%d', '%.2f', '%.2f'],
+                header='t n heartrate SpO2')
+
+    return path, outpath, len(n), len(n)*sample_period, len(series), elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded pulse oximeter sessions.')
+    parser.add_argument('recordings', nargs='+', help='rawdata.txt or .cap files')
+    parser.add_argument('-o', '--outdir', help='directory for the .vitals.txt time series')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--view', choices=['short', 'long'], default='short')
+    parser.add_argument('--batch', action='store_true',
+                        help='reprocess the whole window every refresh instead of incrementally')
+    parser.add_argument('-K', type=float, default=K, help='SpO2 calibration constant')
+    parser.add_argument('--profile', help='calibration profile written by pulseox_calibrate.py '
+                                          'to use instead of -K')
+    args = parser.parse_args(argv)
+
+    curve = SPO2_CURVE
+    if args.profile is not None:
+        from pulseox_calibrate import load_profile
+        profile = load_profile(args.profile)
+        args.K = profile['K']
+        curve = profile['curve']
+
+    if args.outdir is not None and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    jobs = [(path, args.outdir, args.view, not args.batch, args.K, curve)
+            for path in args.recordings]
+
+    t0 = time.time()
+    total_samples = 0
+    total_seconds = 0 # recorded
+    if args.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(replay_file, jobs)
+    else:
+        pool = None
+        results = map(replay_file, jobs)
+
+    for path, outpath, samples, seconds, refreshes, elapsed in results:
+        total_samples += samples
+        total_seconds += seconds
+        rate = samples/elapsed if elapsed > 0 else float('inf')
+        print('%s: %d samples, %d refreshes in %.2f s (%.0f samples/s)%s' %
+              (path, samples, refreshes, elapsed, rate, '' if outpath is None else ' -> '+outpath))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    wall = time.time()-t0
+    print('%d recordings, %d samples in %.2f s: %.0f samples/s, %.0fx real time' %
+          (len(jobs), total_samples, wall, total_samples/wall,
+           total_seconds/wall))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+'''
+Draws review sheets of recorded sessions, the photoplethysmograms the way
+the graph draws them with the heart markers on each beat, into PNG or SVG
+files without PyQt4 or a display.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+A sheet splits a stretch of a recording, all of it by default, into rows
+one above the other. Each row is drawn like Graph.paintEvent() draws the
+history, the red and IR traces from the lowest and highest sample in each
+pixel column of a pulseox_history pyramid, so an hour takes about as long
+to draw as a few seconds. The recording goes through a PulseOxEngine once,
+as in pulseox_replay.py, for the beats and the vitals. Each row is labelled
+with the time it starts and the median heart rate and SpO2 over it, and
+rows no longer than MARKER_SPAN get the peaks and troughs marked with
+heart_peak.png and heart_trough.png. Many recordings are drawn at once
+across a process pool:
+
+    python pulseox_report.py -j 8 -o sheets/ night1/rawdata.cap night2/rawdata.cap
+    python pulseox_report.py --start 3600 --end 3660 --rows 2 --format svg night1/rawdata.cap
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from numpy import array, column_stack, errstate, float64, int64, isfinite, median, nan, \
+                  searchsorted, zeros
+
+from pulseox_engine import K, UC_SAMPLE_PERIOD, PulseOxEngine
+from pulseox_history import History
+from pulseox_image import BLACK, GREY, RED, SVG, Raster, read_png
+from pulseox_render import envelope_points, envelope_ppgs, normalize_samples
+from pulseox_replay import read_recording
+from pulseox_signal import SPO2_CURVE
+
+ROWS = 8
+WIDTH = 1210 # pixels, as wide as the long view
+ROW_HEIGHT = 170 # pixels
+TITLE_HEIGHT = 24 # pixels
+LABEL_HEIGHT = 14 # pixels, above the traces of each row
+MARKER_SPAN = 60 # seconds, rows no longer than this get their beats marked
+LINE_GREY = (208, 208, 208)
+# The GUI refreshes every 45 samples (short view) to keep the display
+# moving. A sheet only needs the beats, which the BeatTracker reports once
+# whatever the refresh rate, and the vitals over minutes, so the engine is
+# refreshed a fifth of a short window at a time, about 3 times faster.
+REFRESH = 300 # samples, 1.8 s
+
+IMAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def analyze(datasets, view='short', K=K, curve=SPO2_CURVE, refresh=REFRESH,
+            sample_period=UC_SAMPLE_PERIOD):
+    """
+    Pushes an (N, 3) array of (red, IR, sample number) rows, sampled every
+    sample_period seconds, through a PulseOxEngine like replay(),
+    refreshing every refresh samples, and
+    returns vitals, an (M, 3) array of the sample number of the newest
+    sample, heart rate and SpO2 (nan while unknown) of each refresh, and the
+    sample numbers of the peak and trough of every beat.
+    """
+
+    engine = PulseOxEngine(view, K=K, curve=curve, SAMPLES_PER_REFRESH=refresh,
+                           sample_period=sample_period)
+    rows = []
+    peaks = []
+    troughs = []
+    k = 0
+    # the window starts out flat so the first refreshes divide 0 by 0
+    with errstate(divide='ignore', invalid='ignore'):
+        while k < len(datasets):
+            num = engine.until_refresh()
+            due = engine.push(datasets[k:k+num])
+            k += num
+            if due:
+                engine.process()
+                hr = engine.heartrate
+                SpO2 = engine.SpO2
+                rows.append((engine.window()[0][-1],
+                             nan if hr is None else hr,
+                             nan if SpO2 is None else SpO2))
+                for beat in engine.new_beats:
+                    peaks.append(beat.n)
+                    troughs.append(beat.trough)
+    return array(rows, dtype=float64).reshape(-1, 3), \
+           array(peaks, dtype=int64), array(troughs, dtype=int64)
+
+
+def _median(values):
+    values = values[isfinite(values)]
+    if len(values) == 0:
+        return None
+    return median(values)
+
+
+def _clock(t):
+    return time.strftime('%H:%M:%S', time.localtime(t))
+
+
+def _duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds//3600, seconds//60 % 60, seconds % 60)
+
+
+class Sheet():
+    """
+    Lays out and draws the rows of a sheet onto a pulseox_image Raster or
+    SVG painter.
+    """
+
+    def __init__(self, painter, width=WIDTH):
+        self.painter = painter
+        self.width = width
+        self.heart_peak = read_png(os.path.join(IMAGE_DIR, 'heart_peak.png'))
+        self.heart_trough = read_png(os.path.join(IMAGE_DIR, 'heart_trough.png'))
+        self.hw = self.heart_peak.shape[1]/2.0
+        self.hh = self.heart_peak.shape[0]
+        # the same proportions as the graph's, in each row below its label
+        height = ROW_HEIGHT - LABEL_HEIGHT
+        self.floor_red = LABEL_HEIGHT + height/2.0 - self.hh
+        self.floor_ir = LABEL_HEIGHT + height - self.hh
+        self.sf = height/2.0 - 2*self.hh
+
+    def title(self, text):
+        self.painter.text(5, 5, text, BLACK)
+
+    def row(self, r, history, p0, p1, label, peaks=None, troughs=None):
+        """
+        Draws the samples at positions p0 to p1 in row r, with the peaks and
+        troughs at the sample numbers given marked.
+        """
+
+        top = TITLE_HEIGHT + r*ROW_HEIGHT
+        painter = self.painter
+        painter.polyline([[0, top], [self.width - 1, top]], LINE_GREY)
+        painter.text(5, top + 2, label, GREY)
+
+        x, lo, hi = history.envelope(p0, p1, self.width)
+        if len(x) == 0:
+            return
+        bottom, top_ppg, norm = envelope_ppgs(lo, hi)
+        # x is across the positions held, which p0 may be before
+        q0 = max(p0, history.start)
+        span = float(p1 - p0)
+        x = (q0 - p0 + x*float(min(p1, history.total) - q0)/self.width)*self.width/span
+        painter.polyline(envelope_points(x, bottom[:, 0], top_ppg[:, 0],
+                                         top + self.floor_red, self.sf), RED)
+        painter.polyline(envelope_points(x, bottom[:, 1], top_ppg[:, 1],
+                                         top + self.floor_ir, self.sf), BLACK)
+
+        if peaks is None:
+            return
+        for marks, image, above in [(peaks, self.heart_peak, self.hh),
+                                    (troughs, self.heart_trough, 0)]:
+            p = history.positions(marks)
+            p = p[(p >= q0) & (p < p1)]
+            heights = self.sf*normalize_samples(history.samples(p), norm)
+            for k in range(len(p)):
+                t1 = self.width*(p[k] - p0 + 0.5)/span - self.hw
+                painter.image(image, t1, top + self.floor_red - (heights[k, 0] + above))
+                painter.image(image, t1, top + self.floor_ir - (heights[k, 1] + above))
+
+
+def report(t, n, red, ir, path, fmt='png', rows=ROWS, row_seconds=None, width=WIDTH,
+           title='', vitals=True, view='short', K=K, curve=SPO2_CURVE,
+           sample_period=UC_SAMPLE_PERIOD):
+    """
+    Draws a sheet of the recorded datasets, sampled every sample_period
+    seconds, to path and returns the number of rows drawn. The rows split
+    the datasets evenly unless row_seconds is given. With vitals False the
+    engine isn't run, for the traces alone.
+    """
+
+    datasets = column_stack([red, ir, n]).astype(int64)
+    history = History(max(len(datasets) + len(datasets)//4, 1))
+    history.push(datasets)
+    p_start, p_end = history.start, history.total
+    if row_seconds is not None:
+        per_row = max(int(round(row_seconds/sample_period)), 1)
+        rows = max(-(-(p_end - p_start)//per_row), 1)
+    else:
+        per_row = max(-(-(p_end - p_start)//rows), 1)
+
+    if vitals and len(datasets) > 0:
+        series, peaks, troughs = analyze(datasets, view, K, curve, sample_period=sample_period)
+    else:
+        series, peaks, troughs = zeros((0, 3)), None, None
+
+    if fmt == 'svg':
+        painter = SVG(width, TITLE_HEIGHT + rows*ROW_HEIGHT)
+    else:
+        painter = Raster(width, TITLE_HEIGHT + rows*ROW_HEIGHT)
+    sheet = Sheet(painter, width)
+    first = history.sample_numbers([p_start])[0] if p_end > p_start else 0
+    t0 = t[0] if len(t) > 0 else 0.0
+    sheet.title('%s  %s  %s' % (title, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t0)),
+                                _duration((p_end - p_start)*sample_period)))
+
+    for r in range(rows):
+        p0 = p_start + r*per_row
+        p1 = p0 + per_row
+        held = min(p1, p_end)
+        label = ''
+        if held > p0:
+            n0, n1 = history.sample_numbers([p0, held - 1])
+            offset = (n0 - first)*sample_period
+            label = '%s  +%s' % (_clock(t0 + offset), _duration(offset))
+            if len(series) > 0:
+                inside = (series[:, 0] >= n0) & (series[:, 0] <= n1)
+                hr = _median(series[inside, 1])
+                SpO2 = _median(series[inside, 2])
+                label += '  HR %s  SPO2 %s' % ('--' if hr is None else '%.0f' % hr,
+                                               '--' if SpO2 is None else '%.1f%%' % SpO2)
+        marked = peaks is not None and per_row*sample_period <= MARKER_SPAN
+        sheet.row(r, history, p0, p1, label,
+                  peaks if marked else None, troughs if marked else None)
+    painter.save(path)
+    return rows
+
+
+def report_file(args):
+    # pool worker: draws the sheet of one recording
+    path, outdir, fmt, start, end, rows, row_seconds, width, vitals, view, K, curve = args
+    t0 = time.time()
+    t, n, red, ir, sample_period = read_recording(path)
+    # the stretch asked for, by host time from the start of the recording
+    if len(t) > 0:
+        a = 0 if start is None else searchsorted(t, t[0] + start, 'left')
+        b = len(t) if end is None else searchsorted(t, t[0] + end, 'left')
+        t, n, red, ir = t[a:b], n[a:b], red[a:b], ir[a:b]
+
+    name = os.path.splitext(path.strip(os.sep).replace(os.sep, '_'))[0]
+    outpath = os.path.join(outdir, name+'.'+fmt)
+    drawn = report(t, n, red, ir, outpath, fmt, rows, row_seconds, width, name, vitals,
+                   view, K, curve, sample_period)
+    return path, outpath, len(n), len(n)*sample_period, drawn, time.time()-t0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Draw review sheets of recorded pulse '
+                                                 'oximeter sessions.')
+    parser.add_argument('recordings', nargs='+', help='rawdata.txt or .cap files')
+    parser.add_argument('-o', '--outdir', default='.', help='directory for the sheets')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--format', choices=['png', 'svg'], default='png')
+    parser.add_argument('--start', type=float, help='seconds from the start of each recording')
+    parser.add_argument('--end', type=float, help='seconds from the start of each recording')
+    parser.add_argument('--rows', type=int, default=ROWS)
+    parser.add_argument('--row-seconds', type=float,
+                        help='seconds per row, as many rows as it takes instead of --rows')
+    parser.add_argument('--width', type=int, default=WIDTH, help='pixels')
+    parser.add_argument('--no-vitals', action='store_true',
+                        help="don't run the engine, just draw the traces")
+    parser.add_argument('--view', choices=['short', 'long'], default='short')
+    parser.add_argument('-K', type=float, default=K, help='SpO2 calibration constant')
+    parser.add_argument('--profile', help='calibration profile written by pulseox_calibrate.py '
+                                          'to use instead of -K')
+    args = parser.parse_args(argv)
+
+    curve = SPO2_CURVE
+    if args.profile is not None:
+        from pulseox_calibrate import load_profile
+        profile = load_profile(args.profile)
+        args.K = profile['K']
+        curve = profile['curve']
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    jobs = [(path, args.outdir, args.format, args.start, args.end, args.rows, args.row_seconds,
+             args.width, not args.no_vitals, args.view, args.K, curve)
+            for path in args.recordings]
+
+    t0 = time.time()
+    total_seconds = 0 # recorded
+    if args.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(report_file, jobs)
+    else:
+        pool = None
+        results = map(report_file, jobs)
+
+    for path, outpath, samples, seconds, rows, elapsed in results:
+        total_seconds += seconds
+        print('%s: %d samples, %d rows in %.2f s -> %s' % (path, samples, rows, elapsed, outpath))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    wall = time.time()-t0
+    print('%d sheets, %.1f hours of recordings in %.2f s' %
+          (len(jobs), total_seconds/3600, wall))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,481 @@
+#!/usr/bin/python
+
+'''
+Streams the waveforms and vitals of every pulse oximeter on the host to any
+number of subscribers over TCP.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+After every refresh of a device a frame is published to every connected
+client. A frame holds the raw red and IR samples that arrived since the
+device's last frame, the sample numbers of the peaks and troughs found
+since then, and the heart rate and SpO2. Frames are little endian binary:
+
+    uint32  length of the rest of the frame
+    4s      b'POXF'
+    uint8   version
+    uint8   flags, bit 0 set if the sample numbers aren't consecutive
+    uint16  length of the device key
+    uint32  frame sequence number, per device
+    float64 host time the newest read of the frame was made
+    int64   sample number of the first sample
+    uint32  number of samples
+    uint16  number of peaks
+    uint16  number of troughs
+    float32 heart rate [bpm], NaN while it's unknown
+    float32 SpO2 [%], NaN while it's unknown
+    ...     the device key (utf-8), the sample numbers less the first one
+            as uint32 if flag 0 is set, the red samples and the IR samples
+            as uint32, and the sample numbers of the peaks and the troughs
+            as int64
+
+Each client has a bounded queue of frames and a thread that sends them. A
+client that can't keep up loses its oldest frames, the dropped frames show
+as a jump in the sequence number, and never holds up the publisher or the
+other clients.
+
+    python pulseox_server.py serve --simulate 8
+    python pulseox_server.py loadtest --clients 100 --seconds 20
+'''
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from numpy import arange, asarray, dtype, frombuffer, int64, nan, searchsorted
+
+from pulseox_manager import DeviceManager, simulated_devices
+from pulseox_device import find_usb_devices
+from pulseox_profile import Histogram
+
+PORT = 8630
+CLIENT_QUEUE_SIZE = 64 # frames, about 6 seconds of one device at the short view
+SEND_TIMEOUT = 5.0 # seconds, a client that blocks a send this long is dropped
+
+FRAME_MAGIC = b'POXF'
+FRAME_VERSION = 1
+FLAG_SAMPLE_NUMBERS = 1
+
+LENGTH = struct.Struct('<I')
+HEADER = struct.Struct('<4sBBHIdqIHHff')
+SAMPLE_DTYPE = dtype('<u4')
+BEAT_DTYPE = dtype('<i8')
+
+
+def encode_frame(key, seq, t, n, red, ir, systole, diastole, heartrate, SpO2):
+    """
+    Returns the frame of the samples n, red, ir and the sample numbers of
+    the peaks and troughs, length prefix included.
+    """
+
+    key = key.encode('utf-8')
+    num = len(n)
+    n0 = int(n[0]) if num else 0
+    flags = 0
+    pieces = [key]
+    if num and int(n[-1]) - n0 != num - 1:
+        flags |= FLAG_SAMPLE_NUMBERS
+        pieces.append((n - n0).astype(SAMPLE_DTYPE).tobytes())
+    pieces.append(red.astype(SAMPLE_DTYPE).tobytes())
+    pieces.append(ir.astype(SAMPLE_DTYPE).tobytes())
+    pieces.append(systole.astype(BEAT_DTYPE).tobytes())
+    pieces.append(diastole.astype(BEAT_DTYPE).tobytes())
+
+    header = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, len(key), seq, t, n0, num,
+                         len(systole), len(diastole),
+                         nan if heartrate is None else heartrate, nan if SpO2 is None else SpO2)
+    body = header + b''.join(pieces)
+    return LENGTH.pack(len(body)) + body
+
+
+def decode_header(body):
+    """
+    Returns the header fields of a frame without its length prefix as a
+    dict. The key, samples and beats follow at HEADER.size.
+    """
+
+    (magic, version, flags, key_len, seq, t, n0, num, num_systole, num_diastole,
+     heartrate, SpO2) = HEADER.unpack_from(body)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError('not a version %d frame' % FRAME_VERSION)
+    return dict(flags=flags, key_len=key_len, seq=seq, t=t, n0=n0, num=num,
+                num_systole=num_systole, num_diastole=num_diastole,
+                heartrate=None if heartrate != heartrate else heartrate,
+                SpO2=None if SpO2 != SpO2 else SpO2)
+
+
+def decode_frame(body):
+    """
+    Returns a frame without its length prefix as a dict of key, seq, t,
+    n, red, ir, systole, diastole, heartrate and SpO2.
+    """
+
+    frame = decode_header(body)
+    offset = HEADER.size
+    frame['key'] = body[offset:offset+frame['key_len']].decode('utf-8')
+    offset += frame['key_len']
+
+    num = frame['num']
+    if frame['flags'] & FLAG_SAMPLE_NUMBERS:
+        n = frombuffer(body, SAMPLE_DTYPE, num, offset).astype(int64) + frame['n0']
+        offset += num*SAMPLE_DTYPE.itemsize
+    else:
+        n = frame['n0'] + arange(num, dtype=int64)
+    frame['n'] = n
+    for name in ['red', 'ir']:
+        frame[name] = frombuffer(body, SAMPLE_DTYPE, num, offset)
+        offset += num*SAMPLE_DTYPE.itemsize
+    for name, count in [('systole', frame['num_systole']), ('diastole', frame['num_diastole'])]:
+        frame[name] = frombuffer(body, BEAT_DTYPE, count, offset)
+        offset += count*BEAT_DTYPE.itemsize
+    return frame
+
+
+def recv_frames(sock, size=65536):
+    """
+    Yields the frames, without their length prefix, received on sock until
+    it's closed.
+    """
+
+    buf = b''
+    while True:
+        data = sock.recv(size)
+        if not data:
+            return
+        buf += data
+        start = 0
+        while len(buf) - start >= LENGTH.size:
+            length = LENGTH.unpack_from(buf, start)[0]
+            end = start + LENGTH.size + length
+            if end > len(buf):
+                break
+            yield buf[start+LENGTH.size:end]
+            start = end
+        buf = buf[start:]
+
+
+class FrameBuilder():
+    """
+    Makes the frames of one device from its PulseOxEngine, each holding
+    what's new since the last one.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.seq = 0
+        self.last_n = None # sample number of the newest sample sent
+        self.last_beat = None # and of the newest peak or trough
+
+    def build(self, engine, result, t):
+        n, red, ir = engine.window()
+        start = 0 if self.last_n is None else searchsorted(n, self.last_n, 'right')
+        if start < len(n):
+            self.last_n = int(n[-1])
+
+        systole, diastole = result[3], result[4]
+        beats = []
+        if systole != 'NA' and diastole != 'NA':
+            for indices in [systole, diastole]:
+                beats.append(n[asarray(indices, dtype=int64)])
+        else:
+            beats = [n[:0], n[:0]]
+        if self.last_beat is not None:
+            beats = [b[b > self.last_beat] for b in beats]
+        newest = [int(b.max()) for b in beats if len(b)]
+        if newest:
+            self.last_beat = max(newest)
+
+        frame = encode_frame(self.key, self.seq, t, n[start:], red[start:], ir[start:],
+                             beats[0], beats[1], engine.heartrate, engine.SpO2)
+        self.seq = (self.seq + 1) % 2**32
+        return frame
+
+
+class Client():
+    """
+    A connected subscriber and the thread sending it frames.
+    """
+
+    def __init__(self, server, sock, address, queue_size):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.queue = queue.Queue(queue_size)
+        self.sent = 0 # frames
+        self.bytes = 0
+        self.dropped = 0 # frames discarded because the queue was full
+        self.thread = threading.Thread(target=self._send)
+        self.thread.daemon = True
+
+    def put(self, frame):
+        # Like Reader._put(), the oldest frame makes room for the newest.
+        while True:
+            try:
+                self.queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _send(self):
+        try:
+            while True:
+                frames = [self.queue.get()]
+                # everything that queued up meanwhile goes in one send
+                while True:
+                    try:
+                        frames.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in frames:
+                    break
+                data = b''.join(frames)
+                self.sock.sendall(data)
+                self.sent += len(frames)
+                self.bytes += len(data)
+        except (socket.error, socket.timeout):
+            pass
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.server._disconnected(self)
+
+    def close(self):
+        self.put(None)
+
+
+class StreamServer():
+    """
+    Accepts subscribers on a TCP port and sends each one every frame passed
+    to publish().
+    """
+
+    def __init__(self, host='', port=PORT, queue_size=CLIENT_QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.clients = []
+        self.lock = threading.Lock()
+        self.published = 0
+        self.disconnected = 0
+        # sent, bytes and dropped of the clients that have disconnected
+        self.closed = dict(sent=0, bytes=0, dropped=0)
+        self.listener = None
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1] # in case port was 0
+        self.accepter = threading.Thread(target=self._accept)
+        self.accepter.daemon = True
+        self.accepter.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error:
+                break # closed by stop()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(SEND_TIMEOUT)
+            client = Client(self, sock, address, self.queue_size)
+            with self.lock:
+                self.clients.append(client)
+            client.thread.start()
+
+    def _disconnected(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.disconnected += 1
+                for name in self.closed:
+                    self.closed[name] += getattr(client, name)
+
+    def publish(self, frame):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.put(frame)
+        self.published += 1
+
+    def stop(self):
+        if self.listener is None:
+            return
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        self.accepter.join()
+        self.listener = None
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+        for client in clients:
+            client.thread.join()
+
+    def status(self):
+        with self.lock:
+            clients = list(self.clients)
+            status = dict(self.closed)
+        for name in status:
+            status[name] += sum([getattr(c, name) for c in clients])
+        status.update(clients=len(clients), published=self.published,
+                      disconnected=self.disconnected)
+        return status
+
+
+def serve(manager, server):
+    """
+    Publishes every refresh of manager's devices on server. Call before
+    manager.start(). The frames are built from the engines' windows so the
+    manager can't use worker processes.
+    """
+
+    if manager.processes:
+        raise ValueError('the devices must be processed in this process')
+    builders = {} # (channel, FrameBuilder) by key
+
+    def on_refresh(channel, result):
+        # A channel is only ever processed by one worker at a time so its
+        # builder needs no lock. A device that was removed and added again
+        # starts over with a new channel.
+        last_channel, builder = builders.get(channel.key, (None, None))
+        if last_channel is not channel:
+            builder = FrameBuilder(channel.key)
+            builders[channel.key] = (channel, builder)
+        server.publish(builder.build(channel.engine, result, channel.last_read))
+
+    manager.on_refresh = on_refresh
+
+
+class LoadClient(threading.Thread):
+    """
+    A subscriber that decodes the headers of the frames it receives and
+    times how long after the read each one arrives.
+    """
+
+    def __init__(self, host, port):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.create_connection((host, port))
+        self.frames = 0
+        self.bytes = 0
+        self.lost = 0 # frames the server dropped, from the sequence numbers
+        self.latency = Histogram()
+        self.last_seq = {}
+
+    def run(self):
+        try:
+            for body in recv_frames(self.sock):
+                now = time.time()
+                header = decode_header(body)
+                key = body[HEADER.size:HEADER.size+header['key_len']]
+                last = self.last_seq.get(key)
+                if last is not None:
+                    self.lost += (header['seq'] - last - 1) % 2**32
+                self.last_seq[key] = header['seq']
+                self.frames += 1
+                self.bytes += LENGTH.size + len(body)
+                self.latency.add(now - header['t'])
+        except socket.error:
+            pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def load_test(host, port, clients, seconds):
+    """
+    Connects clients subscribers for seconds and returns a report of the
+    frames and bytes they received per second, how many the server dropped,
+    and the latency from the read to the subscriber.
+    """
+
+    subscribers = [LoadClient(host, port) for k in range(clients)]
+    for subscriber in subscribers:
+        subscriber.start()
+    time.sleep(seconds)
+    for subscriber in subscribers:
+        subscriber.close()
+    for subscriber in subscribers:
+        subscriber.join()
+
+    latency = Histogram()
+    for subscriber in subscribers:
+        latency.merge(subscriber.latency)
+    frames = sum([s.frames for s in subscribers])
+    received = sum([s.bytes for s in subscribers])
+    lost = sum([s.lost for s in subscribers])
+    if latency.n == 0:
+        return '%d clients received nothing' % clients
+    return ('%d clients: %.0f frames/s, %.2f MB/s, %d frames dropped, '
+            'latency p50 %.1f ms, p99 %.1f ms, max %.1f ms' %
+            (clients, frames/seconds, received/seconds/1e6, lost,
+             1e3*latency.percentile(50), 1e3*latency.percentile(99), 1e3*latency.max))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream every pulse oximeter on the host over TCP.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('serve', help='serve the devices on the host')
+    p.add_argument('--simulate', type=int, metavar='N',
+                   help='serve N simulated devices instead of the USB devices')
+    p.add_argument('--host', default='')
+    p.add_argument('--port', type=int, default=PORT)
+    p.add_argument('--view', choices=['short', 'long'], default='short')
+    p.add_argument('--seconds', type=float, help='stop after this long')
+
+    p = commands.add_parser('loadtest', help='subscribe many clients to a server')
+    p.add_argument('--host', default='localhost')
+    p.add_argument('--port', type=int, default=PORT)
+    p.add_argument('--clients', type=int, default=10)
+    p.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'loadtest':
+        print(load_test(args.host, args.port, args.clients, args.seconds))
+        return 0
+
+    find = find_usb_devices if args.simulate is None else simulated_devices(args.simulate)
+    manager = DeviceManager(find, view=args.view)
+    server = StreamServer(args.host, args.port)
+    serve(manager, server)
+    server.start()
+    manager.start()
+    t0 = time.time()
+    try:
+        while args.seconds is None or time.time() - t0 < args.seconds:
+            time.sleep(1)
+            print('%(clients)d clients, %(published)d frames published, %(sent)d sent, '
+                  '%(dropped)d dropped' % server.status())
+    except KeyboardInterrupt:
+        pass
+    manager.stop()
+    server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
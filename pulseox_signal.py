@@ -0,0 +1,678 @@
+'''
+Signal processing routines shared by the host programs.
+Author: Jonathan Thomson
+Released Under the MIT License
+'''
+
+import sys
+from collections import deque
+
+from numpy import arange, float64, int64, isscalar, log, maximum, mean, minimum, ndarray, zeros
+
+from pulseox_profile import timer
+from pulseox_protocol import DATASET_FIELDS, RED, IR, SAMPLE_NUM, ring_write
+
+# hysteresis used when locating heart beats on the sum of the normalized PPGs
+PEAK_DELTA = 0.15
+
+# a, b, c, d of the calibration curve SpO2 = 100*(a - b*R)/(c + d*R), see
+# analyze_beats()
+SPO2_CURVE = (0.81, 0.18, 0.63, 0.11)
+
+
+def peakdet(v, delta):
+    """
+    Converted from MATLAB script at http://billauer.co.il/peakdet.html
+
+    Returns two lists, the indices of the maxima and of the minima in v,
+    both in increasing order.
+
+    function [maxtab, mintab]=peakdet(v, delta, x)
+    %PEAKDET Detect peaks in a vector
+    %        [MAXTAB, MINTAB] = PEAKDET(V, DELTA) finds the local
+    %        maxima and minima ("peaks") in the vector V.
+    %        MAXTAB and MINTAB consists of two columns. Column 1
+    %        contains indices in V, and column 2 the found values.
+    %
+    %        With [MAXTAB, MINTAB] = PEAKDET(V, DELTA, X) the indices
+    %        in MAXTAB and MINTAB are replaced with the corresponding
+    %        X-values.
+    %
+    %        A point is considered a maximum peak if it has the maximal
+    %        value, and was preceded (to the left) by a value lower by
+    %        DELTA.
+
+    % Eli Billauer, 3.4.05 (Explicitly not copyrighted).
+    % This function is released to the public domain; Any use is allowed.
+
+    The scan runs from right to left because that detects heart beats better.
+    The peaks are appended as they're found and the lists reversed once at
+    the end, and the loop runs over a plain list of floats rather than
+    indexing the numpy array, so the whole search is a single O(n) pass.
+    """
+
+    if not isscalar(delta):
+        sys.exit('Input argument delta must be a scalar')
+
+    if delta <= 0:
+        sys.exit('Input argument delta must be positive')
+
+    if isinstance(v, ndarray):
+        v = v.tolist()
+    else:
+        v = list(v)
+
+    maxtab = []
+    mintab = []
+
+    mn, mx = float('inf'), -float('inf')
+    mnpos, mxpos = None, None
+
+    lookformax = True
+    pos = len(v)
+    for this in reversed(v):
+        pos -= 1
+        if this > mx:
+            mx = this
+            mxpos = pos
+        if this < mn:
+            mn = this
+            mnpos = pos
+
+        if lookformax:
+            if this < mx-delta:
+                maxtab.append(mxpos)
+                mn = this
+                mnpos = pos
+                lookformax = False
+        else:
+            if this > mn+delta:
+                mintab.append(mnpos)
+                mx = this
+                mxpos = pos
+                lookformax = True
+
+    # lower indices are more to the left
+    maxtab.reverse()
+    mintab.reverse()
+
+    return maxtab, mintab
+
+
+def analyze_window(n, Ired, Iir, graph_width, edge_threshold, sample_period, K,
+                   profiler=None, detect=None, snap=None, curve=SPO2_CURVE):
+    """
+    Processes one window of samples. n, Ired and Iir are the sample numbers
+    and the red and IR intensities ordered oldest to newest.
+
+    Returns tn, nPPG_red, nPPG_ir, systole, diastole, time_elapsed, SpO2
+    where tn is the x coordinate of each sample when plotted graph_width
+    pixels wide, nPPG_red and nPPG_ir are the normalized photoplethysmograms,
+    systole and diastole are the indices of the PPG peaks and troughs,
+    time_elapsed is the time between the first and last peak, and SpO2 is
+    the list of plausible SpO2 values calculated from each beat. If too few
+    beats are found systole and diastole are 'NA' and time_elapsed and SpO2
+    are None.
+
+    If detect is given the beats are looked for on it instead, a filtered
+    version of the PPGs (see pulseox_filter.py), and then moved onto the
+    peaks and troughs of the unfiltered PPGs with snap_beats() and snap,
+    a (delay, width) pair.
+
+    If profiler is given the PPG, peakdet and SpO2 stages are timed.
+
+    K and curve are the calibration, see ratio_SpO2().
+    """
+
+    if profiler is not None:
+        t0 = timer()
+
+    tn = float(graph_width)*(n - n[0])/(n[-1] - n[0])
+
+    # photoplethysmograms
+    PPG_red = -1*log(Ired/float(Ired.max()))
+    PPG_ir = -1*log(Iir/float(Iir.max()))
+
+    mxr = float(PPG_red.max())
+    mxi = float(PPG_ir.max())
+
+    if (mxr > mxi):
+        nf = mxr
+    else:
+        nf = mxi
+
+    # limiting the normalization factor will prevent the traces from getting
+    # too small but may cause them to overlap.
+    #if (nf > 0.10):
+    #   nf = 0.10
+
+    # normalize PPGs for plotting
+    nPPG_red = PPG_red/nf
+    nPPG_ir = PPG_ir/nf
+
+    # Locate heartbeats
+    # systole - PPG peak (heartbeat), intensity trough
+    # diastole - PPG trough, intensity peak
+    # Find peaks on mean of normalized PPGs so delta can be constant
+    # and differences in the peak locations on the separate PPGs are
+    # averaged out.
+    #systole, diastole = peakdet(((PPG_red/mxr)+(PPG_ir/mxi)), 0.5)
+    #systole, diastole = peakdet(((PPG_red/mxr)+(PPG_ir/mxi)), 0.25)
+    s = (PPG_red/mxr)+(PPG_ir/mxi)
+    if profiler is not None:
+        t1 = timer()
+        profiler.add('PPG', t1-t0)
+
+    if detect is None:
+        systole, diastole = peakdet(s, PEAK_DELTA)
+    else:
+        systole, diastole = peakdet(detect, PEAK_DELTA)
+        systole, diastole = snap_beats(s, systole, diastole, snap[0], snap[1])
+    if profiler is not None:
+        t2 = timer()
+        profiler.add('peakdet', t2-t1)
+
+    systole, diastole, time_elapsed, SpO2 = \
+    analyze_beats(systole, diastole, n, Ired, Iir, edge_threshold, sample_period, K,
+                  curve=curve)
+    if profiler is not None:
+        profiler.add('SpO2', timer()-t2)
+
+    return tn, nPPG_red, nPPG_ir, systole, diastole, time_elapsed, SpO2
+
+
+def snap_beats(s, systole, diastole, delay, width):
+    """
+    Moves each peak in systole to the largest value of s, and each trough
+    in diastole to the smallest, within width samples of the index less
+    delay. Finds the peaks and troughs of the PPG that a filter delaying it
+    by delay samples put at systole and diastole. The peaks and troughs
+    keep their order so they still alternate.
+    """
+
+    events = sorted([(i, True) for i in systole] + [(i, False) for i in diastole])
+    centers = [int(round(i - delay)) for i, is_max in events]
+    num = len(s)
+    snapped = []
+    last = -1
+    for k, (i, is_max) in enumerate(events):
+        lo = max(centers[k] - width, last + 1, 0)
+        hi = min(centers[k] + width + 1, num)
+        if k + 1 < len(events):
+            hi = min(hi, max(centers[k+1], lo + 1))
+        if lo >= hi:
+            lo = min(max(centers[k], last + 1), num - 1)
+            hi = lo + 1
+        if is_max:
+            last = lo + int(s[lo:hi].argmax())
+        else:
+            last = lo + int(s[lo:hi].argmin())
+        snapped.append((last, is_max))
+    return ([i for i, is_max in snapped if is_max],
+            [i for i, is_max in snapped if not is_max])
+
+
+def beat_ratios(systole, diastole, Ired, Iir):
+    """
+    Returns the red and IR PPG amplitudes, the log of the intensity at the
+    trough of the PPG (diastole) over the mean of the 5 intensities around
+    its peak (systole), of one beat. R is their ratio.
+    """
+
+    # 5 points surrounding intensity trough
+    rs = list(range(systole-2, systole+3))
+
+    Rred = log(Ired[diastole]/mean(Ired[rs]))
+    Rir = log(Iir[diastole]/mean(Iir[rs]))
+    return Rred, Rir
+
+
+def ratio_SpO2(R, K, curve=SPO2_CURVE):
+    # the SpO2 [%] of a beat's ratio R with the calibration constant K and
+    # the coefficients a, b, c, d of the calibration curve
+    #SpO2new = 100*(0.81 - 0.18*R[-1])/(0.63 + 0.11*R[-1])
+    #SpO2new = 5.05*R[-1]**2 - 47.62*R[-1] + 129.57 # 96 --> 98.1 ***
+    a, b, c, d = curve
+    return 100*(a - b*(R+K))/(c + d*(R+K))
+
+
+def analyze_beats(systole, diastole, n, Ired, Iir, edge_threshold, sample_period, K,
+                  beat_cache=None, offset=0, curve=SPO2_CURVE):
+    """
+    Discards unreliable peaks and troughs and calculates the time elapsed
+    between the first and last peak and the SpO2 of each beat.
+
+    If beat_cache is a dict the SpO2 of each beat is looked up in it, and
+    stored in it, keyed by the peak and trough indices plus offset so that
+    beats don't have to be recalculated each refresh. The cached values are
+    only valid for the K and curve they were calculated with.
+    """
+
+    if not (len(systole) > 2 and len(diastole) > 2):
+        return 'NA', 'NA', None, None
+
+    # last PPG peak found is wrong if it's near the end of the data
+    if (systole[-1] > edge_threshold):
+        systole = systole[:-1]
+
+    # last PPG trough found is wrong if it's near the end of the data
+    if (diastole[-1] > edge_threshold):
+        diastole = diastole[:-1]
+
+    # to be consistent when calculating R, the first PPG
+    # trough should always be after the first PPG peak
+    if (diastole[0] <= systole[0]):
+        diastole = diastole[1:]
+
+    time_elapsed = sample_period*(n[systole[-1]] - n[systole[0]])
+
+    SpO2 = []
+    for i in range(len(diastole)):
+        # Introduction to Pulse oximetry, Sagar G V, August 21, 2012
+        # page 4
+        # R = ln(I_rxR_peak/I_rxR_trough)/ln(I_rxIR_peak/I_rxIR_trough) Eq. 7
+        # for red LED light at 660 nm and infrared LED light at 940 nm:
+        # SpO2 = ((0.81 - 0.18*R)./(0.63 + 0.11*R))*100%
+        #
+        # Intensity peaks occur during diastole and troughs
+        # during systole
+
+        # A peak within 2 samples of the start of the window picks up
+        # samples from the other end, so it can't be cached.
+        cacheable = beat_cache is not None and systole[i] >= 2
+        key = (systole[i]+offset, diastole[i]+offset)
+        if cacheable and key in beat_cache:
+            SpO2new = beat_cache[key]
+        else:
+            Rred, Rir = beat_ratios(systole[i], diastole[i], Ired, Iir)
+            SpO2new = ratio_SpO2(Rred/Rir, K, curve)
+            if cacheable:
+                beat_cache[key] = SpO2new
+
+        if (SpO2new > 85 and SpO2new < 100):
+            SpO2.append(SpO2new)
+
+    return systole, diastole, time_elapsed, SpO2
+
+
+class SlidingExtremum():
+    """
+    Running maximum (or minimum) over the last window samples using a
+    monotonic deque. Each push is O(1) amortized.
+    """
+
+    def __init__(self, window, maximum=True):
+        self.window = window
+        self.maximum = maximum
+        self.q = deque() # (sample index, value), values monotonic
+
+    def push(self, idx, value):
+        q = self.q
+        if self.maximum:
+            while q and q[-1][1] <= value:
+                q.pop()
+        else:
+            while q and q[-1][1] >= value:
+                q.pop()
+        q.append((idx, value))
+        while q[0][0] <= idx-self.window:
+            q.popleft()
+
+    def extend(self, idx, values):
+        # Pushes values[k] as sample idx+k. A value that is exceeded by a
+        # later one in the block can never be the extremum, so only the
+        # others are pushed.
+        if len(values) == 0:
+            return
+        if self.maximum:
+            suffix = maximum.accumulate(values[::-1])[::-1]
+            keep = (values[:-1] > suffix[1:]).nonzero()[0].tolist()
+        else:
+            suffix = minimum.accumulate(values[::-1])[::-1]
+            keep = (values[:-1] < suffix[1:]).nonzero()[0].tolist()
+        keep.append(len(values)-1)
+        for k in keep:
+            self.push(idx+k, values[k].item())
+
+    def value(self):
+        return self.q[0][1]
+
+
+class StreamAnalyzer():
+    """
+    Produces the same results as analyze_window() on the last buffersize
+    samples but keeps its derived state between refreshes so each refresh
+    only has to process the samples that arrived since the last one.
+
+    - The raw data and the derived PPGs are kept in mirrored buffers of
+      length 2*buffersize so the window is always a contiguous view and
+      never has to be unrolled.
+    - The maximum and minimum intensity of each LED are tracked with
+      monotonic deques. The PPGs are normalized by those four values so
+      while none of them changes the PPGs calculated for older samples are
+      still valid and only the new samples need log() applied. When one
+      does change the window is rebuilt just like analyze_window() would,
+      and scanned again. If only a minimum changed the PPGs stored are
+      still right and only s is recalculated from them.
+    - peakdet() scans from right to left and its state after each peak or
+      trough it confirms depends only on that sample. So the scan starts at
+      the newest sample and stops as soon as it confirms the same peak or
+      trough at the same sample as the previous scan did. The rest of the
+      previous scan is reused.
+    - The SpO2 calculated from each beat is cached.
+
+    If filters is a pair of pulseox_filter.FilterChains the beats are looked
+    for on the red and IR PPGs filtered by them, each divided by its range
+    in the window, and moved onto the peaks and troughs of the unfiltered
+    PPGs like analyze_window() does with snap. The samples are filtered as
+    they're pushed, so the filtered PPGs never change once calculated and
+    only have to be divided again when a range changes.
+
+    Set profiler to a pulseox_profile.Profiler to time the PPG, peakdet and
+    SpO2 stages of each update(), and the filter stage of each push().
+    """
+
+    def __init__(self, buffersize, graph_width, edge_threshold, sample_period, K,
+                 filters=None, snap=None, curve=SPO2_CURVE):
+        self.B = buffersize
+        self.graph_width = graph_width
+        self.edge_threshold = edge_threshold
+        self.sample_period = sample_period
+        self.K = K
+        self.curve = curve
+
+        B = self.B
+        self.raw = zeros((2*B, DATASET_FIELDS), dtype=int64)
+        self.n = self.raw[:, SAMPLE_NUM]
+        self.red = self.raw[:, RED]
+        self.ir = self.raw[:, IR]
+        self.PPG_red = zeros(2*B)
+        self.PPG_ir = zeros(2*B)
+        self.s = zeros(2*B) # signal searched by peakdet()
+
+        self.tn_linear = float(graph_width)*arange(B)/(B-1)
+
+        self.total = 0 # number of datasets pushed, counting the initial fill
+        self.processed = 0 # value of total at the last update()
+        self.norm = None # intensity extremes the derived buffers are valid for
+        self.events = [] # (sample, is_max, peak) from the last scan, newest first
+        self.beat_cache = {} # SpO2 of each beat keyed by its peak and trough
+        # indices of the samples whose sample number doesn't follow the one
+        # before them
+        self.gap_at = deque()
+
+        self.extrema = [SlidingExtremum(B, True), SlidingExtremum(B, False),
+                        SlidingExtremum(B, True), SlidingExtremum(B, False)]
+
+        self.filters = filters
+        self.snap = snap
+        if filters is not None:
+            self.F_red = zeros(2*B) # filtered PPGs
+            self.F_ir = zeros(2*B)
+            self.sf = zeros(2*B) # signal searched by peakdet()
+            self.fnorm = None # ranges sf is valid for
+            self.f_extrema = [SlidingExtremum(B, True), SlidingExtremum(B, False),
+                              SlidingExtremum(B, True), SlidingExtremum(B, False)]
+
+        # work counters
+        self.refreshes = 0
+        self.rebuilds = 0
+        self.scanned = 0
+        self.profiler = None
+
+    def push(self, datasets):
+        # datasets is an (N, 3) array of (red, IR, sample number) rows
+        B = self.B
+        if self.total == 0:
+            # Same as the Worker's first loop: fill the window with the first
+            # dataset so the traces are visible straight away.
+            self.red[:] = datasets[0, RED]
+            self.ir[:] = datasets[0, IR]
+            n0 = int(datasets[0, SAMPLE_NUM])
+            self.n[:B] = range(n0-B, n0)
+            self.n[B:] = self.n[:B]
+            self.total = B
+            self.processed = B
+            for k, v in enumerate([datasets[0, RED], datasets[0, RED],
+                                   datasets[0, IR], datasets[0, IR]]):
+                self.extrema[k].push(B-1, int(v))
+            if self.filters is not None:
+                # as if the first dataset had always been there
+                for F, chain, column in [(self.F_red, self.filters[0], RED),
+                                         (self.F_ir, self.filters[1], IR)]:
+                    F[:] = chain.reset(-log(max(float(datasets[0, column]), 1.0)))
+                for k, F in enumerate([self.F_red, self.F_red, self.F_ir, self.F_ir]):
+                    self.f_extrema[k].push(B-1, float(F[0]))
+
+        num = len(datasets)
+        i = self.total % B
+        nums = datasets[:, SAMPLE_NUM].astype(int64)
+        if nums[0] - self.n[(self.total-1) % B] != 1:
+            self.gap_at.append(self.total)
+        for k in ((nums[1:] - nums[:-1]) != 1).nonzero()[0].tolist():
+            self.gap_at.append(self.total+k+1)
+
+        ring_write(self.raw[:B], i, datasets)
+        ring_write(self.raw[B:], i, datasets)
+
+        if self.filters is not None:
+            if self.profiler is not None:
+                t0 = timer()
+            for F, chain, column in [(self.F_red, self.filters[0], RED),
+                                     (self.F_ir, self.filters[1], IR)]:
+                # an intensity of 0 would leave the filter's state infinite
+                values = chain.process(-log(maximum(datasets[:, column], 1).astype(float64)))
+                ring_write(F[:B], i, values)
+                ring_write(F[B:], i, values)
+            if self.profiler is not None:
+                self.profiler.add('filter', timer()-t0)
+        self.total += num
+
+    def window(self):
+        # returns n, Ired, Iir for the last B samples as views
+        o = self.total % self.B
+        return self.n[o:o+self.B], self.red[o:o+self.B], self.ir[o:o+self.B]
+
+    def update(self):
+        """
+        Returns the same tuple as analyze_window() for the current window.
+        """
+
+        profiler = self.profiler
+        if profiler is not None:
+            t0 = timer()
+
+        B = self.B
+        lo = self.total - B # sample index of the oldest sample in the window
+        o = self.total % B  # offset of the window in the mirrored buffers
+        new = self.total - self.processed
+        n, Ired, Iir = self.window()
+
+        self.refreshes += 1
+
+        if new >= B:
+            rebuild = True
+            first = lo
+        else:
+            rebuild = False
+            first = self.processed
+
+        k = o+B-(self.total-first)
+        for e, values in zip(self.extrema, [self.red, self.red, self.ir, self.ir]):
+            e.extend(first, values[k:o+B])
+        norm = tuple([e.value() for e in self.extrema])
+        # the PPGs already stored only depend on the maxima
+        maxima = (self.norm is not None and not rebuild and
+                  (norm[0], norm[2]) == (self.norm[0], self.norm[2]))
+        if norm != self.norm:
+            rebuild = True
+        self.norm = norm
+
+        # tn is the same every refresh as long as the sample numbers are
+        # contiguous
+        while self.gap_at and self.gap_at[0] <= lo:
+            self.gap_at.popleft()
+        if not self.gap_at:
+            tn = self.tn_linear
+        else:
+            tn = float(self.graph_width)*(n - n[0])/(n[-1] - n[0])
+
+        if rebuild:
+            self.rebuilds += 1
+            if maxima:
+                # only a minimum moved, so only the scale of s changed and
+                # just the new samples need log()
+                k = o+B-new
+                PPG_red = self.PPG_red[o:o+B].copy()
+                PPG_ir = self.PPG_ir[o:o+B].copy()
+                PPG_red[B-new:] = -1*log(self.red[k:o+B]/float(norm[0]))
+                PPG_ir[B-new:] = -1*log(self.ir[k:o+B]/float(norm[2]))
+            else:
+                PPG_red = -1*log(Ired/float(Ired.max()))
+                PPG_ir = -1*log(Iir/float(Iir.max()))
+            self.mxr = float(PPG_red.max())
+            self.mxi = float(PPG_ir.max())
+            if (self.mxr > self.mxi):
+                self.nf = self.mxr
+            else:
+                self.nf = self.mxi
+            self._store(0, B, PPG_red, PPG_ir)
+            if self.filters is None:
+                self.events = []
+        else:
+            k = o+B-new
+            PPG_red = -1*log(self.red[k:o+B]/float(norm[0]))
+            PPG_ir = -1*log(self.ir[k:o+B]/float(norm[2]))
+            self._store(B-new, new, PPG_red, PPG_ir)
+
+        if self.filters is None:
+            signal = self.s
+        else:
+            self._update_filtered(first, new, o)
+            signal = self.sf
+
+        self.processed = self.total
+        if profiler is not None:
+            t1 = timer()
+            profiler.add('PPG', t1-t0)
+
+        systole, diastole = self._scan(lo, o, signal)
+        if self.filters is not None:
+            systole, diastole = snap_beats(self.s[o:o+B], systole, diastole,
+                                           self.snap[0], self.snap[1])
+        if profiler is not None:
+            t2 = timer()
+            profiler.add('peakdet', t2-t1)
+
+        self.beat_cache = dict([(key, v) for key, v in self.beat_cache.items() if key[0] >= lo])
+        systole, diastole, time_elapsed, SpO2 = \
+        analyze_beats(systole, diastole, n, Ired, Iir, self.edge_threshold,
+                      self.sample_period, self.K, self.beat_cache, lo, self.curve)
+        if profiler is not None:
+            profiler.add('SpO2', timer()-t2)
+
+        nPPG_red = self.PPG_red[o:o+B]/self.nf
+        nPPG_ir = self.PPG_ir[o:o+B]/self.nf
+
+        return tn, nPPG_red, nPPG_ir, systole, diastole, time_elapsed, SpO2
+
+    def _store(self, start, num, PPG_red, PPG_ir):
+        # write derived values for window positions start..start+num-1 into
+        # both halves of the mirrored buffers
+        B = self.B
+        i = (self.total + start) % B
+        s = (PPG_red/self.mxr)+(PPG_ir/self.mxi)
+        for cb, values in [(self.PPG_red, PPG_red), (self.PPG_ir, PPG_ir), (self.s, s)]:
+            ring_write(cb[:B], i, values)
+            ring_write(cb[B:], i, values)
+
+    def _update_filtered(self, first, new, o):
+        # brings sf up to date with the samples from first on
+        B = self.B
+        k = o+B-(self.total-first)
+        for e, values in zip(self.f_extrema, [self.F_red, self.F_red, self.F_ir, self.F_ir]):
+            e.extend(first, values[k:o+B])
+        fnorm = tuple([e.value() for e in self.f_extrema])
+        if fnorm != self.fnorm or new >= B:
+            start, num = 0, B
+            self.events = []
+        else:
+            start, num = B-new, new
+        self.fnorm = fnorm
+        self.frr = (fnorm[0] - fnorm[1]) or 1.0
+        self.fri = (fnorm[2] - fnorm[3]) or 1.0
+
+        i = (self.total + start) % B
+        sf = self.F_red[o+start:o+B]/self.frr + self.F_ir[o+start:o+B]/self.fri
+        ring_write(self.sf[:B], i, sf)
+        ring_write(self.sf[B:], i, sf)
+
+    def detection_window(self):
+        """
+        Returns the signal the beats are looked for on in the current window
+        when filtering, the filtered PPGs each divided by its range.
+        """
+
+        o = self.total % self.B
+        F_red = self.F_red[o:o+self.B]
+        F_ir = self.F_ir[o:o+self.B]
+        return F_red/((F_red.max() - F_red.min()) or 1.0) + F_ir/((F_ir.max() - F_ir.min()) or 1.0)
+
+    def _scan(self, lo, o, signal):
+        # peakdet() on signal from the newest sample leftwards until it
+        # agrees with the previous scan
+        previous = dict([((e[0], e[1]), k) for k, e in enumerate(self.events)])
+        delta = PEAK_DELTA
+        events = []
+        synced = None
+
+        mn, mx = float('inf'), -float('inf')
+        mnpos, mxpos = None, None
+        lookformax = True
+
+        pos = self.total
+        hi = self.total
+        chunk = 256
+        while hi > lo and synced is None:
+            start = max(lo, hi-chunk)
+            values = signal[o+start-lo:o+hi-lo].tolist()
+            self.scanned += len(values)
+            for this in reversed(values):
+                pos -= 1
+                if this > mx:
+                    mx = this
+                    mxpos = pos
+                if this < mn:
+                    mn = this
+                    mnpos = pos
+
+                if lookformax:
+                    if this < mx-delta:
+                        events.append((pos, True, mxpos))
+                        mn = this
+                        mnpos = pos
+                        lookformax = False
+                        synced = previous.get((pos, True))
+                        if synced is not None:
+                            break
+                else:
+                    if this > mn+delta:
+                        events.append((pos, False, mnpos))
+                        mx = this
+                        mxpos = pos
+                        lookformax = True
+                        synced = previous.get((pos, False))
+                        if synced is not None:
+                            break
+            hi = start
+
+        if synced is not None:
+            for e in self.events[synced+1:]:
+                if e[0] < lo:
+                    break
+                events.append(e)
+        self.events = events
+
+        systole = [e[2]-lo for e in reversed(events) if e[1]]
+        diastole = [e[2]-lo for e in reversed(events) if not e[1]]
+        return systole, diastole
@@ -0,0 +1,228 @@
+'''
+Median, percentiles, mean and variance of the values that arrived within the
+last so many samples, kept up to date as values are added.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+The heart rate and SpO2 used to be the median of the last HRBUFFERSIZE and
+SPO2BUFFERSIZE refreshes, which is a different stretch of time for every view
+and was recomputed from scratch every refresh. Windows here are spans of
+sample numbers, so a 3 second window is 3 seconds whatever the refresh rate
+and however many reads were lost.
+
+The values are counted in bins between lo and hi in a binary indexed
+(Fenwick) tree, and each bin keeps its own values sorted. Adding a value,
+dropping the oldest one and finding the k-th smallest are then a walk down
+the tree plus a search of one short bin, so they cost the same for a 3
+second window as for a 5 minute one. Values outside lo to hi go in the first
+or last bin, which keeps the results exact but makes those bins slower.
+
+    stats = WindowedStats(dict(display=500, trend=50000), lo=0, hi=300)
+    stats.add(n, heart_rate)
+    stats['display'].median(), stats['trend'].percentile(90)
+'''
+
+from bisect import bisect_left, insort
+from collections import deque
+from math import floor, sqrt
+
+NUM_BINS = 1024
+
+
+class OrderStatistics():
+    """
+    A multiset of numbers that can find its k-th smallest member.
+    """
+
+    def __init__(self, lo, hi, bins=NUM_BINS):
+        self.lo = float(lo)
+        self.num_bins = bins
+        self.scale = bins/(float(hi) - self.lo)
+        self.clear()
+
+    def clear(self):
+        self.tree = [0]*(self.num_bins + 1) # Fenwick tree of the bin counts
+        self.bins = [[] for b in range(self.num_bins)]
+        self.n = 0
+        self.top = 1 # the largest power of 2 not above num_bins
+        while 2*self.top <= self.num_bins:
+            self.top *= 2
+
+    def _bin(self, value):
+        b = int((value - self.lo)*self.scale)
+        if b < 0:
+            return 0
+        if b >= self.num_bins:
+            return self.num_bins - 1
+        return b
+
+    def _update(self, b, d):
+        tree = self.tree
+        i = b + 1
+        while i <= self.num_bins:
+            tree[i] += d
+            i += i & -i
+
+    def add(self, value):
+        b = self._bin(value)
+        insort(self.bins[b], value)
+        self._update(b, 1)
+        self.n += 1
+
+    def remove(self, value):
+        b = self._bin(value)
+        values = self.bins[b]
+        del values[bisect_left(values, value)]
+        self._update(b, -1)
+        self.n -= 1
+
+    def kth(self, k):
+        """
+        Returns the k-th smallest value, counting from 0.
+        """
+
+        tree = self.tree
+        rank = k + 1
+        b = 0
+        step = self.top
+        while step:
+            i = b + step
+            if i <= self.num_bins and tree[i] < rank:
+                b = i
+                rank -= tree[i]
+            step //= 2
+        return self.bins[b][rank - 1]
+
+
+class Window():
+    """
+    The values added with sample numbers within the last span sample
+    numbers.
+    """
+
+    def __init__(self, span, lo, hi, bins=NUM_BINS):
+        self.span = span
+        self.values = deque() # (n, value) oldest first
+        self.order = OrderStatistics(lo, hi, bins)
+        self.clear()
+
+    def clear(self):
+        self.values.clear()
+        self.order.clear()
+        # Sums of the values less the first one added, so the variance
+        # doesn't lose its precision to a large mean.
+        self.shift = None
+        self.sum = 0.0
+        self.sum2 = 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, n, value):
+        self.expire(n)
+        if self.shift is None:
+            self.shift = value
+        d = value - self.shift
+        self.sum += d
+        self.sum2 += d*d
+        self.values.append((n, value))
+        self.order.add(value)
+
+    def expire(self, n):
+        """
+        Drops the values older than span sample numbers before n.
+        """
+
+        values = self.values
+        start = n - self.span
+        while values and values[0][0] <= start:
+            old = values.popleft()[1]
+            d = old - self.shift
+            self.sum -= d
+            self.sum2 -= d*d
+            self.order.remove(old)
+        if not values:
+            # nothing left to drift from
+            self.shift = None
+            self.sum = 0.0
+            self.sum2 = 0.0
+
+    # The statistics are None while the window is empty.
+
+    def mean(self):
+        num = len(self.values)
+        if num == 0:
+            return None
+        return self.shift + self.sum/num
+
+    def variance(self):
+        num = len(self.values)
+        if num == 0:
+            return None
+        m = self.sum/num
+        return max(self.sum2/num - m*m, 0.0)
+
+    def std(self):
+        num = len(self.values)
+        return None if num == 0 else sqrt(self.variance())
+
+    def min(self):
+        return self.order.kth(0) if self.values else None
+
+    def max(self):
+        return self.order.kth(len(self.values) - 1) if self.values else None
+
+    def median(self):
+        num = len(self.values)
+        if num == 0:
+            return None
+        if num % 2:
+            return self.order.kth(num//2)
+        # like numpy.median
+        return (self.order.kth(num//2 - 1) + self.order.kth(num//2))/2.0
+
+    def percentile(self, p):
+        """
+        Returns the p-th percentile interpolated linearly between the
+        values either side of it, like numpy.percentile.
+        """
+
+        num = len(self.values)
+        if num == 0:
+            return None
+        rank = (num - 1)*p/100.0
+        k = int(floor(rank))
+        a = self.order.kth(k)
+        if k + 1 >= num or rank == k:
+            return a
+        b = self.order.kth(k + 1)
+        return a + (b - a)*(rank - k)
+
+
+class WindowedStats():
+    """
+    Several Windows of different spans over the same values. spans is a
+    dict of the span of each window in sample numbers keyed by its name.
+    """
+
+    def __init__(self, spans, lo, hi, bins=NUM_BINS):
+        self.windows = dict([(name, Window(span, lo, hi, bins))
+                             for name, span in spans.items()])
+        self.latest = None # the sample number of the newest value
+
+    def __getitem__(self, name):
+        return self.windows[name]
+
+    def add(self, n, value):
+        self.latest = n
+        for window in self.windows.values():
+            window.add(n, value)
+
+    def expire(self, n):
+        for window in self.windows.values():
+            window.expire(n)
+
+    def clear(self):
+        self.latest = None
+        for window in self.windows.values():
+            window.clear()
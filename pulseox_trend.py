@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+'''
+On-disk store of the heart rate and SpO2 trends of long sessions.
+Author: Jonathan Thomson
+Released Under the MIT License
+
+Every refresh and every beat is appended to a set of tables. Each table is
+stored a column per file, so a query only reads the columns it needs and
+hands them out as memory-mapped arrays without parsing anything:
+
+    refresh  host time, sample number, heart rate and SpO2 of every refresh
+    beat     host time, sample number, heart rate from the interval to the
+             previous beat, and SpO2 of every accepted beat
+    1s       min, max, median and count of the refresh heart rates and
+    1m       SpO2s in every second, minute and hour, at the start time of
+    1h       the second, minute or hour
+
+The files are split into a directory per UTC day:
+
+    store/2014-03-01/refresh/t.f8
+    store/2014-03-01/refresh/heartrate.f4
+    ...
+
+Rows are appended in time order so a time range is found by a binary search
+of the t column. A day of refreshes is about 320,000 rows and a query over
+all of them returns in a few milliseconds, one over a rollup faster still
+(benchmarks/bench_trend.py). Days older than a table's retention are deleted, so the store
+doesn't grow beyond RETENTION days of each table.
+
+A column may be a few rows longer than the others of its table if the
+program was killed mid-append. Those rows are ignored. A session restarted
+within the same second, minute or hour leaves two rollup rows for it.
+
+    python pulseox_trend.py info trend_data
+    python pulseox_trend.py query trend_data 1m --hours 8
+'''
+
+import argparse
+import calendar
+import os
+import shutil
+import sys
+import time
+
+from numpy import array, asarray, concatenate, dtype, float64, int64, isnan, median, memmap, \
+                  nan, searchsorted
+
+DAY = 86400 # seconds
+
+# name, numpy dtype of each column of each table
+_VITALS = [('heartrate', '<f4'), ('SpO2', '<f4')]
+_ROLLUP = [('t', '<f8')] + [('%s_%s' % (vital, stat), '<u4' if stat == 'count' else '<f4')
+                            for vital in ['heartrate', 'SpO2']
+                            for stat in ['min', 'max', 'median', 'count']]
+TABLES = {'refresh': [('t', '<f8'), ('n', '<i8')] + _VITALS,
+          'beat': [('t', '<f8'), ('n', '<i8')] + _VITALS,
+          '1s': _ROLLUP, '1m': _ROLLUP, '1h': _ROLLUP}
+
+ROLLUPS = [('1s', 1), ('1m', 60), ('1h', 3600)] # table, seconds
+RETENTION = {'refresh': 14, 'beat': 14, '1s': 60, '1m': 730, '1h': 3650} # days
+
+FLUSH_PERIOD = 1.0 # seconds between flushes to the files
+
+
+def _day(t):
+    return time.strftime('%Y-%m-%d', time.gmtime(t))
+
+
+def _day_start(day):
+    return float(calendar.timegm(time.strptime(day, '%Y-%m-%d')))
+
+
+def _column_path(root, day, table, column):
+    return os.path.join(root, day, table, '%s.%s' % (column, dtype(dict(TABLES[table])[column]).str[1:]))
+
+
+class _Rollup():
+    # The refresh values of the current bucket of one rollup table. The
+    # median needs every value so they're kept until the bucket closes.
+
+    def __init__(self, table, seconds):
+        self.table = table
+        self.seconds = seconds
+        self.bucket = None
+        self.values = dict(heartrate=[], SpO2=[])
+
+    def add(self, t, heartrate, SpO2):
+        # returns the row of the bucket t closed, if it closed one
+        bucket = int(t//self.seconds)
+        row = None
+        if bucket != self.bucket:
+            row = self.close()
+            self.bucket = bucket
+        for name, value in [('heartrate', heartrate), ('SpO2', SpO2)]:
+            if value is not None and not isnan(value):
+                self.values[name].append(value)
+        return row
+
+    def close(self):
+        if self.bucket is None:
+            return None
+        row = dict(t=float(self.bucket*self.seconds))
+        for name, values in self.values.items():
+            if values:
+                row[name + '_min'] = min(values)
+                row[name + '_max'] = max(values)
+                row[name + '_median'] = median(values)
+            else:
+                row[name + '_min'] = row[name + '_max'] = row[name + '_median'] = nan
+            row[name + '_count'] = len(values)
+            self.values[name] = []
+        self.bucket = None
+        return row
+
+
+class TrendWriter():
+    """
+    Appends refreshes and beats to the store in the directory root.
+    """
+
+    def __init__(self, root, retention=RETENTION):
+        self.root = root
+        self.retention = retention
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.files = {} # open files of the current day by (table, column)
+        self.day = dict.fromkeys(TABLES) # day of the open files of each table
+        self.rollups = [_Rollup(table, seconds) for table, seconds in ROLLUPS]
+        self.last_flush = time.time()
+        expire(root, time.time(), retention)
+
+    def _append(self, table, t, rows):
+        # rows is a dict of a value or an array of values of every column
+        day = _day(t)
+        if day != self.day[table]:
+            for column, dt in TABLES[table]:
+                f = self.files.pop((table, column), None)
+                if f is not None:
+                    f.close()
+            directory = os.path.join(self.root, day, table)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for column, dt in TABLES[table]:
+                self.files[(table, column)] = open(_column_path(self.root, day, table, column), 'ab')
+            if self.day[table] is not None:
+                expire(self.root, t, self.retention)
+            self.day[table] = day
+        for column, dt in TABLES[table]:
+            self.files[(table, column)].write(asarray(rows[column], dtype=dt).tobytes())
+
+    def add_refresh(self, t, n, heartrate, SpO2):
+        """
+        Appends the heart rate and SpO2 of the refresh at host time t whose
+        newest sample is n. Either may be None.
+        """
+
+        hr = nan if heartrate is None else heartrate
+        s = nan if SpO2 is None else SpO2
+        self._append('refresh', t, dict(t=t, n=n, heartrate=hr, SpO2=s))
+        for rollup in self.rollups:
+            row = rollup.add(t, hr, s)
+            if row is not None:
+                self._append(rollup.table, row['t'], row)
+        if time.time() - self.last_flush >= FLUSH_PERIOD:
+            self.flush()
+
+    def add_beats(self, beats):
+        """
+        Appends pulseox_beats.Beats, like PulseOxEngine.new_beats, each
+        with the heart rate from its own interval and its own SpO2. The
+        beats the quality score rejected and the first beat, which has no
+        interval before it, are skipped.
+        """
+
+        beats = [b for b in beats if b.accepted and b.rr is not None]
+        if not beats:
+            return
+        rows = dict(t=array([b.t for b in beats], dtype=float64),
+                    n=array([b.n for b in beats], dtype=int64),
+                    heartrate=60/array([b.rr for b in beats], dtype=float64),
+                    SpO2=array([b.SpO2 for b in beats], dtype=float64))
+        self._append('beat', rows['t'][0], rows)
+
+    def add(self, engine, t):
+        """
+        Appends the refresh and new beats of engine's last process(), the
+        newest read of which was made at host time t.
+        """
+
+        n = engine.window()[0]
+        self.add_refresh(t, int(n[-1]), engine.heartrate, engine.SpO2)
+        self.add_beats(engine.new_beats)
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        for rollup in self.rollups:
+            row = rollup.close()
+            if row is not None:
+                self._append(rollup.table, row['t'], row)
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.day = dict.fromkeys(TABLES)
+
+
+def days(root):
+    """
+    Returns the days in the store, oldest first.
+    """
+
+    if not os.path.isdir(root):
+        return []
+    return sorted([d for d in os.listdir(root) if len(d) == 10 and d[4] == '-'])
+
+
+def expire(root, now, retention=RETENTION):
+    """
+    Deletes the days of each table older than its retention in days.
+    """
+
+    for day in days(root):
+        age = (now - _day_start(day))/DAY - 1
+        for table, keep in retention.items():
+            directory = os.path.join(root, day, table)
+            if age >= keep and os.path.isdir(directory):
+                shutil.rmtree(directory)
+        if not os.listdir(os.path.join(root, day)):
+            os.rmdir(os.path.join(root, day))
+
+
+def _read_day(root, day, table, columns):
+    # memory maps the columns of one day of a table, cut to the shortest
+    arrays = {}
+    for column in set(['t'] + columns):
+        path = _column_path(root, day, table, column)
+        dt = dtype(dict(TABLES[table])[column])
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < dt.itemsize:
+            return None
+        arrays[column] = memmap(path, dtype=dt, mode='r', shape=(size//dt.itemsize,))
+    rows = min([len(a) for a in arrays.values()])
+    return dict([(k, a[:rows]) for k, a in arrays.items()])
+
+
+def query(root, table, t0, t1, columns=None):
+    """
+    Returns a dict of the columns of table, all of them if columns is None,
+    for the rows with t0 <= t < t1. Rows from a single day are read-only
+    views of the files.
+    """
+
+    columns = [c for c, dt in TABLES[table]] if columns is None else list(columns)
+    pieces = []
+    for day in days(root):
+        start = _day_start(day)
+        if start >= t1 or start + DAY <= t0:
+            continue
+        arrays = _read_day(root, day, table, columns)
+        if arrays is None:
+            continue
+        t = arrays['t']
+        i, j = searchsorted(t, [t0, t1])
+        if j > i:
+            pieces.append(dict([(c, arrays[c][i:j]) for c in columns]))
+
+    if len(pieces) == 1:
+        return pieces[0]
+    if not pieces:
+        return dict([(c, array([], dtype=dict(TABLES[table])[c])) for c in columns])
+    return dict([(c, concatenate([p[c] for p in pieces])) for c in columns])
+
+
+def choose_table(t0, t1, max_rows=2000):
+    """
+    Returns the finest rollup with at most max_rows rows between t0 and t1.
+    """
+
+    for table, seconds in ROLLUPS:
+        if (t1 - t0)/seconds <= max_rows:
+            return table
+    return ROLLUPS[-1][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect a heart rate and SpO2 trend store.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('info', help='the rows of every table of every day')
+    p.add_argument('root')
+
+    p = commands.add_parser('query', help='print a table over a time range')
+    p.add_argument('root')
+    p.add_argument('table', choices=sorted(TABLES) + ['auto'])
+    p.add_argument('--hours', type=float, default=8.0, help='the last this many hours')
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        for day in days(args.root):
+            counts = []
+            for table in sorted(TABLES):
+                arrays = _read_day(args.root, day, table, [])
+                counts.append('%s %d' % (table, 0 if arrays is None else len(arrays['t'])))
+            print('%s  %s' % (day, ', '.join(counts)))
+        return 0
+
+    t1 = time.time()
+    t0 = t1 - 3600*args.hours
+    table = choose_table(t0, t1) if args.table == 'auto' else args.table
+    rows = query(args.root, table, t0, t1)
+    columns = [c for c, dt in TABLES[table]]
+    print(' '.join(columns))
+    for k in range(len(rows['t'])):
+        print(' '.join([time.strftime('%H:%M:%S', time.localtime(rows['t'][k]))] +
+                       ['%g' % rows[c][k] for c in columns[1:]]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -64,7 +64,7 @@ const USB_Descriptor_Device_t PROGMEM DeviceDescriptor =
 		
 	.VendorID               = 0xFFFE,
 	.ProductID              = 0x0001,
-	.ReleaseNumber          = VERSION_BCD(00.01),
+	.ReleaseNumber          = VERSION_BCD(00.02),
 		
 	.ManufacturerStrIndex   = 0x01,
 	.ProductStrIndex        = 0x02,
@@ -75,11 +75,48 @@
    in the python program should have:
    FSAMPLE = 40 # [Hz] 16000000/(5*5*250*64)
    UC_TIMER_PERIOD = 0.001 # [s] (250*64)/16000000
+
+   Protocol v2
+   The v1 output buffer is overwritten every NTH_SAMPLE samples, so a host
+   that doesn't read within 5 datasets loses data, and sampling faster
+   only makes that worse. A host that sends REQ_SET_PROTOCOL with wValue 2
+   gets v2 packets instead. Every dataset is queued in a ring of RING_SIZE
+   datasets and sent exactly once, the IN endpoint is double-banked so one
+   packet can be filled while the other waits for the host, and a packet
+   holds up to V2_NUM_DATASETS datasets behind an 8 byte header:
+
+     uint8   protocol version, 2
+     uint8   number of datasets in the packet
+     uint16  datasets discarded because the ring was full, wraps around
+     uint32  sample number of the first dataset
+
+   followed by the red and IR moving averages of each dataset as uint16s,
+   which hold them exactly since the frequencies averaged are uint16s. The
+   sample numbers of the others follow on from the first. A bank is filled
+   once V2_MIN_DATASETS are queued, so a host that keeps up gets a packet
+   as often as in v1, and one that stalls gets the backlog 14 datasets at
+   a time. While the host stalls the ring and both banks hold at least
+   RING_SIZE+2*V2_MIN_DATASETS datasets, 444 ms at the default rate and
+   148 ms at 500 datasets a second. REQ_SET_NTH_SAMPLE sets how many
+   timer periods there are per dataset, 1 to 255, so the host can ask for
+   up to 1000 datasets a second without reflashing. REQ_GET_PROTOCOL
+   returns the newest version the firmware speaks. v1 firmware doesn't
+   answer it, which is how the host tells them apart.
 */
 
 #include "pulseox_USB.h"
 #include "freqmeasure.h"
 #define USB_BUFSIZE   5*3  // 3 data points per dataset. buffer 5 datasets.
+#define RING_SIZE   64  // v2 datasets queued, a power of 2, 256 bytes of RAM
+#define V2_HEADER_SIZE   8
+#define V2_NUM_DATASETS   ((EP_SIZE-V2_HEADER_SIZE)/4)  // 14
+#define V2_MIN_DATASETS   5
+#define PROTOCOL_MAX   2
+
+// vendor control requests
+#define REQ_GET_PROTOCOL     0x01
+#define REQ_SET_PROTOCOL     0x02
+#define REQ_SET_NTH_SAMPLE   0x03
 //#define M   64  // number of samples to average, works well at home
 #define M   128  // number of samples to average, better at apt?
 #define NTH_SAMPLE   6   // buffer a dataset to be output every Nth sample
@@ -107,6 +144,15 @@ static uint32_t dataToSend[USB_BUFSIZE] = {0};
 volatile static uint8_t take_sample = 1;
 static uint8_t idx = 0;
 static uint8_t new_dataset_buffered = 0;
+static uint32_t sample_num = 0;
+
+static uint8_t protocol = 1; // v1 until the host asks for v2
+static uint8_t nth_sample = NTH_SAMPLE;
+static uint16_t ring_red[RING_SIZE];
+static uint16_t ring_ir[RING_SIZE];
+static uint8_t ring_head = 0; // next slot written
+static uint8_t ring_count = 0; // datasets queued
+static uint16_t overflow = 0;
 
 ISR(TIMER0_COMPA_vect)
 {
@@ -163,7 +209,8 @@ void Main_Task(void)
 	static uint32_t sum_ir = 0;
 	static uint16_t i = 0;
 	static uint8_t j = 0;
-	static uint32_t sample_num = 0;
+	uint16_t red;
+	uint16_t ir;
 
 	if (take_sample)
 	{
@@ -192,29 +239,55 @@ void Main_Task(void)
 			i = 0;
 
 		j++;
-		if (j == NTH_SAMPLE)
+		if (j >= nth_sample)
 		{
 			j = 0;
 
-			dataToSend[idx] = ((sum_red+_BV((LOG2F(M)-1))) >> LOG2F(M));
-			dataToSend[idx+1] = ((sum_ir+_BV((LOG2F(M)-1))) >> LOG2F(M));
-			dataToSend[idx+2] = sample_num;
+			red = ((sum_red+_BV((LOG2F(M)-1))) >> LOG2F(M));
+			ir = ((sum_ir+_BV((LOG2F(M)-1))) >> LOG2F(M));
+
+			if (protocol == 1)
+			{
+				dataToSend[idx] = red;
+				dataToSend[idx+1] = ir;
+				dataToSend[idx+2] = sample_num;
+
+				new_dataset_buffered = 1;
+
+				idx = idx+3;
+				if (idx == USB_BUFSIZE)
+					idx = 0;
+			}
+			else
+			{
+				// a full ring loses its oldest dataset
+				ring_red[ring_head] = red;
+				ring_ir[ring_head] = ir;
+				ring_head = (ring_head+1) & (RING_SIZE-1);
+				if (ring_count == RING_SIZE)
+					overflow++;
+				else
+					ring_count++;
+			}
 			sample_num++;
-
-			new_dataset_buffered = 1;
-
-			idx = idx+3;
-			if (idx == USB_BUFSIZE)
-				idx = 0;
 		}
 
 	}
 
-	if (USB_DeviceState == DEVICE_STATE_Configured && new_dataset_buffered == 1)
+	if (USB_DeviceState == DEVICE_STATE_Configured)
 	{
-		PORTD |= _BV(PD3); // DEBUG: high to oscilloscope
-		Send_Data();
-		PORTD &= ~_BV(PD3); // DEBUG: low to oscilloscope
+		if (protocol == 1 && new_dataset_buffered == 1)
+		{
+			PORTD |= _BV(PD3); // DEBUG: high to oscilloscope
+			Send_Data();
+			PORTD &= ~_BV(PD3); // DEBUG: low to oscilloscope
+		}
+		else if (protocol == 2 && ring_count >= V2_MIN_DATASETS)
+		{
+			PORTD |= _BV(PD3); // DEBUG: high to oscilloscope
+			Send_Data_V2();
+			PORTD &= ~_BV(PD3); // DEBUG: low to oscilloscope
+		}
 	}
 
 }
@@ -242,6 +315,37 @@ void Send_Data(void)
 
 }
 
+/** Sends the oldest queued datasets as a v2 packet once a bank is free */
+void Send_Data_V2(void)
+{
+	uint8_t count;
+	uint8_t tail;
+	uint8_t k;
+
+	/* Select the IN Endpoint */
+	Endpoint_SelectEndpoint(IN_EP);
+
+	if (Endpoint_IsConfigured() && Endpoint_IsINReady() && Endpoint_IsReadWriteAllowed())
+	{
+		count = (ring_count < V2_NUM_DATASETS) ? ring_count : V2_NUM_DATASETS;
+		tail = (ring_head-ring_count) & (RING_SIZE-1);
+
+		Endpoint_Write_8(2);
+		Endpoint_Write_8(count);
+		Endpoint_Write_16_LE(overflow);
+		Endpoint_Write_32_LE(sample_num-ring_count);
+		for (k = 0; k < count; k++)
+		{
+			Endpoint_Write_16_LE(ring_red[tail]);
+			Endpoint_Write_16_LE(ring_ir[tail]);
+			tail = (tail+1) & (RING_SIZE-1);
+		}
+		Endpoint_ClearIN();
+		ring_count -= count;
+	}
+
+}
+
 void TSL230_Init(void)
 {
 	// disable TSL230
@@ -329,9 +433,10 @@ void EVENT_USB_Device_ConfigurationChanged(void)
 	bool success = 1;
 
 	/* Setup SendDataToHost Endpoint */
+	/* Double-banked so v2 can fill one bank while the host reads the other */
 	success &= Endpoint_ConfigureEndpoint(IN_EP, EP_TYPE_BULK,
 	                                      ENDPOINT_DIR_IN, EP_SIZE,
-	                                      ENDPOINT_BANK_SINGLE);
+	                                      ENDPOINT_BANK_DOUBLE);
 
 	while (!success)
 	{
@@ -350,16 +455,48 @@ void EVENT_USB_Device_ConfigurationChanged(void)
 	}
 }
 
-/** Event handler for the USB_UnhandledControlRequest event. This is used to catch standard, class,
+/** Event handler for the USB_ControlRequest event. This is used to catch standard, class,
  *  and vendor specific control requests that are not handled internally by the USB library so that
- *  they can be handled appropriately for the application.
+ *  they can be handled appropriately for the application. It used to be named
+ *  EVENT_USB_Device_UnhandledControlRequest, which this version of LUFA never calls.
  */
-void EVENT_USB_Device_UnhandledControlRequest(void)
+void EVENT_USB_Device_ControlRequest(void)
 {
+	uint8_t version = PROTOCOL_MAX;
+
 	/* Process specific control requests */
 	switch (USB_ControlRequest.bRequest)
 	{
+		case REQ_GET_PROTOCOL:
+			if (USB_ControlRequest.bmRequestType == (REQDIR_DEVICETOHOST | REQTYPE_VENDOR | REQREC_DEVICE))
+			{
+				Endpoint_ClearSETUP();
+				Endpoint_Write_Control_Stream_LE(&version, 1);
+				Endpoint_ClearOUT();
+			}
+			break;
+		case REQ_SET_PROTOCOL:
+			if (USB_ControlRequest.bmRequestType == (REQDIR_HOSTTODEVICE | REQTYPE_VENDOR | REQREC_DEVICE) &&
+			    USB_ControlRequest.wValue >= 1 && USB_ControlRequest.wValue <= PROTOCOL_MAX)
+			{
+				Endpoint_ClearSETUP();
+				protocol = USB_ControlRequest.wValue;
+				// start the queue afresh
+				ring_count = 0;
+				overflow = 0;
+				new_dataset_buffered = 0;
+				Endpoint_ClearStatusStage();
+			}
+			break;
+		case REQ_SET_NTH_SAMPLE:
+			if (USB_ControlRequest.bmRequestType == (REQDIR_HOSTTODEVICE | REQTYPE_VENDOR | REQREC_DEVICE) &&
+			    USB_ControlRequest.wValue >= 1 && USB_ControlRequest.wValue <= 255)
+			{
+				Endpoint_ClearSETUP();
+				nth_sample = USB_ControlRequest.wValue;
+				Endpoint_ClearStatusStage();
+			}
+			break;
 		default: break;
 	}
 }
-
@@ -46,6 +46,7 @@
 	/* Function Prototypes: */
 		void Main_Task(void);
 		void Send_Data(void);
+		void Send_Data_V2(void);
 
 		void TSL230_Init(void);
 		void Start_Timer(void);
@@ -54,6 +55,6 @@
 		void EVENT_USB_Device_Connect(void);
 		void EVENT_USB_Device_Disconnect(void);
 		void EVENT_USB_Device_ConfigurationChanged(void);
-		void EVENT_USB_Device_UnhandledControlRequest(void);
+		void EVENT_USB_Device_ControlRequest(void);
 
 #endif